@@ -1,18 +1,60 @@
+import logging
 import os
 import sqlite3
-import requests
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, make_response, g
 from flask_cors import CORS
 from dotenv import load_dotenv
 import json
-import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import firestore
 import resend
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 import uuid
+import time
+import threading
+from functools import wraps
 
 load_dotenv()
 
+# Local modules read their settings from the environment, so import after .env is loaded
+import rate_limit
+from rate_limit import rate_limited
+from metrics import metrics
+import support_outbox
+import firestore_outbox
+import paddle_index
+import paypal_verifications
+import payments_by_id
+import identities
+import user_sync
+import upstream
+import bulkheads
+import deadlines
+import shared_cache
+import structured_log
+from bulkheads import Overloaded
+from deadlines import DeadlineExceeded
+from readiness import Readiness
+import license_tokens
+from license_watch import LicenseWatcher
+from license_stats import LicenseStats
+from snapshot_rebuild import SnapshotRebuild
+from webhook_journal import WebhookJournal
+from sqlite_writer import SQLiteWriter
+from paddle_api import paddle_base_url, paddle_headers, webhook_fields
+from storage import DB_NAME, init_db, init_firestore
+from licensing import (
+    LICENSE_FIELDS, as_utc, license_fields, paddle_plan_type, plan_expiration, resolve_license,
+    revalidate_local, to_iso_z, trial_end_from,
+)
+from shared_cache import MISS
+
+# Raised instead of waiting on a slow or saturated upstream; handlers let them through
+FAIL_FAST = (DeadlineExceeded, Overloaded)
+
+# JSON lines written by a background thread: a slow log sink never holds up a request
+structured_log.setup()
+log = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app)
 
@@ -20,68 +62,38 @@ CORS(app)
 # Using provided key as default fallback
 resend.api_key = os.getenv("RESEND_API_KEY", "re_hkj5p2Fs_BBLyhPFKEPcSyqCbtuJeJ6ap")
 
-# Database setup
-DB_NAME = "licenses.db"
+# Initialize DB on start
+init_db()
 
-# Initialize Firebase Admin
-cred = None
+# The Firestore gRPC client and the background threads don't survive a fork: start_runtime()
+# creates them, at import or, under gunicorn --preload, in each worker (gunicorn.conf.py)
 db = None
-try:
-    if not firebase_admin._apps:
-        sa_json = os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON")
-        if sa_json:
-            cred = credentials.Certificate(json.loads(sa_json))
-            firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            print("Firebase Admin Initialized (env)")
-        elif os.path.exists("serviceAccountKey.json"):
-            cred = credentials.Certificate("serviceAccountKey.json")
-            firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            print("Firebase Admin Initialized (file)")
-        else:
-            print("WARNING: Firebase credentials not found. Firestore updates will fail.")
-    else:
-        db = firestore.client()
-except Exception as e:
-    print(f"Error initializing Firebase: {e}")
-
-def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        # Create table with new schema
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS licenses (
-                email TEXT PRIMARY KEY,
-                is_premium BOOLEAN DEFAULT 0,
-                status TEXT DEFAULT 'free',
-                payment_id TEXT,
-                subscription_id TEXT,
-                method TEXT,
-                date_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expiration_date TIMESTAMP,
-                trial_end_date TIMESTAMP
-            )
-        """)
-        
-        # Migration: Add columns if they don't exist
-        columns = [
-            ("expiration_date", "TIMESTAMP"),
-            ("method", "TEXT"),
-            ("status", "TEXT DEFAULT 'free'"),
-            ("trial_end_date", "TIMESTAMP"),
-            ("subscription_id", "TEXT")
-        ]
-        for col_name, col_type in columns:
-            try:
-                cursor.execute(f"ALTER TABLE licenses ADD COLUMN {col_name} {col_type}")
-            except sqlite3.OperationalError:
-                pass
-            
-        conn.commit()
+replicator = None
+license_watch = None
 
-# Initialize DB on start
-init_db()
+# Request handlers never commit on their own: mutations are queued to one writer thread that group-commits them
+sqlite_writer = SQLiteWriter(DB_NAME)
+
+# Status/method counters kept by SQLite triggers; this only expires lapsed rows and recounts
+stats = LicenseStats(DB_NAME, sqlite_writer)
+
+# Raw inbound webhooks are kept for recovery and load replays (replay_webhooks.py)
+webhook_journal = WebhookJournal() if os.getenv("WEBHOOK_JOURNAL_DIR", "webhook_journal") else None
+
+# Support mails are stored locally and delivered by a background sender
+support_mail = support_outbox.SupportOutbox(DB_NAME, send=resend.Emails.send)
+
+# Login syncs only write usuarios when the profile changed or lastLogin is due
+login_sync = user_sync.UserSync(sqlite_writer)
+
+# Concurrency limits changed at runtime (/admin/bulkheads) reach every worker through SQLite
+bulkhead_limits = bulkheads.LimitReloader(DB_NAME)
+
+# A cold instance (empty licenses.db) is filled from Firestore in bulk before it takes traffic
+snapshot = SnapshotRebuild(DB_NAME, sqlite_writer)
+
+# Optional Redis-protocol tier shared by every instance (SHARED_CACHE_URL); a miss whenever it's unreachable
+shared = shared_cache.cache
 
 # PayPal Configuration
 PAYPAL_MODE = os.getenv("PAYPAL_MODE", "sandbox") # 'sandbox' or 'live'
@@ -95,19 +107,33 @@ else:
     PAYPAL_SECRET = os.getenv("PAYPAL_SECRET_SANDBOX")
     PAYPAL_API_BASE = "https://api-m.sandbox.paypal.com"
 
-print(f"PayPal Mode: {PAYPAL_MODE}")
+log.info("PayPal Mode: %s", PAYPAL_MODE)
+
+# Shared tokens are dropped this long before PayPal expires them
+PAYPAL_TOKEN_MARGIN_SECONDS = 300
 
 def get_paypal_access_token():
+    token_key = shared_cache.paypal_token_key(PAYPAL_MODE)
+    cached = shared.get(token_key)
+    if cached is not MISS and cached:
+        return cached
     try:
         auth = (PAYPAL_CLIENT_ID, PAYPAL_SECRET)
         data = {"grant_type": "client_credentials"}
-        response = requests.post(f"{PAYPAL_API_BASE}/v1/oauth2/token", auth=auth, data=data)
+        response = upstream.paypal.post(f"{PAYPAL_API_BASE}/v1/oauth2/token", auth=auth, data=data)
         if response.status_code == 200:
-            return response.json().get("access_token")
-        print(f"PayPal Auth Error: {response.text}")
+            body = response.json()
+            token = body.get("access_token")
+            ttl = int(body.get("expires_in") or 0) - PAYPAL_TOKEN_MARGIN_SECONDS
+            if token and ttl > 0:
+                shared.set(token_key, token, ttl)
+            return token
+        log.error("PayPal Auth Error: %s (%s)", response.status_code, response.text[:500])
         return None
+    except FAIL_FAST:
+        raise
     except Exception as e:
-        print(f"PayPal Auth Exception: {e}")
+        log.error("PayPal Auth Exception: %s", e)
         return None
 
 # --- SUBSCRIPTION HELPERS ---
@@ -139,18 +165,18 @@ def get_or_create_paypal_plan(product_id, plan_name, interval_unit, amount):
 
     # Check if plan already exists in PayPal (Simple List Check)
     try:
-        list_resp = requests.get(f"{PAYPAL_API_BASE}/v1/billing/plans?page_size=20&status=ACTIVE", headers={"Authorization": f"Bearer {token}"})
+        list_resp = upstream.paypal.get(f"{PAYPAL_API_BASE}/v1/billing/plans?page_size=20&status=ACTIVE", headers={"Authorization": f"Bearer {token}"})
         if list_resp.status_code == 200:
             existing_plans = list_resp.json().get("plans", [])
             for p in existing_plans:
                 if p.get("name") == plan_name and p.get("status") == "ACTIVE":
-                    print(f"Found existing PayPal Plan: {plan_name} ({p['id']})")
+                    log.info("Found existing PayPal Plan: %s (%s)", plan_name, p['id'])
                     plans[plan_key] = p['id']
                     with open(plans_file, 'w') as f:
                         json.dump(plans, f)
                     return p['id']
     except Exception as e:
-        print(f"Error checking existing plans: {e}")
+        log.error("Error checking existing plans: %s", e)
     
     data = {
         "product_id": product_id,
@@ -173,16 +199,16 @@ def get_or_create_paypal_plan(product_id, plan_name, interval_unit, amount):
         }
     }
     
-    resp = requests.post(f"{PAYPAL_API_BASE}/v1/billing/plans", headers=headers, json=data)
+    resp = upstream.paypal.post(f"{PAYPAL_API_BASE}/v1/billing/plans", headers=headers, json=data)
     if resp.status_code == 201:
         plan_id = resp.json()["id"]
         plans[plan_key] = plan_id
         with open(plans_file, 'w') as f:
             json.dump(plans, f)
-        print(f"Created PayPal Plan: {plan_name} ({plan_id})")
+        log.info("Created PayPal Plan: %s (%s)", plan_name, plan_id)
         return plan_id
     else:
-        print(f"Error creating PayPal plan: {resp.text}")
+        log.error("Error creating PayPal plan: %s", resp.text[:500])
         return None
 
 def setup_paypal_products_and_plans():
@@ -219,13 +245,13 @@ def setup_paypal_products_and_plans():
             "type": "SERVICE",
             "category": "SOFTWARE"
         }
-        resp = requests.post(f"{PAYPAL_API_BASE}/v1/catalogs/products", headers=headers, json=data)
+        resp = upstream.paypal.post(f"{PAYPAL_API_BASE}/v1/catalogs/products", headers=headers, json=data)
         if resp.status_code == 201:
             store[product_key] = resp.json()["id"]
             with open(plans_file, 'w') as f:
                 json.dump(store, f)
         else:
-            print(f"Error creating product: {resp.text}")
+            log.error("Error creating product: %s", resp.text[:500])
             return {}
             
     product_id = store[product_key]
@@ -261,7 +287,7 @@ def setup_paypal_products_and_plans():
                 "payment_failure_threshold": 3
             }
         }
-        resp = requests.post(f"{PAYPAL_API_BASE}/v1/billing/plans", headers=headers, json=plan_data)
+        resp = upstream.paypal.post(f"{PAYPAL_API_BASE}/v1/billing/plans", headers=headers, json=plan_data)
         if resp.status_code == 201:
             store[yearly_plan_key] = resp.json()["id"]
             with open(plans_file, 'w') as f:
@@ -291,7 +317,7 @@ def setup_paypal_products_and_plans():
                 "payment_failure_threshold": 3
             }
         }
-         resp = requests.post(f"{PAYPAL_API_BASE}/v1/billing/plans", headers=headers, json=plan_data)
+         resp = upstream.paypal.post(f"{PAYPAL_API_BASE}/v1/billing/plans", headers=headers, json=plan_data)
          if resp.status_code == 201:
             store[monthly_plan_key] = resp.json()["id"]
             with open(plans_file, 'w') as f:
@@ -302,12 +328,102 @@ def setup_paypal_products_and_plans():
         "yearly": store.get(yearly_plan_key)
     }
 
-# Global Plan Cache
+# Global Plan Cache, filled by the warm-up checks below
 PAYPAL_PLANS = {}
-try:
-    PAYPAL_PLANS = setup_paypal_products_and_plans()
-except Exception as e:
-    print(f"Error setting up PayPal plans: {e}")
+
+def load_paypal_plans():
+    global PAYPAL_PLANS
+    plans = setup_paypal_products_and_plans()
+    if not plans or not any(plans.values()):
+        raise RuntimeError("PayPal plans unavailable")
+    PAYPAL_PLANS = plans
+
+def warm_sqlite():
+    # Opens the writer's connection and a reader, and pages in the license index
+    with upstream.timed("sqlite"):
+        sqlite_writer.execute(lambda cursor: cursor.execute("SELECT 1").fetchone())
+        with sqlite3.connect(DB_NAME) as conn:
+            conn.execute("SELECT COUNT(*) FROM licenses").fetchone()
+
+def warm_firestore():
+    # The first call opens the gRPC channel and fetches credentials
+    with upstream.timed("firestore"):
+        db.collection("usuarios").document("_warmup").get()
+
+def warm_paddle_pool():
+    upstream.paddle.head(paddle_base_url(), timeout=5)
+
+def on_replicated(writes):
+    """Drops shared-cache license copies once their Firestore write has landed"""
+    uids, emails = set(), set()
+    for op, collection, doc_id, data in writes:
+        if not any(field in data for field in LICENSE_FIELDS):
+            continue
+        if op == firestore_outbox.OP_SET_WHERE_EMAIL or collection == "licenses_by_email":
+            emails.add(doc_id)
+        elif collection == "usuarios":
+            uids.add(doc_id)
+    shared.invalidate_license(uids, emails, publish=False)
+
+def on_license_invalidated(message):
+    """Another request (on any instance) changed these licenses: forget what this process remembers"""
+    uids = [u for u in message.get("uids") or [] if isinstance(u, str)]
+    emails = [e for e in message.get("emails") or [] if isinstance(e, str)]
+    rate_limit.verdicts.discard_identities(uids, emails)
+    if message.get("origin") != shared_cache.ORIGIN:
+        # Written elsewhere: this SQLite copy is stale, so the next check reads through again
+        sqlite_writer.submit(lambda cursor: identities.unsync(cursor, uids, emails))
+
+def invalidate_license(uid, email):
+    """Called after a write endpoint commits a license change"""
+    shared.invalidate_license([uid], [identities.norm_email(email)])
+
+readiness = Readiness()
+
+def start_runtime():
+    """Creates this process's Firestore client and starts its background threads"""
+    global db, replicator, license_watch
+    db = init_firestore()
+    sqlite_writer.start()
+
+    # Firestore mirroring: write endpoints commit SQLite + an outbox row, this thread replicates them
+    replicator = firestore_outbox.FirestoreReplicator(DB_NAME, db, on_applied=on_replicated) if db else None
+    if replicator:
+        replicator.start()
+
+    # Snapshot listeners (one worker per instance) keep license-bearing rows current in SQLite
+    license_watch = LicenseWatcher(db, DB_NAME, sqlite_writer) if db and os.getenv("LICENSE_WATCH_ENABLED", "1") == "1" else None
+    if license_watch:
+        license_watch.start()
+
+    stats.start()
+    support_mail.start()
+    login_sync.start()
+    bulkhead_limits.start()
+    shared.listen(on_license_invalidated)
+
+    # Traffic is routed here only once /readyz passes: SQLite and Firestore must answer,
+    # PayPal plans and the Paddle pool are attempted first and retried in the background
+    readiness.add("sqlite", warm_sqlite)
+    if db:
+        readiness.add("firestore", warm_firestore)
+        readiness.add("sqlite_snapshot", lambda: snapshot.ensure(db))
+    readiness.add("paypal_plans", load_paypal_plans, required=False)
+    readiness.add("paddle_pool", warm_paddle_pool, required=False)
+    if license_watch:
+        readiness.add("license_cache", license_watch.wait_fresh, required=False)
+    readiness.start()
+
+if os.getenv("APP_DEFER_RUNTIME") != "1":
+    start_runtime()
+
+
+def cached_paypal_verification(kind, ref_id):
+    """(status, billing_info) of an order/subscription PayPal already confirmed, or None"""
+    with read_db() as conn:
+        hit = paypal_verifications.lookup(conn, kind, ref_id)
+    metrics.inc("paypal_verify_cache", kind=kind, result="hit" if hit else "miss")
+    return hit
 
 
 def verify_paypal_order(order_id):
@@ -321,7 +437,7 @@ def verify_paypal_order(order_id):
     }
     
     try:
-        response = requests.get(f"{PAYPAL_API_BASE}/v2/checkout/orders/{order_id}", headers=headers)
+        response = upstream.paypal.get_idempotent(f"{PAYPAL_API_BASE}/v2/checkout/orders/{order_id}", headers=headers)
         if response.status_code == 200:
             order_data = response.json()
             status = order_data.get("status")
@@ -329,14 +445,162 @@ def verify_paypal_order(order_id):
                 return True, order_data
             return False, f"Order status is {status}"
         return False, f"PayPal API Error: {response.text}"
+    except FAIL_FAST:
+        raise
     except Exception as e:
         return False, str(e)
 
 
+# Per-call caps; inside a request each is further capped by the request's remaining deadline
+FIRESTORE_TIMEOUT_SECONDS = float(os.getenv("FIRESTORE_TIMEOUT_SECONDS", "10"))
+SQLITE_READ_TIMEOUT_SECONDS = 5.0
+# Without a fresh license watcher nothing tells us about changes made elsewhere: local answers expire
+LOCAL_LICENSE_MAX_AGE_SECONDS = float(os.getenv("LOCAL_LICENSE_MAX_AGE_SECONDS", "300"))
+
+@app.before_request
+def start_deadline():
+    g.deadline_token = deadlines.start(request.endpoint or "unknown")
+
+@app.teardown_request
+def clear_deadline(exc):
+    token = g.pop("deadline_token", None)
+    if token is not None:
+        deadlines.clear(token)
+
+@app.before_request
+def start_request_log():
+    g.log_token = structured_log.begin(request.endpoint or "unknown", request.headers.get(structured_log.REQUEST_ID_HEADER))
+
+@app.after_request
+def log_request(response):
+    """One access line per request with its status, duration and upstream timings"""
+    ctx = structured_log.current()
+    if ctx is not None:
+        response.headers[structured_log.REQUEST_ID_HEADER] = ctx.request_id
+        log.log(
+            logging.WARNING if response.status_code >= 500 else logging.INFO,
+            "%s %s %s", request.method, request.path, response.status_code,
+            extra={"fields": {"status": response.status_code, "duration_ms": ctx.elapsed_ms()}},
+        )
+    return response
+
+@app.teardown_request
+def end_request_log(exc):
+    token = g.pop("log_token", None)
+    if token is not None:
+        structured_log.end(token)
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    return jsonify({"error": "Request deadline exceeded", "upstream": e.upstream}), 504
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    return jsonify({"error": "Service busy, retry shortly", "upstream": e.upstream}), 503, {"Retry-After": "1"}
+
+def read_db():
+    """SQLite connection for request-path reads, bounded by the request deadline"""
+    return sqlite3.connect(DB_NAME, timeout=deadlines.timeout("sqlite", SQLITE_READ_TIMEOUT_SECONDS))
+
+def firestore_get(ref):
+    """ref.get() for a document or query, through the Firestore bulkhead and bounded by the request deadline"""
+    with bulkheads.slot("firestore"), upstream.timed("firestore"):
+        try:
+            return ref.get(timeout=deadlines.timeout("firestore", FIRESTORE_TIMEOUT_SECONDS))
+        except FAIL_FAST:
+            raise
+        except Exception as e:
+            if deadlines.expired():
+                raise deadlines.exceeded("firestore") from e
+            raise
+
 @app.route("/")
 def home():
     return "Equalizer – Web Audio API is running (v1.2.0 - Clean)"
 
+def metrics_authorized():
+    token = os.getenv("METRICS_TOKEN")
+    return not token or request.headers.get("Authorization") == f"Bearer {token}"
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """Process is up and serving requests"""
+    return jsonify({"status": "ok", "uptime_seconds": round(time.time() - readiness.started_at, 1)})
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """Dependencies initialized and connections warm"""
+    status = readiness.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+@app.route("/diagnostics", methods=["GET"])
+def diagnostics():
+    """Warm-up state and recent latency to each upstream; ?probe=1 re-runs the checks first"""
+    if not metrics_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    status = readiness.probe() if request.args.get("probe") == "1" else readiness.status()
+    return jsonify({**status, "upstreams": upstream.diagnostics()})
+
+@app.route("/metrics", methods=["GET"])
+def metrics_snapshot():
+    """Returns in-process counters, gauges and latency summaries"""
+    if not metrics_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(metrics.snapshot())
+
+@app.route("/admin/stats", methods=["GET"])
+def admin_stats():
+    """License counts by status and method, read from the maintained counters"""
+    if not metrics_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(stats.snapshot())
+
+@app.route("/admin/bulkheads", methods=["GET", "POST"])
+def admin_bulkheads():
+    """Per-upstream concurrency limits; POST {"firestore": {"limit": 6, "queue": 4}} changes them in every worker"""
+    if not metrics_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    if request.method == "POST":
+        changes = request.get_json(silent=True) or {}
+        unknown = [name for name in changes if name not in bulkheads.bulkheads]
+        if unknown:
+            return jsonify({"error": f"Unknown upstream: {', '.join(unknown)}"}), 400
+        updates = []
+        for name, values in changes.items():
+            current = bulkheads.bulkheads[name]
+            try:
+                limit = max(1, int(values.get("limit", current.limit)))
+                queue = max(0, int(values.get("queue", current.queue)))
+            except (AttributeError, TypeError, ValueError):
+                return jsonify({"error": f"Invalid limits for {name}"}), 400
+            updates.append((name, limit, queue))
+        sqlite_writer.execute(lambda cursor: [bulkheads.save(cursor, *u) for u in updates])
+        for name, limit, queue in updates:
+            bulkheads.bulkheads[name].configure(limit, queue)
+    return jsonify(bulkheads.status())
+
+@app.route("/admin/snapshot", methods=["GET", "POST"])
+def admin_snapshot():
+    """Progress of the Firestore-to-SQLite rebuild; POST {"restart": true} starts one in the background"""
+    if not metrics_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    if request.method == "POST":
+        if not db:
+            return jsonify({"error": "Firestore unavailable"}), 503
+        if snapshot.progress()["running"]:
+            return jsonify({"error": "A rebuild is already running"}), 409
+        restart = bool((request.get_json(silent=True) or {}).get("restart"))
+
+        def rebuild():
+            try:
+                snapshot.run(db, restart=restart)
+            except Exception as e:
+                log.error("Snapshot rebuild failed: %s", e)
+
+        threading.Thread(target=rebuild, name="snapshot-rebuild", daemon=True).start()
+        return jsonify({"started": True, "restart": restart}), 202
+    return jsonify(snapshot.progress())
+
 @app.route("/get-plans", methods=["GET"])
 def get_plans():
     """Returns the available subscription plans and correct client ID"""
@@ -365,49 +629,58 @@ def register_paypal():
             return jsonify({"error": "Missing email or uid"}), 400
 
         now = datetime.now(timezone.utc)
-        expiration_date = now + (timedelta(days=366) if plan_type == "yearly" else timedelta(days=31))
+        expiration_date = plan_expiration(plan_type, now)
         status = "active"
         method = "PayPal"
         payment_id = order_id
 
-        if subscription_id:
-            token = get_paypal_access_token()
-            if not token:
-                return jsonify({"error": "PayPal Auth Failed"}), 500
-
-            headers = {"Authorization": f"Bearer {token}"}
-            resp = requests.get(f"{PAYPAL_API_BASE}/v1/billing/subscriptions/{subscription_id}", headers=headers)
-            if resp.status_code != 200:
-                return jsonify({"error": "Failed to verify subscription"}), resp.status_code
-
-            sub_data = resp.json()
-            sub_status = sub_data.get("status")
-            if sub_status not in ["ACTIVE", "APPROVED"]:
-                return jsonify({"error": f"Subscription status is {sub_status}"}), 400
+        # Set when PayPal was asked, so the confirmation is stored with the license
+        verification = None
 
-            billing_info = sub_data.get("billing_info", {}) or {}
+        if subscription_id:
+            cached = cached_paypal_verification("subscription", subscription_id)
+            if cached:
+                sub_status, billing_info = cached
+            else:
+                token = get_paypal_access_token()
+                if not token:
+                    return jsonify({"error": "PayPal Auth Failed"}), 500
+
+                headers = {"Authorization": f"Bearer {token}"}
+                resp = upstream.paypal.get_idempotent(f"{PAYPAL_API_BASE}/v1/billing/subscriptions/{subscription_id}", headers=headers)
+                if resp.status_code != 200:
+                    return jsonify({"error": "Failed to verify subscription"}), resp.status_code
+
+                sub_data = resp.json()
+                sub_status = sub_data.get("status")
+                if sub_status not in ["ACTIVE", "APPROVED"]:
+                    return jsonify({"error": f"Subscription status is {sub_status}"}), 400
+
+                billing_info = sub_data.get("billing_info", {}) or {}
+                verification = ("subscription", subscription_id, sub_status, billing_info)
             next_billing_time = billing_info.get("next_billing_time")
             if next_billing_time:
                 try:
                     expiration_date = datetime.strptime(next_billing_time, "%Y-%m-%dT%H:%M:%SZ")
                 except Exception:
-                    expiration_date = now + (timedelta(days=366) if plan_type == "yearly" else timedelta(days=31))
+                    expiration_date = plan_expiration(plan_type, now)
 
             payment_id = subscription_id
             method = "PayPal_Subscription"
 
         elif order_id:
-            verified, _ = verify_paypal_order(order_id)
-            if not verified:
-                return jsonify({"error": "PayPal order verification failed"}), 400
+            if not cached_paypal_verification("order", order_id):
+                verified, order_data = verify_paypal_order(order_id)
+                if not verified:
+                    return jsonify({"error": "PayPal order verification failed"}), 400
+                verification = ("order", order_id, order_data.get("status"), None)
 
             payment_id = f"PAYPAL_{order_id}"
 
         else:
             return jsonify({"error": "Missing orderID or subscriptionID"}), 400
 
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
+        def write(cursor):
             cursor.execute(
                 """
                 INSERT INTO licenses (email, is_premium, status, payment_id, expiration_date, method)
@@ -427,89 +700,58 @@ def register_paypal():
                     method,
                 ),
             )
-            conn.commit()
+            identities.link(cursor, uid, email, synced=True)
+            if verification:
+                paypal_verifications.record(cursor, *verification)
+            if db:
+                license_data = {
+                    "email": email.strip().lower(),
+                    "isPremium": True,
+                    "status": status,
+                    "method": method,
+                    "paymentId": payment_id,
+                    "planType": plan_type,
+                    "expirationDate": expiration_date,
+                }
+                firestore_outbox.enqueue(cursor, "usuarios", uid, {**license_data, "lastPayment": firestore.SERVER_TIMESTAMP})
+                payments_by_id.enqueue(cursor, [payment_id], uid, license_data)
 
-        if db:
-            try:
-                db.collection("usuarios").document(uid).set(
-                    {
-                        "email": email.strip().lower(),
-                        "isPremium": True,
-                        "status": status,
-                        "method": method,
-                        "paymentId": payment_id,
-                        "planType": plan_type,
-                        "expirationDate": expiration_date,
-                        "lastPayment": firestore.SERVER_TIMESTAMP,
-                    },
-                    merge=True,
-                )
-            except Exception as e:
-                print(f"Firebase Update Error (PayPal): {e}")
+        sqlite_writer.execute(write)
+        invalidate_license(uid, email)
 
         return jsonify({"status": "approved", "expiration": expiration_date.isoformat().replace('+00:00', 'Z')})
+    except FAIL_FAST:
+        raise
     except Exception as e:
-        print(f"Register PayPal Error: {e}")
+        log.exception("Register PayPal Error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/paddle-webhook", methods=["POST"])
 @app.route("/paddle-webhook/", methods=["POST"])
 def paddle_webhook():
+    if webhook_journal:
+        try:
+            webhook_journal.append(request.path, request.headers, request.get_data())
+        except Exception as e:
+            log.error("Webhook journal error: %s", e)
     try:
-        payload = request.json or {}
-        event_type = payload.get("event_type") or payload.get("eventType")
-        data = payload.get("data") or {}
+        event_type, data, email, uid, price_id = webhook_fields(request.json or {})
 
         if not event_type:
             return jsonify({"status": "ignored", "reason": "no_event_type"}), 200
 
-        custom_data = data.get("custom_data") or data.get("customData") or {}
-        if isinstance(custom_data, str):
-            try:
-                custom_data = json.loads(custom_data)
-            except Exception:
-                custom_data = {}
-
-        email = (custom_data.get("email") or (data.get("customer") or {}).get("email") or data.get("customer_email"))
-        uid = (custom_data.get("uid") or custom_data.get("user_id") or custom_data.get("userId"))
+        if event_type.startswith("customer."):
+            sqlite_writer.execute(lambda cursor: paddle_index.record_event(cursor, event_type, data))
+            return jsonify({"status": "indexed", "event": event_type}), 200
 
         if not email:
+            # Still worth indexing: the customer's email arrives with customer.* events or the backfill
+            sqlite_writer.execute(lambda cursor: paddle_index.record_event(cursor, event_type, data))
             return jsonify({"status": "ignored", "reason": "no_email"}), 200
 
         email_norm = email.strip().lower()
 
-        def parse_iso_dt(value):
-            if not value:
-                return None
-            if isinstance(value, datetime):
-                return value
-            if hasattr(value, "to_datetime"):
-                try:
-                    return value.to_datetime()
-                except Exception:
-                    return None
-            s = str(value)
-            s = s.replace("Z", "")
-            if "." in s:
-                s = s.split(".", 1)[0]
-            try:
-                return datetime.strptime(s, "%Y-%m-%dT%H:%M:%S")
-            except Exception:
-                return None
-
-        items = data.get("items") or []
-        price_id = None
-        for item in items:
-            pinfo = item.get("price") or {}
-            price_id = item.get("price_id") or pinfo.get("id")
-            if price_id:
-                break
-
-        plan_type = "monthly"
-        if price_id == "pri_01kk2mxf0828y5x7p8bky7ch47":
-            plan_type = "yearly"
-        elif price_id == "pri_01kk2mvgj2pmjfh0pkjatsv8bf":
-            plan_type = "monthly"
+        plan_type = paddle_plan_type(price_id)
 
         now = datetime.now(timezone.utc)
 
@@ -536,11 +778,11 @@ def paddle_webhook():
 
             billing_period = data.get("current_billing_period") or {}
             expires_at = billing_period.get("ends_at") or billing_period.get("end_at") or data.get("next_billed_at")
-            expiration_date = parse_iso_dt(expires_at)
+            expiration_date = as_utc(expires_at)
 
             trial_ends_at = data.get("trial_ends_at") or data.get("trial_end") or billing_period.get("ends_at")
             if paddle_status == "trialing" or event_type == "subscription.trialing":
-                trial_end_date = parse_iso_dt(trial_ends_at) or (now + timedelta(days=3))
+                trial_end_date = as_utc(trial_ends_at) or trial_end_from(now)
                 used_trial = True
 
             if trial_end_date and now < trial_end_date:
@@ -565,12 +807,30 @@ def paddle_webhook():
             used_trial = True
 
         else:
+            sqlite_writer.execute(lambda cursor: paddle_index.record_event(cursor, event_type, data, email_norm))
             return jsonify({"status": "ignored", "event": event_type}), 200
 
         payment_id = data.get("id") or data.get("transaction_id")
 
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
+        update_data = {
+            "email": email_norm,
+            "isPremium": is_premium,
+            "status": status,
+            "method": "Paddle",
+            "paymentId": payment_id,
+            "subscriptionId": subscription_id,
+            "planType": plan_type,
+            "lastPayment": firestore.SERVER_TIMESTAMP,
+        }
+        if expiration_date:
+            update_data["expirationDate"] = expiration_date
+        if trial_end_date:
+            update_data["trialEndDate"] = trial_end_date
+        if used_trial:
+            update_data["usedTrial"] = True
+
+        def write(cursor):
+            paddle_index.record_event(cursor, event_type, data, email_norm)
             cursor.execute(
                 """
                 INSERT INTO licenses (email, is_premium, status, payment_id, subscription_id, expiration_date, trial_end_date, method)
@@ -595,50 +855,29 @@ def paddle_webhook():
                     "Paddle",
                 ),
             )
-            conn.commit()
-
-        if db:
-            update_data = {
-                "email": email_norm,
-                "isPremium": is_premium,
-                "status": status,
-                "method": "Paddle",
-                "paymentId": payment_id,
-                "subscriptionId": subscription_id,
-                "planType": plan_type,
-                "lastPayment": firestore.SERVER_TIMESTAMP,
-            }
-            if expiration_date:
-                update_data["expirationDate"] = expiration_date
-            if trial_end_date:
-                update_data["trialEndDate"] = trial_end_date
-            if used_trial:
-                update_data["usedTrial"] = True
-
-            if uid:
-                try:
-                    db.collection("usuarios").document(uid).set(update_data, merge=True)
-                except Exception as e:
-                    print(f"Firebase Paddle update error (uid): {e}")
-
-            try:
-                docs = db.collection("usuarios").where("email", "==", email_norm).limit(10).get()
-                for d in docs:
-                    db.collection("usuarios").document(d.id).set(update_data, merge=True)
-            except Exception as e:
-                print(f"Firebase Paddle update error (email): {e}")
-
-            try:
-                db.collection("licenses_by_email").document(email_norm).set(
-                    {**update_data, "uid": uid or None}, merge=True
-                )
-            except Exception as e:
-                print(f"Firebase Paddle update error (licenses_by_email): {e}")
+            identities.link(cursor, uid, email_norm, synced=True)
+            # Firestore copies are replicated from the outbox after this commit
+            if db:
+                if uid:
+                    firestore_outbox.enqueue(cursor, "usuarios", uid, update_data)
+                firestore_outbox.enqueue(cursor, "usuarios", email_norm, update_data, op=firestore_outbox.OP_SET_WHERE_EMAIL)
+                firestore_outbox.enqueue(cursor, "licenses_by_email", email_norm, {**update_data, "uid": uid or None})
+                payments_by_id.enqueue(cursor, [payment_id, subscription_id], uid, update_data)
+
+        sqlite_writer.execute(write)
+        invalidate_license(uid, email_norm)
+        # Lets cancel-subscription on any instance find the subscription without this one's index
+        if is_premium and subscription_id:
+            shared.set(shared_cache.paddle_subs_key(email_norm), subscription_id, shared_cache.PADDLE_TTL_SECONDS)
+        else:
+            shared.delete([shared_cache.paddle_subs_key(email_norm)])
 
         return jsonify({"status": "ok"}), 200
 
+    except FAIL_FAST:
+        raise
     except Exception as e:
-        print(f"Paddle Webhook Error: {e}")
+        log.exception("Paddle Webhook Error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/cancel-subscription", methods=["POST"])
@@ -655,15 +894,12 @@ def cancel_subscription():
         if not paddle_api_key:
             return jsonify({"error": "PADDLE_API_KEY not configured"}), 503
 
-        paddle_env = (os.getenv("PADDLE_ENV") or "production").lower()
-        base_url = "https://sandbox-api.paddle.com" if paddle_env == "sandbox" else "https://api.paddle.com"
-
         subscription_id = None
         email_norm = email.strip().lower() if isinstance(email, str) else None
 
         if db and uid:
             try:
-                doc = db.collection("usuarios").document(uid).get()
+                doc = firestore_get(db.collection("usuarios").document(uid))
                 if doc.exists:
                     u = doc.to_dict() or {}
                     email_norm = (email_norm or u.get("email") or "").strip().lower() or email_norm
@@ -672,12 +908,14 @@ def cancel_subscription():
                         pid = u.get("paymentId")
                         if isinstance(pid, str) and pid.startswith("sub_"):
                             subscription_id = pid
+            except FAIL_FAST:
+                raise
             except Exception as e:
-                print(f"Cancel lookup (uid) error: {e}")
+                log.warning("Cancel lookup (uid) error: %s", e)
 
         if db and not subscription_id and email_norm:
             try:
-                lic_doc = db.collection("licenses_by_email").document(email_norm).get()
+                lic_doc = firestore_get(db.collection("licenses_by_email").document(email_norm))
                 if lic_doc.exists:
                     lic = lic_doc.to_dict() or {}
                     subscription_id = lic.get("subscriptionId")
@@ -685,12 +923,14 @@ def cancel_subscription():
                         pid = lic.get("paymentId")
                         if isinstance(pid, str) and pid.startswith("sub_"):
                             subscription_id = pid
+            except FAIL_FAST:
+                raise
             except Exception as e:
-                print(f"Cancel lookup (licenses_by_email) error: {e}")
+                log.warning("Cancel lookup (licenses_by_email) error: %s", e)
 
         if not subscription_id and email_norm:
             try:
-                with sqlite3.connect(DB_NAME) as conn:
+                with read_db() as conn:
                     cursor = conn.cursor()
                     cursor.execute("SELECT subscription_id, payment_id FROM licenses WHERE email = ?", (email_norm,))
                     row = cursor.fetchone()
@@ -700,58 +940,36 @@ def cancel_subscription():
                             pid = row[1]
                             if isinstance(pid, str) and "sub_" in pid:
                                 subscription_id = pid.replace("PADDLE_", "")
+            except FAIL_FAST:
+                raise
             except Exception as e:
-                print(f"Cancel lookup (sqlite) error: {e}")
+                log.warning("Cancel lookup (sqlite) error: %s", e)
 
         if not subscription_id and email_norm:
+            # Local Paddle index (webhooks + paddle_index.py backfill) instead of searching Paddle on the request path
             try:
-                headers = {
-                    "Authorization": f"Bearer {paddle_api_key}",
-                    "Accept": "application/json",
-                    "Paddle-Version": "1",
-                }
-
-                cust_resp = requests.get(
-                    f"{base_url}/customers",
-                    headers=headers,
-                    params={"email": email_norm, "per_page": 10},
-                    timeout=20,
-                )
-                if cust_resp.status_code == 200:
-                    cust_data = cust_resp.json() or {}
-                    customers = cust_data.get("data") or []
-                    customer_id = customers[0].get("id") if len(customers) > 0 else None
-                    if customer_id and str(customer_id).startswith("ctm_"):
-                        subs_resp = requests.get(
-                            f"{base_url}/subscriptions",
-                            headers=headers,
-                            params={"customer_id": customer_id, "status": "trialing,active", "per_page": 20},
-                            timeout=20,
-                        )
-                        if subs_resp.status_code == 200:
-                            subs_data = subs_resp.json() or {}
-                            subs = subs_data.get("data") or []
-                            for s in subs:
-                                sid = s.get("id")
-                                sstatus = s.get("status")
-                                if sid and str(sid).startswith("sub_") and sstatus in ["trialing", "active"]:
-                                    subscription_id = sid
-                                    break
+                with read_db() as conn:
+                    subs = paddle_index.active_subscriptions(conn, email_norm)
+                if subs:
+                    subscription_id = subs[0][0]
+                metrics.inc("cancel_index_lookups", result="hit" if subs else "miss")
+            except FAIL_FAST:
+                raise
             except Exception as e:
-                print(f"Cancel lookup (paddle api) error: {e}")
+                log.warning("Cancel lookup (paddle index) error: %s", e)
+
+        if not subscription_id and email_norm:
+            # The webhook may have reached another instance, whose index this one doesn't share
+            cached = shared.get(shared_cache.paddle_subs_key(email_norm))
+            if cached is not MISS and cached:
+                subscription_id = cached
 
         if not subscription_id or not str(subscription_id).startswith("sub_"):
             return jsonify({"error": "Subscription ID not found"}), 404
 
-        headers = {
-            "Authorization": f"Bearer {paddle_api_key}",
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Paddle-Version": "1",
-        }
-        resp = requests.post(
-            f"{base_url}/subscriptions/{subscription_id}/cancel",
-            headers=headers,
+        resp = upstream.paddle.post(
+            f"{paddle_base_url()}/subscriptions/{subscription_id}/cancel",
+            headers={**paddle_headers(paddle_api_key), "Content-Type": "application/json"},
             json={"effective_from": "immediately"},
             timeout=20,
         )
@@ -771,9 +989,9 @@ def cancel_subscription():
 
             # Treat "subscription_update_when_canceled" as success for local DB sync:
             if code == "subscription_update_when_canceled":
-                print(f"Paddle: Subscription {subscription_id} already canceled. Proceeding to sync local DBs.")
+                log.info("Paddle: Subscription %s already canceled. Proceeding to sync local DBs.", subscription_id)
             else:
-                print(f"Paddle Error: {code} - {details}")
+                log.warning("Paddle cancel failed", extra={"fields": {"code": code, "subscription_id": subscription_id, "status_code": resp.status_code, "paddle_request_id": request_id}})
                 return jsonify({
                     "error": "Paddle cancel failed",
                     "code": code,
@@ -784,64 +1002,117 @@ def cancel_subscription():
                 }), 400
 
         now = datetime.now(timezone.utc)
-        print(f"Syncing cancellation for {email_norm} (UID: {uid}) to Firestore and SQLite...")
 
+        update_data = {
+            "isPremium": False,
+            "status": "canceled",
+            "method": "Paddle",
+            "subscriptionId": subscription_id,
+            "usedTrial": True,
+            "canceledAt": now,
+        }
         if email_norm:
-            try:
-                with sqlite3.connect(DB_NAME) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "UPDATE licenses SET is_premium=0, status='canceled', method='Paddle', subscription_id=?, trial_end_date=NULL WHERE email=?",
-                        (subscription_id, email_norm),
-                    )
-                    conn.commit()
-                print(f"SQLite updated for {email_norm}")
-            except Exception as e:
-                print(f"SQLite cancel error: {e}")
+            update_data["email"] = email_norm
 
-        if db:
-            update_data = {
-                "isPremium": False,
-                "status": "canceled",
-                "method": "Paddle",
-                "subscriptionId": subscription_id,
-                "usedTrial": True,
-                "canceledAt": now,
-            }
-            if email_norm:
-                update_data["email"] = email_norm
-
-            # 1. Update by UID (Primary)
-            if uid:
-                try:
-                    db.collection("usuarios").document(uid).set(update_data, merge=True)
-                    print(f"Firestore updated by UID: {uid}")
-                except Exception as e:
-                    print(f"Cancel Firestore (uid) error: {e}")
-
-            # 2. Update all docs with this email
+        # One local transaction: SQLite row plus the Firestore writes the replicator will apply
+        # (usuarios by UID, every usuarios doc with this email, licenses_by_email)
+        def write(cursor):
+            paddle_index.mark_canceled(cursor, subscription_id)
+            identities.link(cursor, uid, email_norm, synced=True)
             if email_norm:
-                try:
-                    docs = db.collection("usuarios").where("email", "==", email_norm).limit(10).get()
-                    for d in docs:
-                        db.collection("usuarios").document(d.id).set(update_data, merge=True)
-                    print(f"Firestore updated {len(docs)} docs by email: {email_norm}")
-                except Exception as e:
-                    print(f"Cancel Firestore (email) error: {e}")
-
-                # 3. Update licenses_by_email collection
-                try:
-                    db.collection("licenses_by_email").document(email_norm).set(update_data, merge=True)
-                    print(f"Firestore updated licenses_by_email: {email_norm}")
-                except Exception as e:
-                    print(f"Cancel Firestore (licenses_by_email) error: {e}")
+                cursor.execute(
+                    "UPDATE licenses SET is_premium=0, status='canceled', method='Paddle', subscription_id=?, trial_end_date=NULL WHERE email=?",
+                    (subscription_id, email_norm),
+                )
+            if db:
+                if uid:
+                    firestore_outbox.enqueue(cursor, "usuarios", uid, update_data)
+                if email_norm:
+                    firestore_outbox.enqueue(cursor, "usuarios", email_norm, update_data, op=firestore_outbox.OP_SET_WHERE_EMAIL)
+                    firestore_outbox.enqueue(cursor, "licenses_by_email", email_norm, update_data)
+                payments_by_id.enqueue(cursor, [subscription_id], uid, update_data)
+
+        sqlite_writer.execute(write)
+        invalidate_license(uid, email_norm)
+        shared.delete([shared_cache.paddle_subs_key(email_norm)] if email_norm else [])
+        log.info("Cancellation stored for %s (UID: %s)", email_norm, uid)
 
         return jsonify({"status": "canceled", "message": "Subscription synced as canceled."}), 200
+    except FAIL_FAST:
+        raise
     except Exception as e:
-        print(f"Cancel Subscription Error: {e}")
+        log.exception("Cancel Subscription Error: %s", e)
         return jsonify({"error": str(e)}), 500
 
+LICENSE_TOKENS_ENABLED = os.getenv("LICENSE_TOKENS_ENABLED", "1") == "1"
+if LICENSE_TOKENS_ENABLED and not license_tokens.keyring.available():
+    log.warning("No license token keys (LICENSE_TOKEN_KEYS or %s): check-license answers without tokens",
+                license_tokens.keyring.path)
+
+def attach_license_token(view):
+    """Adds a signed token to license verdicts so the extension can verify them offline"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        resp = make_response(view(*args, **kwargs))
+        if not LICENSE_TOKENS_ENABLED or resp.status_code != 200 or not resp.is_json or not license_tokens.keyring.available():
+            return resp
+        body = resp.get_json(silent=True)
+        if not isinstance(body, dict) or "error" in body or "premium" not in body:
+            return resp
+        try:
+            email = (request.args.get("email") or "").strip().lower()
+            body["token"] = license_tokens.mint(request.args.get("uid"), email, body)
+            resp.set_data(json.dumps(body))
+        except Exception as e:
+            log.error("License token error: %s", e)
+        return resp
+    return wrapper
+
+@app.route("/license-keys", methods=["GET"])
+def license_keys():
+    """Public keys (JWKS) for verifying license tokens"""
+    resp = jsonify(license_tokens.keyring.jwks())
+    resp.headers["Cache-Control"] = f"public, max-age={license_tokens.JWKS_MAX_AGE_SECONDS}"
+    return resp
+
+def fetch_license_by_email(email_norm):
+    """licenses_by_email doc for check-license, read from Firestore and kept in the shared cache"""
+    try:
+        lic_doc = firestore_get(db.collection('licenses_by_email').document(email_norm))
+        lic = license_fields(lic_doc.to_dict() or {}) if lic_doc.exists else None
+        shared.set(shared_cache.license_key(email_norm), lic, shared_cache.LICENSE_TTL_SECONDS)
+        return lic
+    except FAIL_FAST:
+        raise
+    except Exception as e:
+        log.warning("Email license lookup error: %s", e)
+        return None
+
+def read_license_docs(uid, email_norm):
+    """(usuarios fields, licenses_by_email lookup, source) for check-license.
+
+    Both docs come from the shared cache in one pipelined read when it has
+    them; whichever is missing is read from Firestore and cached.
+    """
+    cached_user, cached_license = shared.get_many([shared_cache.user_key(uid), shared_cache.license_key(email_norm)])
+    if cached_user is MISS:
+        doc = firestore_get(db.collection('usuarios').document(uid))
+        data = license_fields(doc.to_dict() or {}) if doc.exists else None
+        shared.fill_user(uid, email_norm, data)
+        source = "firestore"
+    else:
+        data, source = cached_user, "shared_cache"
+
+    def lookup_license(email):
+        if email == email_norm and cached_license is not MISS:
+            return cached_license
+        return fetch_license_by_email(email)
+
+    return data, lookup_license, source
+
 @app.route("/check-license", methods=["GET"])
+@rate_limited("check_license", remember_verdict=True)
+@attach_license_token
 def check_license():
     email = request.args.get("email")
     uid = request.args.get("uid")
@@ -849,130 +1120,72 @@ def check_license():
     if not email:
         return jsonify({"premium": False, "error": "No email provided"})
         
-    print(f"Checking license for: {email} (v1.2.0 - Clean Logic)")
+    log.info("Checking license for: %s", email)
+    email_norm = email.strip().lower()
 
     try:
-        # 1. Check Firestore FIRST if UID is provided (Direct User Match)
-        if db and uid:
-            user_ref = db.collection('usuarios').document(uid)
-            doc = user_ref.get()
-            if doc.exists:
-                data = doc.to_dict()
-                status = data.get('status', 'free')
-                is_premium_db = data.get('isPremium', False)
-                method = data.get('method', 'Unknown')
-                
-                email_norm = email.strip().lower()
-
-                # Re-validate dates BEFORE early return
-                exp_date = data.get('expirationDate')
-                if exp_date and hasattr(exp_date, 'to_datetime'):
-                    exp_date = exp_date.to_datetime() # Firestore returns aware UTC
-                elif exp_date and not exp_date.tzinfo:
-                    exp_date = exp_date.replace(tzinfo=timezone.utc)
-
-                trial_end = data.get('trialEndDate')
-                if trial_end and hasattr(trial_end, 'to_datetime'):
-                    trial_end = trial_end.to_datetime() # Firestore returns aware UTC
-                elif trial_end and not trial_end.tzinfo:
-                    trial_end = trial_end.replace(tzinfo=timezone.utc)
-
-                subscription_id = data.get('subscriptionId')
-                used_trial = data.get('usedTrial', False) or bool(trial_end)
-                now = datetime.now(timezone.utc)
-
-                if trial_end:
-                    if now > trial_end:
-                        status = 'expired_trial'
-                        is_premium_db = False
-                    else:
-                        status = 'trialing'
-                        is_premium_db = True
-                elif exp_date:
-                    if now > exp_date:
-                        status = 'past_due'
-                        is_premium_db = False
-                    else:
-                        status = 'active'
-                        is_premium_db = True
-                
-                # Check for other premium accounts with same email if not premium yet
-                needs_firestore_sync = False
-                if not is_premium_db:
-                    try:
-                        lic_doc = db.collection('licenses_by_email').document(email_norm).get()
-                        if lic_doc.exists:
-                            lic = lic_doc.to_dict() or {}
-                            if lic.get('isPremium') is True:
-                                user_ref.set({
-                                    'isPremium': True,
-                                    'status': lic.get('status', 'active'),
-                                    'expirationDate': lic.get('expirationDate'),
-                                    'trialEndDate': lic.get('trialEndDate'),
-                                    'method': lic.get('method', 'Paddle'),
-                                    'paymentId': lic.get('paymentId'),
-                                    'subscriptionId': lic.get('subscriptionId'),
-                                    'planType': lic.get('planType'),
-                                    'usedTrial': lic.get('usedTrial', False) or bool(lic.get('trialEndDate')),
-                                    'email': email_norm
-                                }, merge=True)
-                                data = user_ref.get().to_dict()
-                                # Refresh our local variables
-                                is_premium_db = True
-                                status = data.get('status', status)
-                                trial_end = data.get('trialEndDate')
-                                if trial_end and hasattr(trial_end, 'to_datetime'):
-                                    trial_end = trial_end.to_datetime().replace(tzinfo=None)
-                                elif trial_end and trial_end.tzinfo:
-                                    trial_end = trial_end.replace(tzinfo=None)
-                    except Exception as e:
-                        print(f"Email license lookup error: {e}")
-
-                if not is_premium_db:
-                    users_by_email = db.collection('usuarios').where('email', '==', email_norm).where('isPremium', '==', True).limit(1).get()
-                    if len(users_by_email) > 0:
-                        premium_doc = users_by_email[0].to_dict()
-                        user_ref.set({
-                            'isPremium': True,
-                            'status': premium_doc.get('status', 'active'),
-                            'expirationDate': premium_doc.get('expirationDate'),
-                            'trialEndDate': premium_doc.get('trialEndDate'),
-                            'method': premium_doc.get('method', 'Restored'),
-                            'paymentId': premium_doc.get('paymentId'),
-                            'email': email_norm
-                        }, merge=True)
-                        is_premium_db = True
-                        status = premium_doc.get('status', 'active')
+        # 1. Known identity whose license state is held locally: one indexed SQLite lookup
+        pending = False
+        if uid:
+            with read_db() as conn:
+                synced_after = 0.0 if license_watch and license_watch.fresh() else time.time() - LOCAL_LICENSE_MAX_AGE_SECONDS
+                local = identities.local_license(conn, uid, email_norm, synced_after)
+                pending = local is None and bool(db) and firestore_outbox.has_pending(conn, "usuarios", uid)
+            if local is not None:
+                metrics.inc("license_reads", source="local")
+                return local_license_response(local)
+
+        # 2. Check Firestore if UID is provided (Direct User Match),
+        # unless our own writes for this user haven't replicated yet (SQLite is newer then)
+        if db and uid and not pending:
+            data, lookup_license, source = read_license_docs(uid, email_norm)
+            metrics.inc("license_reads", source=source)
+            if data is not None:
+                # A license bought under another account with the same email lives in
+                # licenses_by_email. Copying it onto this user doc is the reconciler's
+                # job (reconcile.py); here we only read it to answer correctly.
+                verdict = resolve_license(data, lookup_license, email_norm)
+                is_premium_db, status = verdict["premium"], verdict["status"]
+                method = verdict["method"]
+                exp_date, trial_end = verdict["expiration"], verdict["trial_end"]
+                subscription_id = verdict["subscription_id"]
+                used_trial = verdict["used_trial"]
+
+                with read_db() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT is_premium, status, expiration_date, trial_end_date FROM licenses WHERE email = ?", (email_norm,))
+                    row = cursor.fetchone()
 
                 # Manual deactivation in SQLite if definitely not premium
                 if is_premium_db is False and status not in ['trialing', 'active']:
-                    with sqlite3.connect(DB_NAME) as conn:
-                        cursor = conn.cursor()
-                        # Only update if current state in SQLite is actually 'premium' to avoid redundant writes
-                        cursor.execute("SELECT is_premium FROM licenses WHERE email = ?", (email,))
-                        row = cursor.fetchone()
-                        if row and row[0]:
-                            cursor.execute("UPDATE licenses SET is_premium=0, status='free', method=NULL, trial_end_date=NULL, expiration_date=NULL WHERE email=?", (email,))
-                            conn.commit()
+                    # Cache maintenance: queued for the writer, the response doesn't wait for it.
+                    # Only update if current state in SQLite is actually 'premium' to avoid redundant writes
+                    deactivate = bool(row and row[0])
+                    def write(c):
+                        if deactivate:
+                            c.execute(
+                                "UPDATE licenses SET is_premium=0, status='free', method=NULL, trial_end_date=NULL, expiration_date=NULL WHERE email=?",
+                                (email_norm,),
+                            )
+                        identities.link(c, uid, email_norm, synced=True)
+                    sqlite_writer.submit(write)
                     return jsonify({"premium": False, "status": status, "source": "firestore_override"})
 
                 # Sync back to SQLite only if changed
-                exp_str = exp_date.isoformat().replace('+00:00', 'Z') if exp_date else None
-                trial_str = trial_end.isoformat().replace('+00:00', 'Z') if trial_end else None
-                
-                with sqlite3.connect(DB_NAME) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT is_premium, status, expiration_date, trial_end_date FROM licenses WHERE email = ?", (email,))
-                    row = cursor.fetchone()
+                exp_str = to_iso_z(exp_date)
+                trial_str = to_iso_z(trial_end)
                     
-                    current_prem = bool(row[0]) if row else None
-                    current_status = row[1] if row else None
-                    current_exp = row[2] if row else None
-                    current_trial = row[3] if row else None
-                    
-                    if not row or current_prem != is_premium_db or current_status != status or current_exp != exp_str or current_trial != trial_str:
-                        print(f"Updating SQLite cache for {email} (Changes detected)")
-                        cursor.execute("""
+                current_prem = bool(row[0]) if row else None
+                current_status = row[1] if row else None
+                current_exp = row[2] if row else None
+                current_trial = row[3] if row else None
+                
+                changed = not row or current_prem != is_premium_db or current_status != status or current_exp != exp_str or current_trial != trial_str
+                if changed:
+                    log.info("Updating SQLite cache for %s (Changes detected)", email)
+                def write(c):
+                    if changed:
+                        c.execute("""
                             INSERT INTO licenses (email, is_premium, status, expiration_date, trial_end_date, method)
                             VALUES (?, ?, ?, ?, ?, ?)
                             ON CONFLICT(email) DO UPDATE SET 
@@ -981,8 +1194,10 @@ def check_license():
                                 expiration_date=excluded.expiration_date,
                                 trial_end_date=excluded.trial_end_date,
                                 method=excluded.method
-                        """, (email, 1 if is_premium_db else 0, status, exp_str, trial_str, method))
-                        conn.commit()
+                        """, (email_norm, 1 if is_premium_db else 0, status, exp_str, trial_str, method))
+                    # Later checks for this uid are answered locally
+                    identities.link(c, uid, email_norm, synced=True)
+                sqlite_writer.submit(write)
                 
                 return jsonify({
                     "premium": is_premium_db,
@@ -995,62 +1210,51 @@ def check_license():
                     "usedTrial": True if used_trial else False
                 })
 
-        # 2. Check SQLite (Local Fast Cache) as fallback
-        with sqlite3.connect(DB_NAME) as conn:
+        # 3. Check SQLite (Local Fast Cache) as fallback
+        with read_db() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT is_premium, status, expiration_date, trial_end_date, method, subscription_id FROM licenses WHERE email = ?", (email,))
+            cursor.execute("SELECT is_premium, status, expiration_date, trial_end_date, method, subscription_id FROM licenses WHERE email = ?", (email_norm,))
             row = cursor.fetchone()
-            
-            if row:
-                is_premium = bool(row[0])
-                status = row[1]
-                expiration_str = row[2]
-                trial_end_str = row[3]
-                method = row[4]
-                subscription_id = row[5]
-                
-                now = datetime.now(timezone.utc)
-                
-                # Re-verify local status for trials
-                if status == 'trialing' and trial_end_str:
-                    try:
-                        # Robust ISO parsing
-                        s = trial_end_str.replace('T', ' ').replace('Z', '').split(".")[0]
-                        trial_end = datetime.strptime(s, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-                        if now > trial_end:
-                            is_premium = False
-                            status = 'expired_trial'
-                    except Exception as e: 
-                        print(f"SQLite trial parse error: {e}")
-                
-                # Re-verify local status for active sub
-                elif status == 'active' and expiration_str:
-                    try:
-                        s = expiration_str.replace('T', ' ').replace('Z', '').split(".")[0]
-                        exp_date = datetime.strptime(s, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-                        if now > exp_date:
-                            is_premium = False
-                            status = 'past_due'
-                    except Exception as e: 
-                        print(f"SQLite exp parse error: {e}")
-
-                return jsonify({
-                    "premium": is_premium,
-                    "status": status,
-                    "source": "sqlite",
-                    "expiration": expiration_str,
-                    "trial_end": trial_end_str,
-                    "method": method,
-                    "subscriptionId": subscription_id,
-                    "usedTrial": True if trial_end_str else False
-                })
-
-        return jsonify({"premium": False, "status": "free"})
-        
+        return local_license_response(row or ())
+
+    except FAIL_FAST:
+        # Out of budget or shed: answer from the local cache instead of failing the check
+        metrics.inc("license_reads", source="degraded")
+        with sqlite3.connect(DB_NAME, timeout=1) as conn:
+            row = conn.execute(
+                "SELECT is_premium, status, expiration_date, trial_end_date, method, subscription_id FROM licenses WHERE email = ?",
+                (email_norm,),
+            ).fetchone()
+        return local_license_response(row or ())
     except Exception as e:
-        print(f"Check License Error: {e}")
+        log.exception("Check License Error: %s", e)
         return jsonify({"premium": False, "error": str(e)})
 
+def local_license_response(row):
+    """check-license answer from a SQLite license row, re-validated against its dates"""
+    if not row:
+        return jsonify({"premium": False, "status": "free"})
+
+    is_premium = bool(row[0])
+    status = row[1]
+    expiration_str = row[2]
+    trial_end_str = row[3]
+    method = row[4]
+    subscription_id = row[5]
+    
+    is_premium, status = revalidate_local(is_premium, status, trial_end_str, expiration_str)
+
+    return jsonify({
+        "premium": is_premium,
+        "status": status,
+        "source": "sqlite",
+        "expiration": expiration_str,
+        "trial_end": trial_end_str,
+        "method": method,
+        "subscriptionId": subscription_id,
+        "usedTrial": True if trial_end_str else False
+    })
+
 @app.route("/start-trial", methods=["POST"])
 def start_trial():
     """Initializes a 3-day trial for a user"""
@@ -1061,20 +1265,20 @@ def start_trial():
         
         if not email or not uid:
             return jsonify({"error": "Missing email or uid"}), 400
+        email = email.strip().lower()
             
         # Check if user already had a trial
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
+        trial_end = trial_end_from()
+        trial_str = trial_end.isoformat().replace('+00:00', 'Z')
+
+        def write(cursor):
+            # Check and insert share the writer transaction, so two requests cannot both start a trial
             cursor.execute("SELECT status, trial_end_date FROM licenses WHERE email = ?", (email,))
             row = cursor.fetchone()
-            
             if row and row[1]: # Already has trial info
-                return jsonify({"error": "Trial already used or started", "status": row[0]}), 403
+                return row[0]
 
             # Start 3-day trial
-            trial_end = datetime.now(timezone.utc) + timedelta(days=3)
-            trial_str = trial_end.isoformat().replace('+00:00', 'Z')
-            
             cursor.execute("""
                 INSERT INTO licenses (email, is_premium, status, trial_end_date, method)
                 VALUES (?, 1, 'trialing', ?, 'FreeTrial')
@@ -1084,28 +1288,31 @@ def start_trial():
                     trial_end_date=excluded.trial_end_date,
                     method='FreeTrial'
             """, (email, trial_str))
-            conn.commit()
-            
-        # Sync to Firestore
-        if db:
-            try:
-                user_ref = db.collection('usuarios').document(uid)
-                user_ref.set({
+            identities.link(cursor, uid, email, synced=True)
+            if db:
+                firestore_outbox.enqueue(cursor, 'usuarios', uid, {
                     'isPremium': True,
                     'status': 'trialing',
                     'trialEndDate': trial_end,
                     'method': 'FreeTrial',
                     'email': email
-                }, merge=True)
-            except Exception as e:
-                print(f"Firebase Trial Sync Error: {e}")
+                })
+            return None
+
+        used_status = sqlite_writer.execute(write)
+        if used_status is not None:
+            return jsonify({"error": "Trial already used or started", "status": used_status}), 403
+        invalidate_license(uid, email)
                 
         return jsonify({"status": "trialing", "trial_end": trial_str})
         
+    except FAIL_FAST:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route("/sync-user", methods=["POST"])
+@rate_limited("sync_user")
 def sync_user():
     """Syncs user data from frontend to Firestore on login"""
     try:
@@ -1117,22 +1324,22 @@ def sync_user():
             return jsonify({"error": "Missing uid or email"}), 400
             
         if db:
-            user_ref = db.collection('usuarios').document(uid)
-            # Use set with merge=True to create or update
-            # We don't overwrite isPremium if it exists
-            user_ref.set({
-                'uid': uid,
-                'email': email,
-                'displayName': data.get("displayName"),
-                'photoURL': data.get("photoURL"),
-                'lastLogin': firestore.SERVER_TIMESTAMP
-            }, merge=True)
-            print(f"User synced to Firestore: {email} ({uid})")
+            # Merge-set only what changed; we don't overwrite isPremium if it exists
+            def write(cursor):
+                # Only links the uid: its license state is unknown until a license write or Firestore read
+                identities.link(cursor, uid, email)
+                return user_sync.record_login(cursor, uid, email, data.get("displayName"), data.get("photoURL"))
+            result = sqlite_writer.execute(write)
+            login_sync.count(result)
+            if result == "written":
+                log.info("User sync queued for Firestore: %s (%s)", email, uid)
             return jsonify({"status": "synced"})
         else:
              return jsonify({"error": "Firestore not initialized"}), 503
+    except FAIL_FAST:
+        raise
     except Exception as e:
-        print(f"Error syncing user: {e}")
+        log.exception("Error syncing user: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/restore-purchase", methods=["POST"])
@@ -1148,18 +1355,22 @@ def restore_purchase():
         if not email or not uid:
             return jsonify({"error": "Missing user data"}), 400
             
-        print(f"Restore Purchase Request: {email} (UID: {uid}) - ID: {payment_id} - Payer: {payer_email}")
+        log.info("Restore Purchase Request: %s (UID: %s) - ID: %s - Payer: %s", email, uid, payment_id, payer_email)
 
         # 1. Search in Firestore for this Payment ID or Payer Email
         if db:
-            query = None
+            docs = []
             if payment_id:
-                query = db.collection('usuarios').where('paymentId', '==', payment_id).limit(1)
+                # One document get: payments_by_id has a document for every form of every known payment id
+                ref_ids = payments_by_id.id_variants(payment_id)
+                if ref_ids:
+                    snap = firestore_get(db.collection(payments_by_id.COLLECTION).document(ref_ids[0]))
+                    docs = [snap] if snap.exists else []
+                metrics.inc("restore_lookups", source="payments_by_id", result="hit" if docs else "miss")
             elif payer_email:
-                query = db.collection('usuarios').where('email', '==', payer_email).where('isPremium', '==', True).limit(1)
-            
-            if query:
-                docs = query.get()
+                docs = firestore_get(db.collection('usuarios').where('email', '==', payer_email).where('isPremium', '==', True).limit(1))
+
+            if docs:
                 for doc in docs:
                     data_db = doc.to_dict()
                     if data_db.get('isPremium') is True:
@@ -1174,16 +1385,33 @@ def restore_purchase():
                             if datetime.now(timezone.utc) < trial_dt:
                                 p_status = 'trialing'
 
-                        user_ref = db.collection('usuarios').document(uid)
-                        user_ref.set({
-                            'isPremium': True,
-                            'status': p_status,
-                            'expirationDate': data_db.get('expirationDate'),
-                            'trialEndDate': data_db.get('trialEndDate'),
-                            'method': p_method,
-                            'paymentId': data_db.get('paymentId'),
-                            'restoredFrom': doc.id
-                        }, merge=True)
+                        exp_date = as_utc(data_db.get('expirationDate'))
+                        trial_dt = as_utc(trial_end)
+
+                        def write(cursor):
+                            cursor.execute("""
+                                INSERT INTO licenses (email, is_premium, status, payment_id, expiration_date, trial_end_date, method)
+                                VALUES (?, 1, ?, ?, ?, ?, ?)
+                                ON CONFLICT(email) DO UPDATE SET
+                                    is_premium=1,
+                                    status=excluded.status,
+                                    payment_id=excluded.payment_id,
+                                    expiration_date=excluded.expiration_date,
+                                    trial_end_date=excluded.trial_end_date,
+                                    method=excluded.method
+                            """, (email.strip().lower(), p_status, data_db.get('paymentId'), to_iso_z(exp_date), to_iso_z(trial_dt), p_method))
+                            identities.link(cursor, uid, email, synced=True)
+                            firestore_outbox.enqueue(cursor, 'usuarios', uid, {
+                                'isPremium': True,
+                                'status': p_status,
+                                'expirationDate': exp_date,
+                                'trialEndDate': trial_dt,
+                                'method': p_method,
+                                'paymentId': data_db.get('paymentId'),
+                                'restoredFrom': data_db.get('uid') or doc.id
+                            })
+                        sqlite_writer.execute(write)
+                        invalidate_license(uid, email)
                         
                         return jsonify({
                             "status": "restored", 
@@ -1192,30 +1420,51 @@ def restore_purchase():
                         })
 
         # 2. Search in SQLite if Firestore fails (Legacy or fast cache)
-        with sqlite3.connect(DB_NAME) as conn:
+        with read_db() as conn:
             cursor = conn.cursor()
             if payment_id:
-                cursor.execute("SELECT email, status, expiration_date, method FROM licenses WHERE payment_id = ? OR payment_id = ?", (payment_id, f"PADDLE_{payment_id}"))
+                ids = payments_by_id.id_variants(payment_id) or [payment_id]
+                marks = ", ".join("?" * len(ids))
+                cursor.execute(
+                    f"SELECT email, status, expiration_date, method, trial_end_date, payment_id FROM licenses WHERE payment_id IN ({marks}) OR subscription_id IN ({marks})",
+                    ids + ids,
+                )
             elif payer_email:
-                cursor.execute("SELECT email, status, expiration_date, method FROM licenses WHERE email = ?", (payer_email,))
+                cursor.execute("SELECT email, status, expiration_date, method, trial_end_date, payment_id FROM licenses WHERE email = ?", (payer_email.strip().lower(),))
             else:
                 return jsonify({"status": "not_found", "message": "No se proporcionaron datos de búsqueda."})
                 
             row = cursor.fetchone()
             if row:
-                found_email, status, expiration, method = row
+                found_email, status, expiration, method, trial_end_str, found_payment_id = row
                 # Re-verify if actually premium
                 if status in ['active', 'trialing']:
-                    # Sync to Firestore for current user
-                    if db:
-                        user_ref = db.collection('usuarios').document(uid)
-                        user_ref.set({
-                            'isPremium': True,
-                            'status': status,
-                            'method': method,
-                            'paymentId': payment_id or found_email,
-                            'email': email # Use current email
-                        }, merge=True)
+                    def write(c):
+                        if found_email != email.strip().lower():
+                            # Copy onto the current user's row so their identity answers locally
+                            c.execute("""
+                                INSERT INTO licenses (email, is_premium, status, payment_id, expiration_date, trial_end_date, method)
+                                VALUES (?, 1, ?, ?, ?, ?, ?)
+                                ON CONFLICT(email) DO UPDATE SET
+                                    is_premium=1,
+                                    status=excluded.status,
+                                    payment_id=excluded.payment_id,
+                                    expiration_date=excluded.expiration_date,
+                                    trial_end_date=excluded.trial_end_date,
+                                    method=excluded.method
+                            """, (email.strip().lower(), status, found_payment_id, expiration, trial_end_str, method))
+                        identities.link(c, uid, email, synced=True)
+                        # Sync to Firestore for current user
+                        if db:
+                            firestore_outbox.enqueue(c, 'usuarios', uid, {
+                                'isPremium': True,
+                                'status': status,
+                                'method': method,
+                                'paymentId': payment_id or found_email,
+                                'email': email # Use current email
+                            })
+                    sqlite_writer.execute(write)
+                    invalidate_license(uid, email)
                         
                     return jsonify({
                         "status": "restored", 
@@ -1225,8 +1474,10 @@ def restore_purchase():
 
         return jsonify({"status": "not_found", "message": "No se encontró ninguna suscripción con esos datos."})
         
+    except FAIL_FAST:
+        raise
     except Exception as e:
-        print(f"Restore Purchase Error: {e}")
+        log.exception("Restore Purchase Error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/support", methods=["POST"])
@@ -1264,13 +1515,15 @@ def support():
             "reply_to": email
         }
 
-        email_response = resend.Emails.send(params)
-        print("Resend Response:", email_response)
+        # Persist and acknowledge; the background sender delivers with retries
+        outbox_id = sqlite_writer.execute(lambda cursor: support_mail.enqueue(cursor, params))
 
-        return jsonify({"success": True, "id": email_response.get("id")})
+        return jsonify({"success": True, "id": str(outbox_id), "queued": True}), 202
 
+    except FAIL_FAST:
+        raise
     except Exception as e:
-        print(f"Support Error: {e}")
+        log.exception("Support Error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+"""Boot time and per-worker memory of the gunicorn profile vs. a plain gunicorn start.
+
+    python benchmarks/bench_gunicorn.py [--workers 4] [--rounds 3] [--output results.json]
+
+"plain" runs `gunicorn app:app` with the same worker count and threads but no
+config: every worker imports the app and builds its clients itself. "profile"
+runs gunicorn.conf.py: one preloaded import shared copy-on-write, clients
+created in post_fork. RSS counts shared pages in every worker; PSS splits them
+between the processes sharing them, so its sum is what the box actually pays.
+Linux only (reads /proc).
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, deadline):
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as resp:
+                if resp.status == 200:
+                    return True
+        except Exception:
+            pass
+        time.sleep(0.05)
+    return False
+
+
+def children(pid):
+    out = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; ppid is the 2nd field after it
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            out.append(int(entry))
+    return out
+
+
+def memory_kb(pid):
+    rss = pss = None
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    pss = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, pss
+
+
+def run_once(mode, workers, threads, ready_timeout, workdir):
+    port = free_port()
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        WEB_CONCURRENCY=str(workers),
+        GUNICORN_THREADS=str(threads),
+        LICENSES_DB=os.path.join(workdir, "bench.db"),
+        LICENSE_TOKEN_KEYS_FILE=os.path.join(workdir, "license_keys.json"),
+        LICENSE_TOKEN_KEYS_AUTOCREATE="1",
+        WEBHOOK_JOURNAL_DIR="",
+    )
+    env.pop("APP_DEFER_RUNTIME", None)
+    if mode == "profile":
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"]
+    else:
+        # gunicorn picks up ./gunicorn.conf.py on its own; an empty config keeps it out
+        cmd = [sys.executable, "-m", "gunicorn", "-c", os.devnull, "app:app", "--bind", f"0.0.0.0:{port}",
+               "--workers", str(workers), "--worker-class", "gthread", "--threads", str(threads)]
+
+    started = time.monotonic()
+    proc = subprocess.Popen(cmd, cwd=BACKEND, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base = f"http://127.0.0.1:{port}"
+        deadline = started + ready_timeout
+        healthy = wait_for(f"{base}/healthz", deadline)
+        boot = time.monotonic() - started if healthy else None
+        ready = wait_for(f"{base}/readyz", deadline)
+        ready_s = time.monotonic() - started if ready else None
+        # Let every worker finish booting and warming up before sampling
+        while len(children(proc.pid)) < workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+        time.sleep(2.0)
+
+        worker_pids = children(proc.pid)
+        samples = [memory_kb(pid) for pid in worker_pids]
+        master_rss, master_pss = memory_kb(proc.pid)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    rss = [r for r, _ in samples if r is not None]
+    pss = [p for _, p in samples if p is not None]
+    mb = lambda kb: round(kb / 1024, 1)
+    return {
+        "boot_seconds": round(boot, 3) if boot is not None else None,
+        "ready_seconds": round(ready_s, 3) if ready_s is not None else None,
+        "workers": len(worker_pids),
+        "worker_rss_mb": mb(statistics.mean(rss)) if rss else None,
+        "worker_pss_mb": mb(statistics.mean(pss)) if pss else None,
+        "master_rss_mb": mb(master_rss) if master_rss else None,
+        "total_pss_mb": mb(sum(pss) + (master_pss or 0)) if pss else None,
+    }
+
+
+def summarize(runs):
+    out = {}
+    for key in runs[0]:
+        values = [r[key] for r in runs if r[key] is not None]
+        out[key] = statistics.median(values) if values else None
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--ready-timeout", type=float, default=60.0, help="Seconds to wait for /readyz")
+    parser.add_argument("--output", help="Write the results JSON here as well as to stdout")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir("/proc/self"):
+        parser.error("needs /proc (Linux)")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in ("plain", "profile"):
+            runs = [run_once(mode, args.workers, args.threads, args.ready_timeout, workdir) for _ in range(args.rounds)]
+            results[mode] = {"median": summarize(runs), "runs": runs}
+            print(f"{mode:<8} {json.dumps(results[mode]['median'])}", file=sys.stderr)
+
+    text = json.dumps({"workers": args.workers, "threads": args.threads, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
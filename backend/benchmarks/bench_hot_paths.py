@@ -0,0 +1,145 @@
+"""CPU cost of the per-request licensing paths, measured on recorded fixtures.
+
+    python benchmarks/bench_hot_paths.py [--output results.json] [--repeat 7] [--only as_utc_webhook,webhook_fields]
+
+Each benchmark runs over every fixture record per call; times are reported
+per record. Compare two runs with benchmarks/compare.py.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, jsonify  # noqa: E402
+
+from licensing import (  # noqa: E402
+    as_utc,
+    derive_status,
+    paddle_plan_type,
+    resolve_license,
+    revalidate_local,
+)
+from paddle_api import webhook_fields  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_fixtures():
+    with open(os.path.join(FIXTURES, "paddle_webhooks.json")) as f:
+        webhooks = json.load(f)
+    with open(os.path.join(FIXTURES, "license_rows.json")) as f:
+        licenses = json.load(f)
+    return webhooks, licenses
+
+
+def build_cases(webhooks, licenses):
+    """name -> (fn, records per call); every fn processes the whole fixture set"""
+    now = as_utc(licenses["now"])
+    rows = [tuple(r) for r in licenses["sqlite_rows"]]
+    users = licenses["firestore_users"]
+    by_email = licenses["licenses_by_email"]
+    bodies = [json.dumps(p).encode() for p in webhooks]
+
+    timestamps = [p["occurred_at"] for p in webhooks]
+    for p in webhooks:
+        data = p["data"]
+        timestamps += [data.get(k) for k in ("created_at", "updated_at", "next_billed_at", "canceled_at") if data.get(k)]
+    stored = [v for r in rows for v in (r[2], r[3]) if v]
+    stored += [u[k] for u in users for k in ("expirationDate", "trialEndDate") if u.get(k)]
+    dated = [(u.get("status"), u.get("isPremium"), as_utc(u.get("trialEndDate")), as_utc(u.get("expirationDate"))) for u in users]
+    price_ids = [webhook_fields(p)[4] for p in webhooks]
+
+    app = Flask(__name__)
+    ctx = app.app_context()
+    ctx.push()
+
+    def check_license_bodies():
+        for r in rows:
+            premium, status = revalidate_local(bool(r[0]), r[1], r[3], r[2], now)
+            jsonify({
+                "premium": premium,
+                "status": status,
+                "source": "sqlite",
+                "expiration": r[2],
+                "trial_end": r[3],
+                "method": r[4],
+                "subscriptionId": r[5],
+                "usedTrial": True if r[3] else False,
+            }).get_data()
+
+    def each(fn, items):
+        return lambda: [fn(i) for i in items]
+
+    return {
+        # Webhook timestamps (paddle-webhook) and stored dates (check-license, reconcile) go through as_utc
+        "as_utc_webhook": (each(as_utc, timestamps), len(timestamps)),
+        "as_utc_stored": (each(as_utc, stored), len(stored)),
+        "revalidate_local": (lambda: [revalidate_local(bool(r[0]), r[1], r[3], r[2], now) for r in rows], len(rows)),
+        "derive_status": (lambda: [derive_status(s, p, t, e, now) for s, p, t, e in dated], len(dated)),
+        "resolve_license": (lambda: [resolve_license(u, by_email.get, None, now) for u in users], len(users)),
+        "webhook_fields": (each(webhook_fields, webhooks), len(webhooks)),
+        "webhook_decode": (lambda: [webhook_fields(json.loads(b)) for b in bodies], len(bodies)),
+        "paddle_plan_type": (each(paddle_plan_type, price_ids), len(price_ids)),
+        "check_license_body": (check_license_bodies, len(rows)),
+    }
+
+
+def measure(fn, records, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()  # loops needed for a run of at least 0.2s
+    runs = timer.repeat(repeat=repeat, number=number)
+    per_op = [run / number / records * 1e9 for run in runs]
+    return {
+        "ns_per_op_median": round(statistics.median(per_op), 1),
+        "ns_per_op_min": round(min(per_op), 1),
+        "rounds": repeat,
+        "number": number,
+        "records": records,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", help="Write the results JSON here as well as to stdout")
+    parser.add_argument("--repeat", type=int, default=7, help="Timed rounds per benchmark")
+    parser.add_argument("--only", help="Comma-separated benchmark names")
+    args = parser.parse_args(argv)
+
+    cases = build_cases(*load_fixtures())
+    names = args.only.split(",") if args.only else list(cases)
+    unknown = [n for n in names if n not in cases]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    results = {}
+    for name in names:
+        fn, records = cases[name]
+        fn()  # warm-up
+        results[name] = measure(fn, records, args.repeat)
+        print(f"{name:<20} {results[name]['ns_per_op_median']:>10.1f} ns/op", file=sys.stderr)
+
+    out = {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+    text = json.dumps(out, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
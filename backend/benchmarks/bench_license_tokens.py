@@ -0,0 +1,56 @@
+"""Mint/verify cost of signed license tokens.
+
+    python benchmarks/bench_license_tokens.py [--seconds 2]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import license_tokens  # noqa: E402
+
+VERDICT = {
+    "premium": True,
+    "status": "active",
+    "method": "Paddle",
+    "expiration": "2031-01-01T00:00:00Z",
+    "trial_end": None,
+}
+
+
+def measure(fn, seconds):
+    fn()  # warm caches and the keyring
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(50):
+            fn()
+        count += 50
+    elapsed = time.perf_counter() - started
+    return {"ops": count, "ops_per_second": round(count / elapsed), "us_per_op": round(elapsed / count * 1e6, 1)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=2.0, help="Time spent per measurement")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ring = license_tokens.Keyring(os.path.join(tmp, "keys.json"), autocreate=True)
+        token = license_tokens.mint("uid_123", "someone@example.com", VERDICT, ring=ring)
+        results = {
+            "token_bytes": len(token),
+            "mint": measure(lambda: license_tokens.mint("uid_123", "someone@example.com", VERDICT, ring=ring), args.seconds),
+            "verify": measure(lambda: license_tokens.verify(token, ring=ring), args.seconds),
+        }
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
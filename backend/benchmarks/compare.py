@@ -0,0 +1,66 @@
+"""Compares two bench_hot_paths.py result files and flags regressions.
+
+    python benchmarks/compare.py base.json new.json [--threshold 0.10]
+
+Exits 1 when any benchmark's median got slower by more than the threshold.
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(base, new, threshold):
+    """Rows of (name, base_ns, new_ns, change, verdict) for every benchmark in either file"""
+    base_results, new_results = base.get("results", {}), new.get("results", {})
+    rows = []
+    for name in sorted(set(base_results) | set(new_results)):
+        b, n = base_results.get(name), new_results.get(name)
+        if b is None or n is None:
+            rows.append((name, b and b["ns_per_op_median"], n and n["ns_per_op_median"], None, "added" if b is None else "removed"))
+            continue
+        change = n["ns_per_op_median"] / b["ns_per_op_median"] - 1 if b["ns_per_op_median"] else 0.0
+        if change > threshold:
+            verdict = "REGRESSION"
+        elif change < -threshold:
+            verdict = "faster"
+        else:
+            verdict = "ok"
+        rows.append((name, b["ns_per_op_median"], n["ns_per_op_median"], change, verdict))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+
+    base, new = load(args.base), load(args.new)
+    for side, data in (("base", base), ("new", new)):
+        meta = data.get("meta", {})
+        print(f"{side}: python {meta.get('python')} on {meta.get('platform')} at {meta.get('timestamp')}")
+    if base.get("meta", {}).get("python") != new.get("meta", {}).get("python"):
+        print("warning: results come from different Python versions")
+
+    rows = compare(base, new, args.threshold)
+    fmt = lambda v: f"{v:.1f}" if v is not None else "-"
+    print(f"\n{'benchmark':<20} {'base ns':>10} {'new ns':>10} {'change':>8}  verdict")
+    for name, b, n, change, verdict in rows:
+        pct = f"{change * 100:+.1f}%" if change is not None else "-"
+        print(f"{name:<20} {fmt(b):>10} {fmt(n):>10} {pct:>8}  {verdict}")
+
+    regressions = [r[0] for r in rows if r[4] == "REGRESSION"]
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
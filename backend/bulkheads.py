@@ -0,0 +1,165 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import deadlines
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# How long a caller may wait for a slot before being shed (also capped by its request deadline)
+QUEUE_WAIT_SECONDS = float(os.getenv("BULKHEAD_QUEUE_WAIT_MS", "250")) / 1000.0
+# Limits changed through /admin/bulkheads are picked up by the other workers this often
+RELOAD_SECONDS = 5.0
+
+# Per worker process: keep each limit below the worker's thread count so the
+# rest of the threads can still answer requests that don't need that upstream
+DEFAULT_LIMITS = {
+    "firestore": (4, 4),
+    "paypal": (3, 2),
+    "paddle": (3, 2),
+}
+
+
+class Overloaded(Exception):
+    def __init__(self, upstream):
+        super().__init__(f"{upstream} is at its concurrency limit")
+        self.upstream = upstream
+
+
+class Bulkhead:
+    """Caps concurrent calls to one upstream; a few callers may queue briefly, the rest are shed"""
+
+    def __init__(self, name, limit, queue):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.in_flight = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+        metrics.gauge_fn("bulkhead_in_flight", lambda: self.in_flight, upstream=name)
+        metrics.gauge_fn("bulkhead_queue_depth", lambda: self.waiting, upstream=name)
+        metrics.gauge_fn("bulkhead_limit", lambda: self.limit, upstream=name)
+
+    def configure(self, limit=None, queue=None):
+        with self._cond:
+            if limit is not None:
+                self.limit = max(1, int(limit))
+            if queue is not None:
+                self.queue = max(0, int(queue))
+            self._cond.notify_all()
+
+    def _shed(self):
+        metrics.inc("bulkhead_shed", upstream=self.name)
+        return Overloaded(self.name)
+
+    @contextmanager
+    def slot(self, wait=QUEUE_WAIT_SECONDS):
+        left = deadlines.remaining()
+        if left is not None:
+            wait = min(wait, max(0.0, left))
+        with self._cond:
+            if self.in_flight >= self.limit:
+                if self.waiting >= self.queue:
+                    raise self._shed()
+                self.waiting += 1
+                try:
+                    give_up = time.monotonic() + wait
+                    while self.in_flight >= self.limit:
+                        remaining = give_up - time.monotonic()
+                        if remaining <= 0:
+                            raise self._shed()
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify()
+
+    def status(self):
+        return {"limit": self.limit, "queue": self.queue, "in_flight": self.in_flight, "waiting": self.waiting}
+
+
+def _env_limits(name, limit, queue):
+    prefix = f"BULKHEAD_{name.upper()}_"
+    return int(os.getenv(prefix + "LIMIT", str(limit))), int(os.getenv(prefix + "QUEUE", str(queue)))
+
+
+bulkheads = {name: Bulkhead(name, *_env_limits(name, *limits)) for name, limits in DEFAULT_LIMITS.items()}
+
+
+@contextmanager
+def slot(name):
+    """Holds a slot of the named upstream's bulkhead; upstreams without one pass straight through"""
+    bulkhead = bulkheads.get(name)
+    if bulkhead is None:
+        yield
+        return
+    with bulkhead.slot():
+        yield
+
+
+def status():
+    return {name: b.status() for name, b in bulkheads.items()}
+
+
+def init_table(conn):
+    # Runtime overrides shared by every worker; env defaults apply to upstreams without a row
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bulkhead_limits (
+            upstream TEXT PRIMARY KEY,
+            max_concurrent INTEGER NOT NULL,
+            queue INTEGER NOT NULL,
+            updated_at REAL
+        )
+    """)
+
+
+def save(cursor, name, limit, queue):
+    cursor.execute(
+        """
+        INSERT INTO bulkhead_limits (upstream, max_concurrent, queue, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(upstream) DO UPDATE SET
+            max_concurrent=excluded.max_concurrent, queue=excluded.queue, updated_at=excluded.updated_at
+        """,
+        (name, limit, queue, time.time()),
+    )
+
+
+class LimitReloader:
+    """Applies the limits stored in bulkhead_limits to this process's bulkheads"""
+
+    def __init__(self, db_name, interval=RELOAD_SECONDS):
+        self.db_name = db_name
+        self.interval = interval
+        self._thread = None
+
+    def reload(self):
+        with sqlite3.connect(self.db_name, timeout=5) as conn:
+            rows = conn.execute("SELECT upstream, max_concurrent, queue FROM bulkhead_limits").fetchall()
+        for name, limit, queue in rows:
+            bulkhead = bulkheads.get(name)
+            if bulkhead and (bulkhead.limit, bulkhead.queue) != (limit, queue):
+                bulkhead.configure(limit, queue)
+                log.info("Bulkhead %s: limit=%s queue=%s", name, limit, queue)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="bulkhead-limits", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.reload()
+            except Exception as e:
+                log.error("Bulkhead limits reload error: %s", e)
+            time.sleep(self.interval)
@@ -0,0 +1,86 @@
+import contextvars
+import os
+import time
+
+from metrics import metrics
+
+# Whole-request budget for endpoints without their own entry below
+DEFAULT_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "10"))
+ROUTE_SECONDS = {
+    "check_license": 4.0,
+    "cancel_subscription": 15.0,
+    "register_paypal": 15.0,
+    "restore_purchase": 10.0,
+}
+
+
+def _parse_overrides(value):
+    # REQUEST_DEADLINES="check_license=3,cancel_subscription=20"
+    out = {}
+    for item in (value or "").split(","):
+        name, _, seconds = item.partition("=")
+        if name.strip() and seconds.strip():
+            out[name.strip()] = float(seconds)
+    return out
+
+
+ROUTE_SECONDS.update(_parse_overrides(os.getenv("REQUEST_DEADLINES")))
+
+_current = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, route, upstream):
+        super().__init__(f"{route}: deadline exceeded waiting for {upstream}")
+        self.route = route
+        self.upstream = upstream
+
+
+class _Deadline:
+    __slots__ = ("route", "expires_at")
+
+    def __init__(self, route, expires_at):
+        self.route = route
+        self.expires_at = expires_at
+
+
+def start(route, seconds=None):
+    """Sets the deadline of the current request; returns a token for clear()"""
+    seconds = seconds if seconds is not None else ROUTE_SECONDS.get(route, DEFAULT_SECONDS)
+    return _current.set(_Deadline(route, time.monotonic() + seconds))
+
+
+def clear(token):
+    _current.reset(token)
+
+
+def remaining():
+    """Seconds left for the current request, or None outside one"""
+    d = _current.get()
+    return None if d is None else d.expires_at - time.monotonic()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def exceeded(upstream):
+    """Counts a deadline hit against the current route and returns the error to raise"""
+    d = _current.get()
+    route = d.route if d else "none"
+    metrics.inc("deadline_exceeded", route=route, upstream=upstream)
+    return DeadlineExceeded(route, upstream)
+
+
+def timeout(upstream, default):
+    """Timeout for the next call to upstream: its default, capped by what's left of the request.
+
+    Raises DeadlineExceeded when nothing is left, so no call starts without budget.
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise exceeded(upstream)
+    return left if default is None else min(default, left)
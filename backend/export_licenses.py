@@ -0,0 +1,200 @@
+"""Inspect and export the licenses table without loading it into memory.
+
+    python export_licenses.py export --format ndjson --status active trialing > active.ndjson
+    python export_licenses.py export --format csv --expiring-within 7 -o expiring.csv
+    python export_licenses.py export --format parquet -o licenses.parquet
+    python export_licenses.py summary
+"""
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+
+from storage import DB_NAME
+
+COLUMNS = [
+    "email", "is_premium", "status", "method", "payment_id", "subscription_id",
+    "date_created", "expiration_date", "trial_end_date",
+]
+# Trials end at trial_end_date, everything else at expiration_date
+EFFECTIVE_END_SQL = "julianday(COALESCE(CASE WHEN status = 'trialing' THEN trial_end_date END, expiration_date, trial_end_date))"
+FETCH_SIZE = 1000
+
+
+def build_filters(args):
+    clauses, params = [], []
+    if args.status:
+        clauses.append(f"status IN ({','.join('?' * len(args.status))})")
+        params.extend(args.status)
+    if args.method:
+        clauses.append(f"method IN ({','.join('?' * len(args.method))})")
+        params.extend(args.method)
+    if args.premium_only:
+        clauses.append("is_premium = 1")
+    if args.expires_after:
+        clauses.append(f"{EFFECTIVE_END_SQL} >= julianday(?)")
+        params.append(args.expires_after)
+    if args.expires_before:
+        clauses.append(f"{EFFECTIVE_END_SQL} < julianday(?)")
+        params.append(args.expires_before)
+    if args.expiring_within is not None:
+        clauses.append(f"{EFFECTIVE_END_SQL} BETWEEN julianday('now') AND julianday('now', ?)")
+        params.append(f"+{args.expiring_within} days")
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
+
+
+def iter_rows(conn, where, params):
+    cursor = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM licenses{where} ORDER BY email", params)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+def write_ndjson(rows, out):
+    count = 0
+    for row in rows:
+        record = dict(zip(COLUMNS, row))
+        record["is_premium"] = bool(record["is_premium"])
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def write_csv(rows, out):
+    writer = csv.writer(out)
+    writer.writerow(COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def write_parquet(rows, path, row_group_size):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet output needs pyarrow (pip install pyarrow)")
+
+    schema = pa.schema([(c, pa.bool_() if c == "is_premium" else pa.string()) for c in COLUMNS])
+    count = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        columns = [[] for _ in COLUMNS]
+        for row in rows:
+            for i, value in enumerate(row):
+                columns[i].append(bool(value) if i == 1 else (None if value is None else str(value)))
+            count += 1
+            if len(columns[0]) >= row_group_size:
+                writer.write_table(pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(columns, schema)], schema=schema))
+                columns = [[] for _ in COLUMNS]
+        if columns[0]:
+            writer.write_table(pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(columns, schema)], schema=schema))
+    return count
+
+
+def summary(conn, where, params):
+    def grouped(column):
+        return {
+            (key if key is not None else "null"): {"total": total, "premium": premium}
+            for key, total, premium in conn.execute(
+                f"SELECT {column}, COUNT(*), SUM(is_premium = 1) FROM licenses{where} GROUP BY {column} ORDER BY COUNT(*) DESC",
+                params,
+            )
+        }
+
+    and_or_where = " AND " if where else " WHERE "
+    totals = conn.execute(
+        f"""
+        SELECT
+            COUNT(*),
+            SUM(is_premium = 1),
+            SUM({EFFECTIVE_END_SQL} BETWEEN julianday('now') AND julianday('now', '+7 days')),
+            SUM({EFFECTIVE_END_SQL} BETWEEN julianday('now') AND julianday('now', '+30 days')),
+            SUM(is_premium = 1 AND {EFFECTIVE_END_SQL} < julianday('now'))
+        FROM licenses{where}
+        """,
+        params,
+    ).fetchone()
+    return {
+        "total": totals[0],
+        "premium": totals[1] or 0,
+        "expiring_7d": totals[2] or 0,
+        "expiring_30d": totals[3] or 0,
+        # Flagged premium but past their end date; check-license downgrades these on read
+        "premium_but_expired": totals[4] or 0,
+        "by_status": grouped("status"),
+        "by_method": grouped("method"),
+        "by_status_method": {
+            f"{status or 'null'}/{method or 'null'}": count
+            for status, method, count in conn.execute(
+                f"SELECT status, method, COUNT(*) FROM licenses{where} GROUP BY status, method ORDER BY COUNT(*) DESC",
+                params,
+            )
+        },
+        "created_last_30d": conn.execute(
+            f"SELECT COUNT(*) FROM licenses{where}{and_or_where}julianday(date_created) >= julianday('now', '-30 days')",
+            params,
+        ).fetchone()[0],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and export the licenses database")
+    parser.add_argument("--db", default=DB_NAME, help="SQLite licenses database")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def add_filters(p):
+        p.add_argument("--status", nargs="+", help="Only these statuses (active, trialing, canceled, ...)")
+        p.add_argument("--method", nargs="+", help="Only these methods (Paddle, PayPal_Subscription, FreeTrial, ...)")
+        p.add_argument("--premium-only", action="store_true", help="Only rows flagged is_premium")
+        p.add_argument("--expires-after", help="Effective end on/after this ISO date")
+        p.add_argument("--expires-before", help="Effective end before this ISO date")
+        p.add_argument("--expiring-within", type=int, metavar="DAYS", help="Effective end within the next N days")
+
+    export = sub.add_parser("export", help="Stream matching rows")
+    add_filters(export)
+    export.add_argument("--format", choices=["ndjson", "csv", "parquet"], default="ndjson")
+    export.add_argument("-o", "--output", help="Output file (stdout if omitted; required for parquet)")
+    export.add_argument("--row-group-size", type=int, default=50000, help="Rows per Parquet row group")
+
+    summ = sub.add_parser("summary", help="Aggregates computed in SQL")
+    add_filters(summ)
+
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.db):
+        print(f"Database file not found at {args.db}", file=sys.stderr)
+        return 1
+
+    where, params = build_filters(args)
+    conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    try:
+        if args.command == "summary":
+            print(json.dumps(summary(conn, where, params), indent=2))
+            return 0
+
+        rows = iter_rows(conn, where, params)
+        if args.format == "parquet":
+            if not args.output:
+                parser.error("--output is required for parquet")
+            count = write_parquet(rows, args.output, args.row_group_size)
+        else:
+            out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+            try:
+                count = (write_csv if args.format == "csv" else write_ndjson)(rows, out)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+        print(f"Exported {count} rows", file=sys.stderr)
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from firebase_admin import firestore
+
+from metrics import metrics
+import upstream
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.getenv("FIRESTORE_OUTBOX_BATCH", "200"))
+POLL_SECONDS = 1.0
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 300.0
+# Only the worker holding the lease drains the outbox, so per-document order holds across processes
+LEASE_SECONDS = 30
+# A Firestore WriteBatch accepts at most 500 writes
+FIRESTORE_BATCH_LIMIT = 450
+# A write still failing after this many attempts (~45 minutes of backoff) is moved to firestore_outbox_dead,
+# so it stops blocking later writes to its document
+MAX_ATTEMPTS = int(os.getenv("FIRESTORE_OUTBOX_MAX_ATTEMPTS", "25"))
+
+OP_SET = "set"
+# doc_id is an email: set on every usuarios doc with that email
+OP_SET_WHERE_EMAIL = "set_where_email"
+
+
+def init_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS firestore_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,
+            collection TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_firestore_outbox_doc ON firestore_outbox (collection, doc_id, id)")
+    # Writes given up on; kept for inspection and for re-queueing by hand
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS firestore_outbox_dead (
+            id INTEGER PRIMARY KEY,
+            op TEXT NOT NULL,
+            collection TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            attempts INTEGER NOT NULL,
+            last_error TEXT,
+            dead_at REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS worker_leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL
+        )
+    """)
+
+
+def _encode(value):
+    if value is firestore.SERVER_TIMESTAMP:
+        return {"$server_ts": True}
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if value.get("$server_ts") is True and len(value) == 1:
+            return firestore.SERVER_TIMESTAMP
+        if "$dt" in value and len(value) == 1:
+            return datetime.fromisoformat(value["$dt"])
+        return {k: _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+_wake = threading.Event()
+
+
+def enqueue(conn, collection, doc_id, data, op=OP_SET):
+    """Records a Firestore merge-set in the caller's SQLite transaction"""
+    now = time.time()
+    conn.execute(
+        "INSERT INTO firestore_outbox (op, collection, doc_id, data, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (op, collection, doc_id, json.dumps(_encode(data)), now, now),
+    )
+    _wake.set()
+
+
+def has_pending(conn, collection, doc_id):
+    """True while a write for this document is still waiting to reach Firestore (dead-lettered ones don't count)"""
+    return conn.execute(
+        "SELECT 1 FROM firestore_outbox WHERE collection = ? AND doc_id = ? LIMIT 1",
+        (collection, doc_id),
+    ).fetchone() is not None
+
+
+class FirestoreReplicator:
+    """Drains firestore_outbox into Firestore in id order, batching and retrying.
+
+    on_applied, if given, is called with (op, collection, doc_id, data) for
+    every write once it is in Firestore.
+    """
+
+    def __init__(self, db_name, db, on_applied=None):
+        self.db_name = db_name
+        self.db = db
+        self.on_applied = on_applied
+        self.owner = uuid.uuid4().hex
+        self._thread = None
+        metrics.gauge_fn("firestore_outbox_depth", self.depth)
+        metrics.gauge_fn("firestore_replication_lag_seconds", self.lag)
+        metrics.gauge_fn("firestore_outbox_dead", self.dead)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_name, timeout=10)
+
+    def depth(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM firestore_outbox").fetchone()[0]
+
+    def dead(self):
+        """Writes given up on; anything above zero needs a look"""
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM firestore_outbox_dead").fetchone()[0]
+
+    def lag(self):
+        """Age of the oldest write not yet replicated"""
+        with self._connect() as conn:
+            oldest = conn.execute("SELECT MIN(created_at) FROM firestore_outbox").fetchone()[0]
+        return round(time.time() - oldest, 3) if oldest else 0.0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="firestore-replicator", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            applied = 0
+            try:
+                if self._hold_lease():
+                    applied = self.drain_once()
+            except Exception as e:
+                log.error("Firestore replicator error: %s", e)
+            if not applied:
+                _wake.wait(POLL_SECONDS)
+                _wake.clear()
+
+    def _hold_lease(self):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO worker_leases (name, owner, expires_at) VALUES ('firestore_replicator', NULL, 0)"
+            )
+            cursor = conn.execute(
+                """
+                UPDATE worker_leases SET owner = ?, expires_at = ?
+                WHERE name = 'firestore_replicator' AND (owner = ? OR expires_at < ?)
+                """,
+                (self.owner, now + LEASE_SECONDS, self.owner, now),
+            )
+            return cursor.rowcount == 1
+
+    def _due_rows(self):
+        now = time.time()
+        with self._connect() as conn:
+            # Skip documents whose earlier write is still backing off, so per-document order holds
+            return conn.execute(
+                """
+                SELECT id, op, collection, doc_id, data, created_at, attempts FROM firestore_outbox o
+                WHERE next_attempt_at <= ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM firestore_outbox p
+                      WHERE p.collection = o.collection AND p.doc_id = o.doc_id
+                        AND p.id < o.id AND p.next_attempt_at > ?
+                  )
+                ORDER BY id LIMIT ?
+                """,
+                (now, now, BATCH_SIZE),
+            ).fetchall()
+
+    def _refs(self, op, collection, doc_id):
+        if op == OP_SET_WHERE_EMAIL:
+            docs = self.db.collection(collection).where("email", "==", doc_id).limit(10).get()
+            return [self.db.collection(collection).document(d.id) for d in docs]
+        return [self.db.collection(collection).document(doc_id)]
+
+    def drain_once(self):
+        """Replicates one batch of due writes; returns how many outbox rows were applied"""
+        rows = self._due_rows()
+        if not rows:
+            return 0
+
+        started = time.time()
+        try:
+            batch, ops = self.db.batch(), 0
+            for _, op, collection, doc_id, data, _, _ in rows:
+                for ref in self._refs(op, collection, doc_id):
+                    batch.set(ref, _decode(json.loads(data)), merge=True)
+                    ops += 1
+                    if ops >= FIRESTORE_BATCH_LIMIT:
+                        with upstream.timed("firestore"):
+                            batch.commit()
+                        batch, ops = self.db.batch(), 0
+            if ops:
+                with upstream.timed("firestore"):
+                    batch.commit()
+            done = [r[0] for r in rows]
+        except Exception as e:
+            log.warning("Firestore outbox batch failed (%d writes), retrying one by one: %s", len(rows), e)
+            done = self._apply_individually(rows)
+
+        self._finish(rows, done)
+        metrics.observe("firestore_replication_batch_seconds", time.time() - started)
+        return len(done)
+
+    def _apply_individually(self, rows):
+        done, blocked = [], set()
+        for row_id, op, collection, doc_id, data, _, attempts in rows:
+            if (collection, doc_id) in blocked:
+                continue
+            try:
+                for ref in self._refs(op, collection, doc_id):
+                    ref.set(_decode(json.loads(data)), merge=True)
+                done.append(row_id)
+            except Exception as e:
+                blocked.add((collection, doc_id))
+                metrics.inc("firestore_replication_errors", collection=collection)
+                if attempts + 1 >= MAX_ATTEMPTS:
+                    self._dead_letter(row_id, str(e))
+                    metrics.inc("firestore_outbox_dead_letters", collection=collection)
+                    log.error("Firestore outbox write %s (%s/%s) failed %d times, moved to firestore_outbox_dead: %s",
+                              row_id, collection, doc_id, attempts + 1, e)
+                    continue
+                delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempts)))
+                with self._connect() as conn:
+                    conn.execute(
+                        "UPDATE firestore_outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                        (time.time() + delay, str(e)[:500], row_id),
+                    )
+                log.warning("Firestore outbox write %s (%s/%s) failed: %s", row_id, collection, doc_id, e)
+        return done
+
+    def _dead_letter(self, row_id, error):
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO firestore_outbox_dead (id, op, collection, doc_id, data, created_at, attempts, last_error, dead_at)
+                SELECT id, op, collection, doc_id, data, created_at, attempts + 1, ?, ? FROM firestore_outbox WHERE id = ?
+                """,
+                (error[:500], time.time(), row_id),
+            )
+            conn.execute("DELETE FROM firestore_outbox WHERE id = ?", (row_id,))
+
+    def _finish(self, rows, done):
+        if not done:
+            return
+        now = time.time()
+        created = {r[0]: r[5] for r in rows}
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM firestore_outbox WHERE id = ?", [(i,) for i in done])
+        metrics.inc("firestore_replicated_writes", len(done))
+        for row_id in done:
+            metrics.observe("firestore_replication_delay_seconds", now - created[row_id])
+        if self.on_applied:
+            applied = set(done)
+            try:
+                self.on_applied([(op, collection, doc_id, json.loads(data)) for row_id, op, collection, doc_id, data, _, _ in rows if row_id in applied])
+            except Exception as e:
+                log.error("Firestore outbox on_applied error: %s", e)
@@ -0,0 +1,144 @@
+"""In-memory stand-in for the slice of the Firestore client this backend uses.
+
+Used by the webhook replay and benchmarks so the real handlers can run
+without credentials or network. Supports document get/set (merge),
+equality where(), order_by("__name__"), limit, select, start_after, batches
+and SERVER_TIMESTAMP.
+"""
+import copy
+import threading
+from datetime import datetime, timezone
+
+from firebase_admin import firestore
+
+
+def _resolve(data):
+    now = datetime.now(timezone.utc)
+    return {k: (now if v is firestore.SERVER_TIMESTAMP else copy.deepcopy(v)) for k, v in data.items()}
+
+
+class Snapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class DocumentRef:
+    def __init__(self, client, collection, doc_id):
+        self._client = client
+        self.collection = collection
+        self.id = doc_id
+
+    def get(self, **kwargs):
+        with self._client.lock:
+            data = self._client.store.get(self.collection, {}).get(self.id)
+            return Snapshot(self, copy.deepcopy(data) if data is not None else None)
+
+    def set(self, data, merge=False, **kwargs):
+        with self._client.lock:
+            docs = self._client.store.setdefault(self.collection, {})
+            if merge and self.id in docs:
+                docs[self.id].update(_resolve(data))
+            else:
+                docs[self.id] = _resolve(data)
+            self._client.writes += 1
+
+    def update(self, data, **kwargs):
+        self.set(data, merge=True)
+
+
+class Query:
+    def __init__(self, client, collection, filters=(), limit=None, after=None, fields=None):
+        self._client = client
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._limit = limit
+        self._after = after
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, limit=self._limit, after=self._after, fields=self._fields)
+        state.update(changes)
+        return Query(self._client, self._collection, **state)
+
+    def where(self, field, op, value):
+        if op != "==":
+            raise NotImplementedError(f"stand-in only supports '==' filters, not {op!r}")
+        return self._copy(filters=self._filters + ((field, value),))
+
+    def order_by(self, field, **kwargs):
+        if field != "__name__":
+            raise NotImplementedError("stand-in only orders by document id")
+        return self
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, fields):
+        return self._copy(fields=tuple(fields))
+
+    def start_after(self, snapshot):
+        # A snapshot, or a {"__name__": doc_id} cursor like the real client accepts
+        return self._copy(after=snapshot["__name__"] if isinstance(snapshot, dict) else snapshot.id)
+
+    def get(self, **kwargs):
+        with self._client.lock:
+            docs = sorted(self._client.store.get(self._collection, {}).items())
+            out = []
+            for doc_id, data in docs:
+                if self._after is not None and doc_id <= self._after:
+                    continue
+                if any(data.get(f) != v for f, v in self._filters):
+                    continue
+                if self._fields is not None:
+                    data = {f: data[f] for f in self._fields if f in data}
+                out.append(Snapshot(DocumentRef(self._client, self._collection, doc_id), copy.deepcopy(data)))
+                if self._limit and len(out) >= self._limit:
+                    break
+            return out
+
+    stream = get
+
+
+class CollectionRef(Query):
+    def __init__(self, client, collection):
+        super().__init__(client, collection)
+
+    def document(self, doc_id):
+        return DocumentRef(self._client, self._collection, doc_id)
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append((ref, data, merge))
+
+    def commit(self):
+        with self._client.lock:
+            for ref, data, merge in self._ops:
+                ref.set(data, merge=merge)
+        self._ops = []
+
+
+class FirestoreStandin:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.store = {}
+        self.writes = 0
+
+    def collection(self, name):
+        return CollectionRef(self, name)
+
+    def batch(self):
+        return WriteBatch(self)
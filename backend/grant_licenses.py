@@ -0,0 +1,266 @@
+"""Bulk manual license grants (refunds, promos, partner seats).
+
+Reads a CSV (with header) or NDJSON file with one grant per row:
+
+    email,uid,days,expires,trial,method,plan_type,payment_id
+
+Only one of email/uid is required. Without `days` or `expires` the grant lasts
+`--days`. A truthy `trial` column grants a trial ending at that date instead
+of a paid period. Rows are upserted into SQLite with executemany in chunked
+transactions and mirrored to Firestore (usuarios/<uid> and
+licenses_by_email/<email>) with batched writes. Progress is checkpointed
+after every chunk, so an interrupted run resumes where it stopped.
+
+    python grant_licenses.py grants.csv --method Promo --days 31
+"""
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+from firebase_admin import firestore
+
+import identities
+from licensing import PLAN_DAYS, as_utc, derive_status, to_iso_z
+from storage import DB_NAME, init_db, init_firestore
+
+FIRESTORE_BATCH_LIMIT = 400
+TRUTHY = ("1", "true", "yes", "y", "si", "sí")
+
+
+class GrantError(ValueError):
+    pass
+
+
+def read_rows(path):
+    """Yields (line_number, dict) for every data row of a CSV or NDJSON file"""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith((".ndjson", ".jsonl")):
+            for n, line in enumerate(f, 1):
+                if line.strip():
+                    yield n, json.loads(line)
+        else:
+            for n, row in enumerate(csv.DictReader(f), 1):
+                yield n, row
+
+
+def build_grant(row, defaults, now):
+    email = (row.get("email") or "").strip().lower() or None
+    uid = (row.get("uid") or "").strip() or None
+    if not email and not uid:
+        raise GrantError("row needs an email or a uid")
+
+    expires = row.get("expires")
+    if expires:
+        end = as_utc(expires)
+        if not end:
+            raise GrantError(f"invalid expires value {expires!r}")
+    else:
+        try:
+            days = int(row.get("days") or defaults.days)
+        except ValueError:
+            raise GrantError(f"invalid days value {row.get('days')!r}")
+        end = now + timedelta(days=days)
+
+    is_trial = str(row.get("trial") or "").strip().lower() in TRUTHY
+    trial_end = end if is_trial else None
+    expiration = None if is_trial else end
+    # Same rules check-license applies when it re-validates a stored license
+    is_premium, status = derive_status("active", True, trial_end, expiration, now)
+    return {
+        "email": email,
+        "uid": uid,
+        "is_premium": is_premium,
+        "status": status,
+        "method": row.get("method") or defaults.method,
+        "plan_type": row.get("plan_type") or defaults.plan_type,
+        "payment_id": row.get("payment_id") or defaults.payment_id,
+        "expiration": expiration,
+        "trial_end": trial_end,
+    }
+
+
+def firestore_fields(grant):
+    data = {
+        "isPremium": grant["is_premium"],
+        "status": grant["status"],
+        "method": grant["method"],
+        "paymentId": grant["payment_id"],
+        "planType": grant["plan_type"],
+        "lastPayment": firestore.SERVER_TIMESTAMP,
+    }
+    if grant["email"]:
+        data["email"] = grant["email"]
+    if grant["expiration"]:
+        data["expirationDate"] = grant["expiration"]
+    if grant["trial_end"]:
+        data["trialEndDate"] = grant["trial_end"]
+        data["usedTrial"] = True
+    return data
+
+
+class FirestoreMirror:
+    """Commits batched writes on a small thread pool, bounding in-flight batches"""
+
+    def __init__(self, db, concurrency):
+        self.db = db
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="grant-fs")
+        self.slots = threading.BoundedSemaphore(concurrency * 2)
+        self.futures = []
+
+    def write(self, grants):
+        batch, ops = self.db.batch(), 0
+        for grant in grants:
+            data = firestore_fields(grant)
+            if grant["uid"]:
+                batch.set(self.db.collection("usuarios").document(grant["uid"]), data, merge=True)
+                ops += 1
+            if grant["email"]:
+                batch.set(self.db.collection("licenses_by_email").document(grant["email"]), {**data, "uid": grant["uid"]}, merge=True)
+                ops += 1
+            if ops >= FIRESTORE_BATCH_LIMIT:
+                self._submit(batch)
+                batch, ops = self.db.batch(), 0
+        if ops:
+            self._submit(batch)
+
+    def _submit(self, batch):
+        self.slots.acquire()
+        future = self.pool.submit(batch.commit)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def wait(self):
+        """Blocks until every submitted batch committed; raises the first failure"""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def upsert_sqlite(conn, grants):
+    rows = [
+        (g["email"], 1 if g["is_premium"] else 0, g["status"], g["payment_id"], to_iso_z(g["expiration"]), to_iso_z(g["trial_end"]), g["method"])
+        for g in grants if g["email"]
+    ]
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO licenses (email, is_premium, status, payment_id, expiration_date, trial_end_date, method)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(email) DO UPDATE SET
+                is_premium=excluded.is_premium,
+                status=excluded.status,
+                payment_id=excluded.payment_id,
+                expiration_date=excluded.expiration_date,
+                trial_end_date=excluded.trial_end_date,
+                method=excluded.method
+            """,
+            rows,
+        )
+        identities.link_many(conn, [(g["uid"], g["email"]) for g in grants if g["uid"]], synced=True)
+    return len(rows)
+
+
+def load_checkpoint(path, restart):
+    if restart or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return json.load(f).get("line", 0)
+
+
+def save_checkpoint(path, line, stats):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"line": line, **stats}, f)
+    os.replace(tmp, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grant premium licenses in bulk")
+    parser.add_argument("input", help="CSV (with header) or NDJSON file of grants")
+    parser.add_argument("--db", default=DB_NAME, help="SQLite licenses database")
+    parser.add_argument("--days", type=int, default=PLAN_DAYS["monthly"], help="Default grant length")
+    parser.add_argument("--method", default="Manual", help="Default method recorded on the license")
+    parser.add_argument("--plan-type", default="monthly")
+    parser.add_argument("--payment-id", default="MANUAL_GRANT")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Rows per SQLite transaction/checkpoint")
+    parser.add_argument("--concurrency", type=int, default=4, help="Firestore batches committed in parallel")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: <input>.checkpoint)")
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint")
+    parser.add_argument("--skip-firestore", action="store_true", help="Only write SQLite")
+    parser.add_argument("--dry-run", action="store_true", help="Validate the input and write nothing")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+
+    checkpoint_path = args.checkpoint or f"{args.input}.checkpoint"
+    resume_after = load_checkpoint(checkpoint_path, args.restart)
+    if resume_after:
+        print(f"Resuming after line {resume_after} (checkpoint {checkpoint_path})", file=sys.stderr)
+
+    db = None if (args.skip_firestore or args.dry_run) else init_firestore()
+    if not db and not (args.skip_firestore or args.dry_run):
+        print("Firestore unavailable; use --skip-firestore to grant in SQLite only", file=sys.stderr)
+        return 1
+
+    init_db(args.db)
+    conn = sqlite3.connect(args.db, timeout=30)
+    mirror = FirestoreMirror(db, args.concurrency) if db else None
+    stats = {"granted": 0, "sqlite_rows": 0, "errors": 0}
+    started = time.time()
+    now = datetime.now(timezone.utc)
+    chunk, last_line = [], resume_after
+
+    def flush():
+        if not chunk:
+            return
+        if not args.dry_run:
+            stats["sqlite_rows"] += upsert_sqlite(conn, chunk)
+            if mirror:
+                mirror.write(chunk)
+                mirror.wait()
+            save_checkpoint(checkpoint_path, last_line, stats)
+        stats["granted"] += len(chunk)
+        elapsed = max(time.time() - started, 1e-6)
+        print(f"{stats['granted']} granted (line {last_line}) - {stats['granted'] / elapsed:.0f} rows/s", file=sys.stderr)
+        chunk.clear()
+
+    try:
+        for line, row in read_rows(args.input):
+            if line <= resume_after:
+                continue
+            try:
+                chunk.append(build_grant(row, args, now))
+            except GrantError as e:
+                stats["errors"] += 1
+                print(f"Line {line}: {e}", file=sys.stderr)
+            last_line = line
+            if len(chunk) >= args.chunk_size:
+                flush()
+        flush()
+        if not args.dry_run:
+            save_checkpoint(checkpoint_path, last_line, stats)
+    finally:
+        if mirror:
+            mirror.close()
+        conn.close()
+
+    elapsed = time.time() - started
+    stats["seconds"] = round(elapsed, 2)
+    stats["rows_per_second"] = round(stats["granted"] / elapsed, 1) if elapsed else None
+    print(json.dumps(stats), file=sys.stderr)
+    return 0 if not stats["errors"] else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,47 @@
+"""Production gunicorn settings.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master (preload) so its pure-Python modules
+are shared copy-on-write between workers; the Firestore gRPC client, HTTP
+connections and background threads are created per worker in post_fork.
+"""
+import gc
+import multiprocessing
+import os
+
+# Read by app.py at import: leave client creation and thread start-up to post_fork
+os.environ["APP_DEFER_RUNTIME"] = "1"
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+
+# Requests mostly wait on Firestore, PayPal and Paddle, so threads carry the concurrency.
+# Every worker keeps its own listener cache, SQLite writer and Firestore channel, which
+# is why the worker count stays close to the core count instead of 2 * cores + 1.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", str(max(1, min(multiprocessing.cpu_count(), 4)))))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# Longer than the slowest per-route request deadline (deadlines.py)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = 20
+keepalive = 5
+
+# app.py writes its own JSON access line per request (sampled per route, with upstream timings)
+accesslog = None
+errorlog = "-"
+
+
+def when_ready(server):
+    # Objects allocated while preloading are never collected; freezing them keeps the
+    # collector from writing to (and un-sharing) their pages in every worker
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import start_runtime
+
+    start_runtime()
@@ -0,0 +1,77 @@
+import time
+
+# Columns check-license needs from the license row an identity points at
+LICENSE_COLUMNS = ("is_premium", "status", "expiration_date", "trial_end_date", "method", "subscription_id")
+
+
+def init_table(conn):
+    # synced_at is set once the uid's license state is known locally: written by us,
+    # read back from Firestore, or streamed in by the license listeners
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS identities (
+            uid TEXT PRIMARY KEY,
+            email TEXT NOT NULL,
+            synced_at REAL,
+            updated_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_identities_email ON identities (email)")
+
+
+def norm_email(email):
+    return email.strip().lower() if isinstance(email, str) else None
+
+
+LINK_SQL = """
+    INSERT INTO identities (uid, email, synced_at, updated_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT(uid) DO UPDATE SET
+        synced_at = CASE
+            WHEN excluded.synced_at IS NOT NULL THEN excluded.synced_at
+            WHEN identities.email = excluded.email THEN identities.synced_at
+            ELSE NULL
+        END,
+        email = excluded.email,
+        updated_at = excluded.updated_at
+"""
+
+
+def link(cursor, uid, email, synced=False):
+    """Maps uid <-> normalized email; synced=True marks the license state as locally known.
+
+    Linking a uid to a different email without synced drops the mark, so the
+    next check goes back to Firestore.
+    """
+    email = norm_email(email)
+    if not uid or not email:
+        return
+    now = time.time()
+    cursor.execute(LINK_SQL, (uid, email, now if synced else None, now))
+
+
+def link_many(cursor, pairs, synced=False):
+    now = time.time()
+    rows = [(uid, norm_email(email), now if synced else None, now) for uid, email in pairs if uid and norm_email(email)]
+    cursor.executemany(LINK_SQL, rows)
+    return len(rows)
+
+
+def local_license(conn, uid, email_norm, synced_after=0.0):
+    """License row for an identity with this email synced after synced_after; () when it has none, None on a miss"""
+    row = conn.execute(
+        f"""
+        SELECT i.email, l.email, {", ".join("l." + c for c in LICENSE_COLUMNS)}
+        FROM identities i LEFT JOIN licenses l ON l.email = i.email
+        WHERE i.uid = ? AND i.synced_at IS NOT NULL AND i.synced_at >= ?
+        """,
+        (uid, synced_after),
+    ).fetchone()
+    if row is None or row[0] != email_norm:
+        return None
+    return tuple(row[2:]) if row[1] is not None else ()
+
+
+def unsync(cursor, uids=(), emails=()):
+    """Drops the synced mark for these uids/emails: another instance changed their license"""
+    uids, emails = list(uids), list(emails)
+    cursor.executemany("UPDATE identities SET synced_at = NULL WHERE uid = ? AND synced_at IS NOT NULL", [(u,) for u in uids])
+    cursor.executemany("UPDATE identities SET synced_at = NULL WHERE email = ? AND synced_at IS NOT NULL", [(e,) for e in emails])
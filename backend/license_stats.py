@@ -0,0 +1,177 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# The triggers keep the counts exact; the recount only repairs drift (e.g. rows edited with triggers missing)
+RECOUNT_SECONDS = float(os.getenv("LICENSE_STATS_RECOUNT_SECONDS", "3600"))
+# Statuses exported as gauges; any other status still shows up in /admin/stats
+GAUGE_STATUSES = ("trialing", "active", "past_due", "canceled", "expired_trial", "free")
+
+# NULL status/method are counted as 'free' / 'none'
+_STATUS = "COALESCE({0}.status, 'free')"
+_METHOD = "COALESCE({0}.method, 'none')"
+
+
+def _bump(row, delta):
+    return f"""
+        INSERT INTO license_stats (status, method, count) VALUES ({_STATUS.format(row)}, {_METHOD.format(row)}, {delta})
+        ON CONFLICT(status, method) DO UPDATE SET count = count + ({delta});
+    """
+
+
+def init_table(conn):
+    """Counter table plus the triggers that maintain it from every write to licenses"""
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'license_stats'"
+    ).fetchone() is None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS license_stats (
+            status TEXT NOT NULL,
+            method TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (status, method)
+        )
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS license_stats_insert AFTER INSERT ON licenses
+        BEGIN {_bump("NEW", 1)} END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS license_stats_update AFTER UPDATE OF status, method ON licenses
+        WHEN {_STATUS.format("OLD")} != {_STATUS.format("NEW")} OR {_METHOD.format("OLD")} != {_METHOD.format("NEW")}
+        BEGIN {_bump("OLD", -1)} {_bump("NEW", 1)} END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS license_stats_delete AFTER DELETE ON licenses
+        BEGIN {_bump("OLD", -1)} END
+    """)
+    if created:
+        recount(conn)
+
+
+def recount(cursor):
+    """Replaces the counters with a full GROUP BY over licenses; returns how many rows were off"""
+    actual = {
+        (status, method): count
+        for status, method, count in cursor.execute(
+            f"SELECT {_STATUS.format('licenses')}, {_METHOD.format('licenses')}, COUNT(*) FROM licenses GROUP BY 1, 2"
+        )
+    }
+    stored = {(status, method): count for status, method, count in cursor.execute("SELECT status, method, count FROM license_stats")}
+    drift = sum(abs(actual.get(k, 0) - stored.get(k, 0)) for k in set(actual) | set(stored))
+    if drift:
+        cursor.execute("DELETE FROM license_stats")
+        cursor.executemany(
+            "INSERT INTO license_stats (status, method, count) VALUES (?, ?, ?)",
+            [(s, m, c) for (s, m), c in actual.items()],
+        )
+    return drift
+
+
+def _cutoff(now):
+    # Stored dates come as '...T...Z', with or without fractions, or space-separated: compare the first 19 chars
+    return now.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def expire_lapsed(cursor, now=None):
+    """Writes the transitions check-license only computes on read: ended trials and lapsed paid periods.
+
+    Same rules as licensing.revalidate_local, so answers don't change; the
+    triggers then move the rows between counters. Returns rows changed.
+    """
+    cutoff = _cutoff(now or datetime.now(timezone.utc))
+    trials = cursor.execute(
+        """
+        UPDATE licenses SET is_premium=0, status='expired_trial'
+        WHERE status = 'trialing' AND trial_end_date IS NOT NULL
+          AND substr(replace(trial_end_date, 'T', ' '), 1, 19) < ?
+        """,
+        (cutoff,),
+    ).rowcount
+    paid = cursor.execute(
+        """
+        UPDATE licenses SET is_premium=0, status='past_due'
+        WHERE status = 'active' AND expiration_date IS NOT NULL
+          AND substr(replace(expiration_date, 'T', ' '), 1, 19) < ?
+        """,
+        (cutoff,),
+    ).rowcount
+    return trials + paid
+
+
+def read(conn):
+    """Counters as {status: {method: count}}; reads the small counter table, never licenses"""
+    out = {}
+    for status, method, count in conn.execute("SELECT status, method, count FROM license_stats WHERE count != 0"):
+        out.setdefault(status, {})[method] = count
+    return out
+
+
+class LicenseStats:
+    """Serves the counters and periodically expires lapsed rows and recounts through the writer"""
+
+    def __init__(self, db_name, writer, recount_seconds=RECOUNT_SECONDS):
+        self.db_name = db_name
+        self.writer = writer
+        self.recount_seconds = recount_seconds
+        self.last_recount_at = None
+        self._thread = None
+        for status in GAUGE_STATUSES:
+            metrics.gauge_fn("licenses", lambda s=status: self.count(s), status=status)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_name, timeout=10)
+
+    def count(self, status):
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(SUM(count), 0) FROM license_stats WHERE status = ?", (status,)).fetchone()[0]
+
+    def snapshot(self):
+        with self._connect() as conn:
+            by_status_method = read(conn)
+        by_method = {}
+        for methods in by_status_method.values():
+            for method, count in methods.items():
+                by_method[method] = by_method.get(method, 0) + count
+        return {
+            "total": sum(by_method.values()),
+            "by_status": {status: sum(methods.values()) for status, methods in by_status_method.items()},
+            "by_method": by_method,
+            "by_status_method": by_status_method,
+            "last_recount_at": self.last_recount_at,
+        }
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="license-stats", daemon=True)
+        self._thread.start()
+
+    def refresh(self):
+        """Expires lapsed rows and repairs drift; returns (expired, drift)"""
+        def job(cursor):
+            return expire_lapsed(cursor), recount(cursor)
+
+        expired, drift = self.writer.execute(job)
+        self.last_recount_at = time.time()
+        if expired:
+            metrics.inc("license_stats_expired", expired)
+        if drift:
+            metrics.inc("license_stats_drift", drift)
+            log.warning("License stats: corrected a drift of %d rows", drift)
+        return expired, drift
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error("License stats refresh error: %s", e)
+            time.sleep(self.recount_seconds)
@@ -0,0 +1,298 @@
+"""Signed license tokens the extension can verify offline.
+
+Tokens are compact ES256 JWS (JWT) strings signed with a P-256 key from the
+keyring. Public keys are published as a JWKS on /license-keys; the extension
+verifies the token locally and only calls /check-license again when it is
+close to `exp`.
+
+Every instance must sign with the same keys, so they come from
+LICENSE_TOKEN_KEYS or a keys file shared by all of them. Without either no
+tokens are issued; LICENSE_TOKEN_KEYS_AUTOCREATE=1 lets a development
+instance generate its own keys file.
+
+    python license_tokens.py rotate       # add a new signing key, keep the previous ones for verification
+    python license_tokens.py jwks         # print the public keys
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature, encode_dss_signature
+from dotenv import load_dotenv
+
+from licensing import as_utc
+
+log = logging.getLogger(__name__)
+
+ISSUER = "smart-audio-eq"
+TOKEN_TTL_SECONDS = int(os.getenv("LICENSE_TOKEN_TTL_SECONDS", str(6 * 3600)))
+KEYS_FILE = os.getenv("LICENSE_TOKEN_KEYS_FILE", "license_keys.json")
+# Only for development: a key generated on local disk is unknown to every other instance
+AUTOCREATE = os.getenv("LICENSE_TOKEN_KEYS_AUTOCREATE", "0") == "1"
+# How long clients may cache /license-keys; a rotated key only signs once every cached copy has it
+JWKS_MAX_AGE_SECONDS = 3600
+# Retired keys stay published long enough for every token they signed to expire
+KEEP_PREVIOUS_KEYS = 2
+RELOAD_CHECK_SECONDS = 60
+
+
+class TokenError(ValueError):
+    pass
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def b64url_decode(value):
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def email_hash(email_norm):
+    """Lets the client match the token to its signed-in email without exposing it"""
+    return b64url(hashlib.sha256((email_norm or "").encode("utf-8")).digest()[:16])
+
+
+def new_key_entry(active_at=None):
+    key = ec.generate_private_key(ec.SECP256R1())
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode("ascii")
+    now = int(time.time())
+    return {"kid": uuid.uuid4().hex[:16], "created": now, "active_at": int(active_at or now), "pem": pem}
+
+
+def _active_at(entry):
+    return entry.get("active_at", entry.get("created", 0))
+
+
+def public_jwk(kid, public_key):
+    numbers = public_key.public_numbers()
+    return {
+        "kty": "EC",
+        "crv": "P-256",
+        "alg": "ES256",
+        "use": "sig",
+        "kid": kid,
+        "x": b64url(numbers.x.to_bytes(32, "big")),
+        "y": b64url(numbers.y.to_bytes(32, "big")),
+    }
+
+
+class Keyring:
+    """Signing keys, newest first. Loaded from LICENSE_TOKEN_KEYS (JSON) or the keys file.
+
+    A key is published as soon as it is in the keyring but only signs from its
+    active_at on, so clients holding a cached JWKS can verify its tokens.
+    """
+
+    def __init__(self, path=KEYS_FILE, autocreate=AUTOCREATE):
+        self.path = path
+        self.autocreate = autocreate
+        self._lock = threading.Lock()
+        self._keys = []
+        self._mtime = None
+        self._checked_at = 0.0
+
+    def _load_entries(self):
+        env = os.getenv("LICENSE_TOKEN_KEYS")
+        if env:
+            return json.loads(env)
+        with open(self.path) as f:
+            return json.load(f)
+
+    def _write(self, entries, exclusive=False):
+        # The file only ever appears complete: readers in other workers never see a partial write
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(entries, f)
+        os.chmod(tmp, 0o600)
+        try:
+            if exclusive:
+                # Fails if another worker got there first, so all of them end up on its key
+                os.link(tmp, self.path)
+            else:
+                os.replace(tmp, self.path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _create_file(self):
+        try:
+            self._write([new_key_entry()], exclusive=True)
+        except FileExistsError:
+            return
+        log.warning("License token keyring created at %s; other instances won't accept its tokens", self.path)
+
+    def _refresh(self):
+        now = time.time()
+        if self._checked_at and now - self._checked_at < RELOAD_CHECK_SECONDS:
+            return
+        self._checked_at = now
+        from_env = bool(os.getenv("LICENSE_TOKEN_KEYS"))
+        if not from_env and not os.path.exists(self.path):
+            if not self.autocreate:
+                self._keys, self._mtime = [], None
+                return
+            self._create_file()
+        mtime = None if from_env else os.path.getmtime(self.path)
+        if self._keys and mtime == self._mtime:
+            return
+        entries = sorted(self._load_entries(), key=lambda e: e.get("created", 0), reverse=True)
+        self._keys = [
+            (e["kid"], serialization.load_pem_private_key(e["pem"].encode("ascii"), password=None), _active_at(e))
+            for e in entries
+        ]
+        self._mtime = mtime
+
+    def available(self):
+        """False when no keys are configured; no tokens are issued then"""
+        with self._lock:
+            self._refresh()
+            return bool(self._keys)
+
+    def signing_key(self):
+        """(kid, key) of the newest key already active"""
+        now = time.time()
+        with self._lock:
+            self._refresh()
+            if not self._keys:
+                raise TokenError("no license token keys configured")
+            active = [(kid, key) for kid, key, active_at in self._keys if active_at <= now]
+            # Every key still pending (clock skew, hand-edited keyring): the oldest one has been published longest
+            return active[0] if active else self._keys[-1][:2]
+
+    def public_key(self, kid):
+        with self._lock:
+            self._refresh()
+            for key_id, key, _ in self._keys:
+                if key_id == kid:
+                    return key.public_key()
+        return None
+
+    def jwks(self):
+        with self._lock:
+            self._refresh()
+            return {"keys": [public_jwk(kid, key.public_key()) for kid, key, _ in self._keys]}
+
+    def rotate(self, delay=JWKS_MAX_AGE_SECONDS):
+        """Adds a key that starts signing after delay seconds and drops keys beyond the retention window.
+
+        Keys not active yet are always kept, plus the KEEP_PREVIOUS_KEYS newest
+        active ones. Returns (new entry, keyring entries). With LICENSE_TOKEN_KEYS
+        set nothing is written; the caller has to publish the returned entries to
+        that variable.
+        """
+        with self._lock:
+            now = time.time()
+            from_env = bool(os.getenv("LICENSE_TOKEN_KEYS"))
+            entries = self._load_entries() if from_env or os.path.exists(self.path) else []
+            entries = sorted(entries, key=lambda e: e.get("created", 0), reverse=True)
+            pending = [e for e in entries if _active_at(e) > now]
+            active = [e for e in entries if _active_at(e) <= now]
+            # The first key of a keyring has no cached JWKS to wait for
+            entry = new_key_entry(now + delay if entries else now)
+            entries = [entry] + pending + active[:KEEP_PREVIOUS_KEYS]
+            if not from_env:
+                self._write(entries)
+            self._checked_at = 0.0
+            return entry, entries
+
+
+keyring = Keyring()
+
+
+def _sign(signing_input, key):
+    der = key.sign(signing_input, ec.ECDSA(hashes.SHA256()))
+    r, s = decode_dss_signature(der)
+    return r.to_bytes(32, "big") + s.to_bytes(32, "big")
+
+
+def mint(uid, email_norm, verdict, now=None, ring=None):
+    """Signs the check-license verdict; valid for TOKEN_TTL_SECONDS or until the license ends"""
+    ring = ring or keyring
+    now = int(now or time.time())
+    kid, key = ring.signing_key()
+
+    ends = as_utc(verdict.get("trial_end") if verdict.get("status") == "trialing" else verdict.get("expiration"))
+    license_end = int(ends.timestamp()) if ends else None
+    exp = now + TOKEN_TTL_SECONDS
+    if verdict.get("premium") and license_end and license_end > now:
+        exp = min(exp, license_end)
+
+    header = {"alg": "ES256", "typ": "JWT", "kid": kid}
+    payload = {
+        "iss": ISSUER,
+        "sub": uid or None,
+        "eh": email_hash(email_norm),
+        "prem": bool(verdict.get("premium")),
+        "st": verdict.get("status") or "free",
+        "lexp": license_end,
+        "iat": now,
+        "exp": exp,
+    }
+    signing_input = (
+        b64url(json.dumps(header, separators=(",", ":")).encode())
+        + "."
+        + b64url(json.dumps(payload, separators=(",", ":")).encode())
+    )
+    return signing_input + "." + b64url(_sign(signing_input.encode("ascii"), key))
+
+
+def verify(token, now=None, ring=None):
+    """Returns the payload of a valid, unexpired token or raises TokenError"""
+    ring = ring or keyring
+    try:
+        header_b64, payload_b64, sig_b64 = token.split(".")
+        header = json.loads(b64url_decode(header_b64))
+        payload = json.loads(b64url_decode(payload_b64))
+        sig = b64url_decode(sig_b64)
+    except Exception:
+        raise TokenError("malformed token")
+    if header.get("alg") != "ES256" or len(sig) != 64:
+        raise TokenError("unsupported token")
+    public_key = ring.public_key(header.get("kid"))
+    if public_key is None:
+        raise TokenError("unknown key")
+    der = encode_dss_signature(int.from_bytes(sig[:32], "big"), int.from_bytes(sig[32:], "big"))
+    try:
+        public_key.verify(der, f"{header_b64}.{payload_b64}".encode("ascii"), ec.ECDSA(hashes.SHA256()))
+    except InvalidSignature:
+        raise TokenError("bad signature")
+    if payload.get("iss") != ISSUER or payload.get("exp", 0) < (now or time.time()):
+        raise TokenError("expired token")
+    return payload
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else "jwks"
+    load_dotenv()
+    if command == "rotate":
+        entry, entries = keyring.rotate()
+        if os.getenv("LICENSE_TOKEN_KEYS"):
+            print("LICENSE_TOKEN_KEYS is set; replace it with:", file=sys.stderr)
+            print(json.dumps(entries))
+        active_at = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(entry["active_at"]))
+        print(f"New signing key: {entry['kid']} (published now, signs from {active_at})", file=sys.stderr)
+    elif command == "jwks":
+        print(json.dumps(keyring.jwks(), indent=2))
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,381 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from metrics import metrics
+import identities
+from licensing import LICENSE_FIELDS, license_fields, resolve_license, to_iso_z
+
+log = logging.getLogger(__name__)
+
+# How long the cache may keep answering after its listeners lost the stream
+MAX_STALENESS_SECONDS = float(os.getenv("LICENSE_CACHE_MAX_STALENESS_SECONDS", "30"))
+SUPERVISE_SECONDS = 1.0
+RESUBSCRIBE_BACKOFF_MAX_SECONDS = 60.0
+# One watcher per instance: the worker holding the lease listens, the others read what it writes to SQLite
+LEASE_SECONDS = 30
+HEARTBEAT_SECONDS = 5.0
+# Without a heartbeat for this long the watcher counts as down in every worker
+FRESH_TTL_SECONDS = 15.0
+STATE_CHECK_SECONDS = 1.0
+
+WATCHED_COLLECTIONS = ("usuarios", "licenses_by_email")
+
+
+def init_table(conn):
+    # Written by the lease holder: until when its listeners are known to be current
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS license_watch_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            owner TEXT,
+            fresh_until REAL NOT NULL DEFAULT 0
+        )
+    """)
+
+
+def _norm(email):
+    return (email or "").strip().lower()
+
+
+class _Listener:
+    __slots__ = ("collection", "watch", "docs", "loaded", "connected_at", "down_since", "failures", "retry_at")
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.watch = None
+        self.docs = {}
+        self.loaded = False
+        self.connected_at = None
+        self.down_since = time.monotonic()
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class LicenseWatcher:
+    """Mirrors license-bearing usuarios and licenses_by_email docs through Firestore snapshot listeners.
+
+    Only docs with isPremium set are watched, projected to the license fields.
+    One worker per instance (the holder of the license_watch lease) listens and
+    streams changes into the SQLite licenses and identities tables, where
+    check-license in every worker reads them. A doc that leaves the watched set
+    drops the synced mark of its identities, so their next check reads
+    Firestore. A listener whose stream dies is resubscribed; the watcher stops
+    counting as fresh once it has been disconnected for longer than
+    MAX_STALENESS_SECONDS.
+    """
+
+    def __init__(self, db, db_name, writer, max_staleness=MAX_STALENESS_SECONDS):
+        self.db = db
+        self.db_name = db_name
+        self.writer = writer
+        self.max_staleness = max_staleness
+        self.owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._listeners = {c: _Listener(c) for c in WATCHED_COLLECTIONS}
+        # email -> uids of the usuarios docs carrying it
+        self._uids_by_email = {}
+        self._leading = False
+        # Local rows that went unwatched while no worker was listening have been unsynced
+        self._swept = False
+        self._heartbeat_at = 0.0
+        self._fresh_until = 0.0
+        self._state_checked_at = 0.0
+        self._thread = None
+        metrics.gauge_fn("license_watch_leader", lambda: int(self._leading))
+        for collection in WATCHED_COLLECTIONS:
+            metrics.gauge_fn("firestore_listener_connected", lambda c=collection: int(self._is_live(self._listeners[c])), collection=collection)
+            metrics.gauge_fn("license_cache_docs", lambda c=collection: len(self._listeners[c].docs), collection=collection)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_name, timeout=10)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._supervise, name="license-watch", daemon=True)
+        self._thread.start()
+
+    def fresh(self):
+        """True while the instance's watcher has every listener loaded and none down for longer than allowed"""
+        now = time.time()
+        if now - self._state_checked_at >= STATE_CHECK_SECONDS:
+            self._state_checked_at = now
+            try:
+                with self._connect() as conn:
+                    row = conn.execute("SELECT fresh_until FROM license_watch_state WHERE id = 1").fetchone()
+                self._fresh_until = row[0] if row else 0.0
+            except sqlite3.Error as e:
+                log.warning("License watcher state unreadable: %s", e)
+                self._fresh_until = 0.0
+        return self._fresh_until > now
+
+    def wait_fresh(self, timeout=10.0):
+        """Blocks until the instance's watcher has loaded (warm-up)"""
+        deadline = time.monotonic() + timeout
+        while not self.fresh():
+            if time.monotonic() > deadline:
+                raise TimeoutError("license listeners have not loaded yet")
+            time.sleep(0.1)
+
+    def _listening_fresh(self, now):
+        with self._lock:
+            for listener in self._listeners.values():
+                if not listener.loaded:
+                    return False
+                if listener.down_since is not None and now - listener.down_since > self.max_staleness:
+                    return False
+        return self._swept
+
+    def _is_live(self, listener):
+        watch = listener.watch
+        return bool(watch is not None and listener.loaded and not getattr(watch, "_closed", False) and getattr(watch, "is_active", True))
+
+    def _supervise(self):
+        while True:
+            now = time.monotonic()
+            try:
+                if now - self._heartbeat_at >= HEARTBEAT_SECONDS:
+                    self._heartbeat(now)
+            except Exception as e:
+                log.error("License watcher lease error: %s", e)
+            if self._leading:
+                for listener in self._listeners.values():
+                    try:
+                        self._check(listener, now)
+                    except Exception as e:
+                        log.error("License watcher (%s) error: %s", listener.collection, e)
+                if not self._swept and all(l.loaded for l in self._listeners.values()):
+                    self._sweep()
+                # Publish a change of freshness without waiting for the next heartbeat
+                if self._listening_fresh(now) != (self._fresh_until > time.time()):
+                    self._heartbeat_at = 0.0
+            time.sleep(SUPERVISE_SECONDS)
+
+    def _heartbeat(self, now):
+        """Takes or renews the lease and, holding it, publishes whether the listeners are current"""
+        self._heartbeat_at = now
+        wall = time.time()
+        fresh = self._leading and self._listening_fresh(now)
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO worker_leases (name, owner, expires_at) VALUES ('license_watch', NULL, 0)")
+            held = conn.execute(
+                """
+                UPDATE worker_leases SET owner = ?, expires_at = ?
+                WHERE name = 'license_watch' AND (owner = ? OR expires_at < ?)
+                """,
+                (self.owner, wall + LEASE_SECONDS, self.owner, wall),
+            ).rowcount == 1
+            if held:
+                conn.execute(
+                    "INSERT OR REPLACE INTO license_watch_state (id, owner, fresh_until) VALUES (1, ?, ?)",
+                    (self.owner, wall + FRESH_TTL_SECONDS if fresh else 0.0),
+                )
+        if held:
+            self._fresh_until, self._state_checked_at = (wall + FRESH_TTL_SECONDS if fresh else 0.0), wall
+        if held and not self._leading:
+            log.info("License watcher: listening for this instance")
+        elif self._leading and not held:
+            log.warning("License watcher: lease lost, stopping listeners")
+            self._stop()
+        self._leading = held
+
+    def _stop(self):
+        with self._lock:
+            for collection, listener in list(self._listeners.items()):
+                if listener.watch is not None:
+                    try:
+                        listener.watch.unsubscribe()
+                    except Exception as e:
+                        log.warning("License watcher: unsubscribing %s failed: %s", listener.collection, e)
+                self._listeners[collection] = _Listener(collection)
+            self._uids_by_email = {}
+            self._swept = False
+
+    def _check(self, listener, now):
+        if self._is_live(listener):
+            with self._lock:
+                listener.down_since = None
+            return
+        with self._lock:
+            if listener.down_since is None:
+                listener.down_since = now
+        watch = listener.watch
+        # Transient stream errors are retried inside the Watch; only a closed one needs a new subscription
+        if watch is not None and not getattr(watch, "_closed", False):
+            return
+        if now < listener.retry_at:
+            return
+        if watch is not None:
+            metrics.inc("firestore_listener_reconnects", collection=listener.collection)
+            log.warning("License watcher: %s listener closed, resubscribing", listener.collection)
+        self._subscribe(listener, now)
+
+    def _query(self, collection):
+        # Only license-bearing docs, and only their license fields
+        return self.db.collection(collection).where("isPremium", "==", True).select(list(LICENSE_FIELDS))
+
+    def _subscribe(self, listener, now):
+        with self._lock:
+            listener.loaded = False
+        try:
+            listener.watch = self._query(listener.collection).on_snapshot(
+                lambda docs, changes, read_time: self._on_snapshot(listener, docs, changes, read_time)
+            )
+            listener.failures = 0
+            listener.connected_at = now
+        except Exception as e:
+            listener.watch = None
+            listener.failures += 1
+            listener.retry_at = now + min(RESUBSCRIBE_BACKOFF_MAX_SECONDS, 2 ** listener.failures)
+            log.warning("License watcher: subscribing to %s failed: %s", listener.collection, e)
+
+    def _on_snapshot(self, listener, docs, changes, read_time):
+        if self._listeners.get(listener.collection) is not listener:
+            return  # stopped since
+        try:
+            self._apply(listener, docs, changes, read_time)
+        except Exception as e:
+            log.error("License watcher (%s) snapshot error: %s", listener.collection, e)
+
+    def _apply(self, listener, docs, changes, read_time):
+        now = datetime.now(timezone.utc)
+        usuarios = listener.collection == "usuarios"
+        touched = set()
+        # Docs that left the watched set: their local state can't be vouched for anymore
+        dropped = set()
+
+        with self._lock:
+            if not listener.loaded:
+                # First snapshot of a subscription is the full watched set: replace what we had
+                changed = [(snap.id, license_fields(snap.to_dict() or {})) for snap in docs]
+                removed = set(listener.docs) - {doc_id for doc_id, _ in changed}
+            else:
+                changed, removed = [], set()
+                for change in changes:
+                    snap = change.document
+                    if getattr(change.type, "name", change.type) == "REMOVED":
+                        removed.add(snap.id)
+                    else:
+                        changed.append((snap.id, license_fields(snap.to_dict() or {})))
+                    updated = getattr(snap, "update_time", None) or read_time
+                    if updated is not None:
+                        metrics.observe("firestore_listener_lag_seconds", max(0.0, (now - updated).total_seconds()), collection=listener.collection)
+
+            for doc_id in removed:
+                old = listener.docs.pop(doc_id, None)
+                dropped.add(doc_id)
+                if usuarios and old is not None:
+                    touched.add(self._unindex(doc_id, old))
+                elif not usuarios:
+                    touched.add(doc_id)
+            for doc_id, fields in changed:
+                old = listener.docs.get(doc_id)
+                if old == fields:
+                    continue
+                listener.docs[doc_id] = fields
+                if usuarios:
+                    if old is not None:
+                        touched.add(self._unindex(doc_id, old))
+                    email = _norm(fields.get("email"))
+                    if email:
+                        self._uids_by_email.setdefault(email, set()).add(doc_id)
+                    touched.add(email)
+                else:
+                    touched.add(doc_id)
+            listener.loaded = True
+            listener.down_since = None
+            rows = self._rows_for({e for e in touched if e}, now)
+
+        metrics.inc("license_cache_changes", len(changed) + len(removed), collection=listener.collection)
+        if rows or dropped:
+            uids, emails = (dropped, ()) if usuarios else ((), dropped)
+            self.writer.submit(lambda cursor: self._write_rows(cursor, rows, uids, emails))
+
+    def _sweep(self):
+        """Unsyncs local premium rows nobody watched: they may have changed while no worker was listening"""
+        with self._lock:
+            watched = set(self._uids_by_email) | set(self._listeners["licenses_by_email"].docs)
+            self._swept = True
+
+        def job(cursor):
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS license_watch_emails (email TEXT PRIMARY KEY)")
+            cursor.execute("DELETE FROM license_watch_emails")
+            cursor.executemany("INSERT OR IGNORE INTO license_watch_emails (email) VALUES (?)", [(e,) for e in watched])
+            # Our own writes that haven't replicated yet aren't in the watched set either
+            unsynced = cursor.execute("""
+                UPDATE identities SET synced_at = NULL
+                WHERE synced_at IS NOT NULL
+                  AND email IN (SELECT email FROM licenses WHERE is_premium = 1)
+                  AND email NOT IN (SELECT email FROM license_watch_emails)
+                  AND email NOT IN (SELECT doc_id FROM firestore_outbox)
+                  AND uid NOT IN (SELECT doc_id FROM firestore_outbox)
+            """).rowcount
+            cursor.execute("DELETE FROM license_watch_emails")
+            return unsynced
+
+        unsynced = self.writer.execute(job, timeout=60)
+        log.info("License watcher: %d watched emails, %d unwatched identities unsynced", len(watched), unsynced)
+
+    def _unindex(self, uid, old):
+        email = _norm(old.get("email"))
+        uids = self._uids_by_email.get(email)
+        if uids:
+            uids.discard(uid)
+            if not uids:
+                del self._uids_by_email[email]
+        return email
+
+    def _rows_for(self, emails, now):
+        """SQLite cache rows for the given emails; called with the lock held"""
+        lookup = lambda e: self._listeners["licenses_by_email"].docs.get(e)
+        users = self._listeners["usuarios"].docs
+        rows = []
+        for email in emails:
+            uids = sorted(self._uids_by_email.get(email, ()))
+            verdicts = [resolve_license(users[uid], lookup, email, now) for uid in uids]
+            if not verdicts and lookup(email) is not None:
+                verdicts = [resolve_license({}, lookup, email, now)]
+            if not verdicts:
+                continue
+            # Several accounts may share an email: any premium one wins, same as check-license would answer
+            verdict = next((v for v in verdicts if v["premium"]), verdicts[0])
+            rows.append((email, uids, verdict))
+        return rows
+
+    def _write_rows(self, cursor, rows, dropped_uids=(), dropped_emails=()):
+        identities.unsync(cursor, dropped_uids, dropped_emails)
+        for email, uids, v in rows:
+            # Our own writes that haven't replicated yet are newer than what the listener saw
+            keys = [email] + uids
+            pending = cursor.execute(
+                f"SELECT 1 FROM firestore_outbox WHERE doc_id IN ({','.join('?' * len(keys))}) LIMIT 1", keys
+            ).fetchone()
+            if pending:
+                continue
+            identities.link_many(cursor, [(uid, email) for uid in uids], synced=True)
+            if not v["premium"]:
+                cursor.execute(
+                    "UPDATE licenses SET is_premium=0, status='free', method=NULL, trial_end_date=NULL, expiration_date=NULL WHERE email=? AND is_premium=1",
+                    (email,),
+                )
+                continue
+            cursor.execute("""
+                INSERT INTO licenses (email, is_premium, status, expiration_date, trial_end_date, method, subscription_id)
+                VALUES (?, 1, ?, ?, ?, ?, ?)
+                ON CONFLICT(email) DO UPDATE SET
+                    is_premium=1,
+                    status=excluded.status,
+                    expiration_date=excluded.expiration_date,
+                    trial_end_date=excluded.trial_end_date,
+                    method=excluded.method,
+                    subscription_id=COALESCE(excluded.subscription_id, licenses.subscription_id)
+                WHERE licenses.is_premium IS NOT 1
+                   OR licenses.status IS NOT excluded.status
+                   OR licenses.expiration_date IS NOT excluded.expiration_date
+                   OR licenses.trial_end_date IS NOT excluded.trial_end_date
+                   OR licenses.method IS NOT excluded.method
+            """, (email, v["status"], to_iso_z(v["expiration"]), to_iso_z(v["trial_end"]), v["method"], v["subscription_id"]))
@@ -0,0 +1,160 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+log = logging.getLogger(__name__)
+
+# Statuses that grant premium access
+PREMIUM_STATUSES = ("trialing", "active")
+
+TRIAL_DAYS = 3
+# Paid periods include a day of grace over the billing interval
+PLAN_DAYS = {"monthly": 31, "yearly": 366}
+
+# Only what a license verdict needs; caches keep just these fields of usuarios/licenses_by_email docs
+LICENSE_FIELDS = ("email", "isPremium", "status", "method", "expirationDate", "trialEndDate", "subscriptionId", "usedTrial")
+
+PADDLE_YEARLY_PRICE_ID = "pri_01kk2mxf0828y5x7p8bky7ch47"
+PADDLE_MONTHLY_PRICE_ID = "pri_01kk2mvgj2pmjfh0pkjatsv8bf"
+
+
+def as_utc(value):
+    """Normalizes Firestore Timestamps, datetimes and stored ISO strings to aware UTC"""
+    if not value:
+        return None
+    if hasattr(value, "to_datetime"):
+        value = value.to_datetime()  # Firestore returns aware UTC
+    elif isinstance(value, str):
+        try:
+            s = value.replace('T', ' ').replace('Z', '').split(".")[0].split("+")[0]
+            value = datetime.strptime(s, "%Y-%m-%d %H:%M:%S" if len(s) > 10 else "%Y-%m-%d")
+        except Exception:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if not value.tzinfo:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def license_fields(data):
+    return {k: data[k] for k in LICENSE_FIELDS if k in data}
+
+
+def to_iso_z(value):
+    """Formats a datetime the way SQLite rows and API responses store it"""
+    return value.isoformat().replace('+00:00', 'Z') if value else None
+
+
+def plan_expiration(plan_type, now=None):
+    """Expiration for a one-off purchase of the given plan"""
+    now = now or datetime.now(timezone.utc)
+    return now + timedelta(days=PLAN_DAYS.get(plan_type, PLAN_DAYS["monthly"]))
+
+
+def trial_end_from(now=None):
+    return (now or datetime.now(timezone.utc)) + timedelta(days=TRIAL_DAYS)
+
+
+def derive_status(status, is_premium, trial_end, exp_date, now=None):
+    """Re-validates a stored license against its dates.
+
+    A trial end date wins over the expiration date; without either the stored
+    values are kept. Returns (is_premium, status).
+    """
+    now = now or datetime.now(timezone.utc)
+    trial_end = as_utc(trial_end)
+    exp_date = as_utc(exp_date)
+    if trial_end:
+        if now > trial_end:
+            return False, 'expired_trial'
+        return True, 'trialing'
+    if exp_date:
+        if now > exp_date:
+            return False, 'past_due'
+        return True, 'active'
+    return bool(is_premium), status or 'free'
+
+
+def _parse_stored(value):
+    s = value.replace('T', ' ').replace('Z', '').split(".")[0]
+    return datetime.strptime(s, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+
+
+def revalidate_local(is_premium, status, trial_end_str, expiration_str, now=None):
+    """Re-checks a SQLite license row's status against its stored date strings.
+
+    Only trialing and active rows can lapse; an unparseable date keeps the
+    stored values. Returns (is_premium, status).
+    """
+    now = now or datetime.now(timezone.utc)
+    # Re-verify local status for trials
+    if status == 'trialing' and trial_end_str:
+        try:
+            if now > _parse_stored(trial_end_str):
+                return False, 'expired_trial'
+        except Exception as e:
+            log.warning("SQLite trial parse error: %s", e)
+    # Re-verify local status for active sub
+    elif status == 'active' and expiration_str:
+        try:
+            if now > _parse_stored(expiration_str):
+                return False, 'past_due'
+        except Exception as e:
+            log.warning("SQLite exp parse error: %s", e)
+    return is_premium, status
+
+
+def paddle_subscription_state(status):
+    """Maps a Paddle subscription status onto (is_premium, local status)"""
+    if status in PREMIUM_STATUSES:
+        return True, status
+    if status in ("past_due", "paused"):
+        return False, "past_due"
+    return False, "canceled"
+
+
+def paddle_plan_type(price_id):
+    return "yearly" if price_id == PADDLE_YEARLY_PRICE_ID else "monthly"
+
+
+def resolve_license(user, lookup_license, email_norm=None, now=None):
+    """Verdict for a usuarios doc, falling back to the licenses_by_email doc.
+
+    A license bought under another account with the same email lives in
+    licenses_by_email; lookup_license(email_norm) returns that doc (or None)
+    and is only called when the user doc itself isn't premium. email_norm
+    defaults to the doc's own email.
+    """
+    now = now or datetime.now(timezone.utc)
+    exp_date = as_utc(user.get('expirationDate'))
+    trial_end = as_utc(user.get('trialEndDate'))
+    is_premium, status = derive_status(user.get('status', 'free'), user.get('isPremium', False), trial_end, exp_date, now)
+    verdict = {
+        "premium": is_premium,
+        "status": status,
+        "method": user.get('method', 'Unknown'),
+        "trial_end": trial_end,
+        "expiration": exp_date,
+        "subscription_id": user.get('subscriptionId'),
+        "used_trial": bool(user.get('usedTrial', False) or trial_end),
+    }
+    email_norm = email_norm or (user.get('email') or '').strip().lower()
+    if is_premium or not email_norm:
+        return verdict
+
+    lic = lookup_license(email_norm) or {}
+    if lic.get('isPremium') is True:
+        lic_trial = as_utc(lic.get('trialEndDate'))
+        lic_exp = as_utc(lic.get('expirationDate'))
+        lic_premium, lic_status = derive_status(lic.get('status', 'active'), True, lic_trial, lic_exp, now)
+        if lic_premium:
+            verdict.update(
+                premium=True,
+                status=lic_status,
+                trial_end=lic_trial,
+                expiration=lic_exp,
+                method=lic.get('method', verdict["method"]),
+                subscription_id=lic.get('subscriptionId') or verdict["subscription_id"],
+                used_trial=verdict["used_trial"] or bool(lic.get('usedTrial', False) or lic_trial),
+            )
+    return verdict
@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# Number of recent observations kept per summary for percentile estimates
+SUMMARY_WINDOW = 1024
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items()))) if labels else (name, ())
+
+
+def _label_str(labels):
+    return ",".join(f"{k}={v}" for k, v in labels)
+
+
+class _Summary:
+    __slots__ = ("count", "total", "recent")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=SUMMARY_WINDOW)
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class Metrics:
+    """In-process counters, gauges and summaries, served as JSON by /metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._gauge_fns = {}
+        self._summaries = {}
+        self.started_at = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def gauge_fn(self, name, fn, **labels):
+        """Registers a callable evaluated each time a snapshot is taken"""
+        with self._lock:
+            self._gauge_fns[_key(name, labels)] = fn
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = _Summary()
+            summary.count += 1
+            summary.total += value
+            summary.recent.append(value)
+
+    def quantile(self, name, q, **labels):
+        with self._lock:
+            summary = self._summaries.get(_key(name, labels))
+            values = sorted(summary.recent) if summary else []
+        return _percentile(values, q)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            gauge_fns = dict(self._gauge_fns)
+            summaries = {k: (s.count, s.total, sorted(s.recent)) for k, s in self._summaries.items()}
+
+        for key, fn in gauge_fns.items():
+            try:
+                gauges[key] = fn()
+            except Exception as e:
+                gauges[key] = None
+                log.warning("Metrics gauge %s error: %s", key[0], e)
+
+        out = {"uptime_seconds": round(time.time() - self.started_at, 1), "counters": {}, "gauges": {}, "summaries": {}}
+        for (name, labels), value in counters.items():
+            out["counters"].setdefault(name, {})[_label_str(labels)] = value
+        for (name, labels), value in gauges.items():
+            out["gauges"].setdefault(name, {})[_label_str(labels)] = value
+        for (name, labels), (count, total, values) in summaries.items():
+            out["summaries"].setdefault(name, {})[_label_str(labels)] = {
+                "count": count,
+                "avg": round(total / count, 6) if count else None,
+                "p50": _percentile(values, 0.50),
+                "p95": _percentile(values, 0.95),
+                "p99": _percentile(values, 0.99),
+                "max": values[-1] if values else None,
+            }
+        return out
+
+
+metrics = Metrics()
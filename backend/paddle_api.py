@@ -0,0 +1,66 @@
+import json
+import os
+
+import upstream
+
+REQUEST_TIMEOUT = 20
+
+
+def paddle_base_url():
+    paddle_env = (os.getenv("PADDLE_ENV") or "production").lower()
+    return "https://sandbox-api.paddle.com" if paddle_env == "sandbox" else "https://api.paddle.com"
+
+
+def paddle_headers(api_key=None):
+    return {
+        "Authorization": f"Bearer {api_key or os.getenv('PADDLE_API_KEY')}",
+        "Accept": "application/json",
+        "Paddle-Version": "1",
+    }
+
+
+def iter_pages(path, params=None, api_key=None, per_page=200, session=None):
+    """Yields every entity of a Paddle list endpoint, following meta.pagination.next"""
+    http = session or upstream.paddle
+    headers = paddle_headers(api_key)
+    url = f"{paddle_base_url()}{path}"
+    query = {**(params or {}), "per_page": per_page}
+    while url:
+        resp = http.get(url, headers=headers, params=query, timeout=REQUEST_TIMEOUT)
+        if resp.status_code != 200:
+            raise RuntimeError(f"Paddle {path} returned {resp.status_code}: {resp.text[:300]}")
+        body = resp.json() or {}
+        for entity in body.get("data") or []:
+            yield entity
+        pagination = (body.get("meta") or {}).get("pagination") or {}
+        url = pagination.get("next") if pagination.get("has_more") else None
+        # The next link already carries the cursor and page size
+        query = None
+
+
+def webhook_fields(payload):
+    """Extracts (event_type, data, email, uid, price_id) from a Paddle notification.
+
+    custom_data may arrive as an object or as a JSON string; email and uid come
+    from it first, then from the customer fields Paddle includes.
+    """
+    event_type = payload.get("event_type") or payload.get("eventType")
+    data = payload.get("data") or {}
+
+    custom_data = data.get("custom_data") or data.get("customData") or {}
+    if isinstance(custom_data, str):
+        try:
+            custom_data = json.loads(custom_data)
+        except Exception:
+            custom_data = {}
+
+    email = (custom_data.get("email") or (data.get("customer") or {}).get("email") or data.get("customer_email"))
+    uid = (custom_data.get("uid") or custom_data.get("user_id") or custom_data.get("userId"))
+
+    price_id = None
+    for item in data.get("items") or []:
+        pinfo = item.get("price") or {}
+        price_id = item.get("price_id") or pinfo.get("id")
+        if price_id:
+            break
+    return event_type, data, email, uid, price_id
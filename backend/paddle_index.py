@@ -0,0 +1,165 @@
+"""Local index of Paddle customers and subscriptions.
+
+Maps normalized email -> customer_id -> subscription ids and statuses so
+cancel-subscription never has to search Paddle. The webhook keeps it current;
+a one-off backfill pages through the Paddle API for history that predates it.
+
+    python paddle_index.py backfill
+    python paddle_index.py lookup someone@example.com
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from licensing import PREMIUM_STATUSES
+from paddle_api import iter_pages
+
+SQLITE_CHUNK = 500
+
+
+def init_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS paddle_customers (
+            customer_id TEXT PRIMARY KEY,
+            email TEXT,
+            updated_at TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_paddle_customers_email ON paddle_customers (email)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS paddle_subscriptions (
+            subscription_id TEXT PRIMARY KEY,
+            customer_id TEXT,
+            status TEXT,
+            updated_at TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_paddle_subscriptions_customer ON paddle_subscriptions (customer_id)")
+
+
+def _norm(email):
+    return email.strip().lower() if isinstance(email, str) and email.strip() else None
+
+
+# Paddle's updated_at decides between two versions of an entity, so late or repeated deliveries never roll it back
+UPSERT_CUSTOMER = """
+    INSERT INTO paddle_customers (customer_id, email, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT(customer_id) DO UPDATE SET
+        email=COALESCE(excluded.email, paddle_customers.email),
+        updated_at=COALESCE(excluded.updated_at, paddle_customers.updated_at)
+    WHERE excluded.updated_at IS NULL OR paddle_customers.updated_at IS NULL OR excluded.updated_at >= paddle_customers.updated_at
+"""
+UPSERT_SUBSCRIPTION = """
+    INSERT INTO paddle_subscriptions (subscription_id, customer_id, status, updated_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT(subscription_id) DO UPDATE SET
+        customer_id=COALESCE(excluded.customer_id, paddle_subscriptions.customer_id),
+        status=COALESCE(excluded.status, paddle_subscriptions.status),
+        updated_at=COALESCE(excluded.updated_at, paddle_subscriptions.updated_at)
+    WHERE excluded.updated_at IS NULL OR paddle_subscriptions.updated_at IS NULL OR excluded.updated_at >= paddle_subscriptions.updated_at
+"""
+
+
+def record_event(cursor, event_type, data, email_norm=None):
+    """Indexes the ids a webhook carries; runs inside the webhook's SQLite transaction"""
+    updated_at = data.get("updated_at")
+    if event_type.startswith("customer."):
+        if data.get("id"):
+            cursor.execute(UPSERT_CUSTOMER, (data["id"], _norm(data.get("email")) or email_norm, updated_at))
+        return
+
+    customer_id = data.get("customer_id")
+    if customer_id:
+        # A transaction's updated_at says nothing about the customer entity
+        cursor.execute(UPSERT_CUSTOMER, (customer_id, email_norm, None))
+    if event_type.startswith("subscription.") and data.get("id"):
+        cursor.execute(UPSERT_SUBSCRIPTION, (data["id"], customer_id, data.get("status"), updated_at))
+    elif data.get("subscription_id"):
+        # Transactions link the subscription to its customer but don't carry its status
+        cursor.execute(UPSERT_SUBSCRIPTION, (data["subscription_id"], customer_id, None, None))
+
+
+def mark_canceled(cursor, subscription_id):
+    cursor.execute(
+        "UPDATE paddle_subscriptions SET status='canceled' WHERE subscription_id = ?",
+        (subscription_id,),
+    )
+
+
+def active_subscriptions(conn, email_norm):
+    """Active or trialing subscriptions of every Paddle customer with this email, newest first"""
+    return conn.execute(
+        f"""
+        SELECT s.subscription_id, s.status, s.customer_id FROM paddle_customers c
+        JOIN paddle_subscriptions s ON s.customer_id = c.customer_id
+        WHERE c.email = ? AND s.status IN ({",".join("?" * len(PREMIUM_STATUSES))})
+        ORDER BY s.updated_at DESC
+        """,
+        (email_norm, *PREMIUM_STATUSES),
+    ).fetchall()
+
+
+def backfill(db_name, api_key=None, per_page=200):
+    """Loads every customer and subscription from the Paddle API; returns (customers, subscriptions)"""
+    counts = {"customers": 0, "subscriptions": 0}
+
+    def load(path, sql, row):
+        with sqlite3.connect(db_name, timeout=30) as conn:
+            rows = []
+            for entity in iter_pages(path, api_key=api_key, per_page=per_page):
+                rows.append(row(entity))
+                if len(rows) >= SQLITE_CHUNK:
+                    conn.executemany(sql, rows)
+                    conn.commit()
+                    counts[path.strip("/")] += len(rows)
+                    rows = []
+            conn.executemany(sql, rows)
+            counts[path.strip("/")] += len(rows)
+
+    load("/customers", UPSERT_CUSTOMER, lambda c: (c.get("id"), _norm(c.get("email")), c.get("updated_at")))
+    load(
+        "/subscriptions",
+        UPSERT_SUBSCRIPTION,
+        lambda s: (s.get("id"), s.get("customer_id"), s.get("status"), s.get("updated_at")),
+    )
+    return counts["customers"], counts["subscriptions"]
+
+
+def main(argv=None):
+    # storage creates these tables, so it can only be imported once this module is loaded
+    from storage import DB_NAME, init_db
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    fill = sub.add_parser("backfill", help="Load all customers and subscriptions from the Paddle API")
+    fill.add_argument("--db", default=DB_NAME)
+    fill.add_argument("--page-size", type=int, default=200)
+    look = sub.add_parser("lookup", help="Show the indexed active subscriptions of an email")
+    look.add_argument("email")
+    look.add_argument("--db", default=DB_NAME)
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+
+    init_db(args.db)
+    if args.command == "backfill":
+        api_key = os.getenv("PADDLE_API_KEY")
+        if not api_key:
+            print("PADDLE_API_KEY is not set", file=sys.stderr)
+            return 1
+        started = time.time()
+        customers, subscriptions = backfill(args.db, api_key, args.page_size)
+        print(f"Indexed {customers} customers and {subscriptions} subscriptions in {time.time() - started:.1f}s")
+    else:
+        with sqlite3.connect(args.db) as conn:
+            rows = active_subscriptions(conn, _norm(args.email))
+        print(json.dumps([{"subscription_id": s, "status": st, "customer_id": c} for s, st, c in rows], indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""payments_by_id: Firestore read model from any payment id to its purchase.
+
+Every id a purchase is known by (PayPal order or subscription id, Paddle
+transaction or subscription id, and their PAYPAL_/PADDLE_ forms stored in
+SQLite) is a document holding the buyer and the license state, so
+restore-purchase is one document get. The write endpoints keep it current
+through the Firestore outbox; a one-off backfill builds it from the
+licenses_by_email and usuarios collections.
+
+    python payments_by_id.py backfill [--dry-run]
+    python payments_by_id.py lookup PAYPAL_5O190127TN364715T
+"""
+import argparse
+import json
+import sys
+import time
+
+from dotenv import load_dotenv
+from firebase_admin import firestore
+
+import firestore_outbox
+
+COLLECTION = "payments_by_id"
+# How the licenses table stores provider ids; restore accepts either form
+PREFIXES = ("PADDLE_", "PAYPAL_")
+# License state copied onto every payment document
+FIELDS = ("email", "isPremium", "status", "method", "planType", "expirationDate", "trialEndDate", "subscriptionId", "usedTrial")
+SOURCE_FIELDS = FIELDS + ("paymentId", "uid", "restoredFrom")
+FIRESTORE_BATCH_LIMIT = 450
+
+
+def provider_prefix(payment_id, method=None):
+    """The prefix SQLite stores this id with, when it has one"""
+    if payment_id.startswith(("txn_", "sub_")):
+        return "PADDLE_"
+    if (method or "").startswith("PayPal") and not payment_id.startswith("I-"):
+        return "PAYPAL_"
+    return None
+
+
+def id_variants(payment_id, method=None):
+    """Every form of a payment id: bare, and with the provider prefix SQLite uses for it"""
+    if not isinstance(payment_id, str) or not payment_id.strip():
+        return []
+    base = payment_id.strip()
+    prefix = None
+    for p in PREFIXES:
+        if base.startswith(p):
+            prefix, base = p, base[len(p):]
+            break
+    # Not valid Firestore document ids
+    if not base or "/" in base or base in (".", ".."):
+        return []
+    prefix = prefix or provider_prefix(base, method)
+    return [base, prefix + base] if prefix else [base]
+
+
+def document(payment_id, uid, data):
+    """payments_by_id fields for a purchase; missing values are left out so merges keep older ones"""
+    doc = {k: data[k] for k in FIELDS if data.get(k) is not None}
+    doc["paymentId"] = payment_id
+    if uid:
+        doc["uid"] = uid
+    doc["updatedAt"] = firestore.SERVER_TIMESTAMP
+    return doc
+
+
+def enqueue(cursor, payment_ids, uid, data, method=None):
+    """Points every form of these ids at this purchase, in the caller's SQLite transaction"""
+    ids = []
+    for payment_id in payment_ids:
+        for variant in id_variants(payment_id, method or data.get("method")):
+            if variant not in ids:
+                ids.append(variant)
+    if not ids:
+        return 0
+    doc = document(ids[0], uid, data)
+    for variant in ids:
+        firestore_outbox.enqueue(cursor, COLLECTION, variant, doc)
+    return len(ids)
+
+
+def _purchase_ids(data):
+    payment_id = data.get("paymentId")
+    return [p for p in (payment_id, data.get("subscriptionId")) if isinstance(p, str)]
+
+
+def backfill(db, page_size=500, dry_run=False):
+    """Writes a payments_by_id document for every id found in licenses_by_email and usuarios.
+
+    usuarios is read second so its documents (which know the uid) win. Copies
+    made by restore-purchase are skipped: they point at someone else's payment.
+    """
+    from storage import iter_collection
+
+    counts = {"licenses_by_email": 0, "usuarios": 0, "documents": 0}
+    batch, ops = db.batch(), 0
+    started = time.time()
+    for collection in ("licenses_by_email", "usuarios"):
+        for snap in iter_collection(db, collection, fields=list(SOURCE_FIELDS), page_size=page_size):
+            data = snap.to_dict() or {}
+            if data.get("restoredFrom"):
+                continue
+            uid = snap.id if collection == "usuarios" else data.get("uid")
+            ids = []
+            for payment_id in _purchase_ids(data):
+                ids += [v for v in id_variants(payment_id, data.get("method")) if v not in ids]
+            if not ids:
+                continue
+            counts[collection] += 1
+            doc = document(ids[0], uid, data)
+            for variant in ids:
+                counts["documents"] += 1
+                if dry_run:
+                    continue
+                batch.set(db.collection(COLLECTION).document(variant), doc, merge=True)
+                ops += 1
+                if ops >= FIRESTORE_BATCH_LIMIT:
+                    batch.commit()
+                    batch, ops = db.batch(), 0
+            if counts[collection] % 1000 == 0:
+                print(f"{collection}: {counts[collection]} purchases, {counts['documents']} documents "
+                      f"({time.time() - started:.0f}s)", file=sys.stderr)
+    if ops:
+        batch.commit()
+    return counts
+
+
+def main(argv=None):
+    from storage import init_firestore
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    fill = sub.add_parser("backfill", help="Build payments_by_id from licenses_by_email and usuarios")
+    fill.add_argument("--page-size", type=int, default=500)
+    fill.add_argument("--dry-run", action="store_true", help="Count what would be written")
+    look = sub.add_parser("lookup", help="Show the payments_by_id document of a payment id")
+    look.add_argument("payment_id")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+
+    db = init_firestore()
+    if db is None:
+        print("Firestore unavailable", file=sys.stderr)
+        return 1
+    if args.command == "backfill":
+        started = time.time()
+        counts = backfill(db, args.page_size, args.dry_run)
+        print(json.dumps({**counts, "seconds": round(time.time() - started, 1), "dry_run": args.dry_run}))
+    else:
+        snap = db.collection(COLLECTION).document(args.payment_id.strip()).get()
+        print(json.dumps(snap.to_dict() if snap.exists else None, indent=2, default=str))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+import json
+import os
+import time
+
+from licensing import as_utc
+
+# Captured orders don't change; they are re-verified after this long only to pick up refunds
+ORDER_TTL_SECONDS = float(os.getenv("PAYPAL_ORDER_CACHE_TTL_SECONDS", str(7 * 86400)))
+# Confirmations without a billing date to expire on (approved orders, subscriptions without next_billing_time)
+FALLBACK_TTL_SECONDS = float(os.getenv("PAYPAL_VERIFY_CACHE_TTL_SECONDS", "3600"))
+
+
+def init_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS paypal_verifications (
+            kind TEXT NOT NULL,
+            ref_id TEXT NOT NULL,
+            status TEXT,
+            billing_info TEXT,
+            verified_at REAL,
+            expires_at REAL,
+            PRIMARY KEY (kind, ref_id)
+        )
+    """)
+
+
+def ttl_until(kind, status, billing_info, now=None):
+    """Epoch seconds until which a confirmed verification can be reused.
+
+    Subscriptions are good until their next billing time, when PayPal may
+    have failed to collect; completed orders for ORDER_TTL_SECONDS.
+    """
+    now = now or time.time()
+    if kind == "order":
+        return now + (ORDER_TTL_SECONDS if status == "COMPLETED" else FALLBACK_TTL_SECONDS)
+    next_billing = as_utc((billing_info or {}).get("next_billing_time"))
+    if next_billing and next_billing.timestamp() > now:
+        return next_billing.timestamp()
+    return now + FALLBACK_TTL_SECONDS
+
+
+def record(cursor, kind, ref_id, status, billing_info=None, now=None):
+    """Stores a confirmed verification; runs inside the registration's SQLite transaction"""
+    now = now or time.time()
+    cursor.execute(
+        """
+        INSERT INTO paypal_verifications (kind, ref_id, status, billing_info, verified_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(kind, ref_id) DO UPDATE SET
+            status=excluded.status,
+            billing_info=excluded.billing_info,
+            verified_at=excluded.verified_at,
+            expires_at=excluded.expires_at
+        """,
+        (kind, ref_id, status, json.dumps(billing_info) if billing_info else None, now,
+         ttl_until(kind, status, billing_info, now)),
+    )
+
+
+def lookup(conn, kind, ref_id, now=None):
+    """(status, billing_info) of an unexpired verification, or None"""
+    row = conn.execute(
+        "SELECT status, billing_info FROM paypal_verifications WHERE kind = ? AND ref_id = ? AND expires_at > ?",
+        (kind, ref_id, now or time.time()),
+    ).fetchone()
+    if row is None:
+        return None
+    return row[0], json.loads(row[1]) if row[1] else {}
@@ -0,0 +1,207 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, jsonify, make_response
+
+log = logging.getLogger(__name__)
+
+# Limits are "<burst>/<seconds>": a bucket holds up to <burst> tokens and refills
+# <burst> tokens every <seconds>. Override with RATE_LIMIT_<ROUTE>_<KEY>, e.g.
+# RATE_LIMIT_CHECK_LICENSE_IP="240/60". Use "0" to disable one dimension.
+DEFAULT_LIMITS = {
+    "check_license": {"uid": "30/60", "email": "30/60", "ip": "120/60"},
+    "sync_user": {"uid": "10/60", "email": "10/60", "ip": "60/60"},
+}
+
+MAX_TRACKED_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+MAX_CACHED_VERDICTS = int(os.getenv("RATE_LIMIT_MAX_VERDICTS", "20000"))
+# Number of proxies in front of us that append to X-Forwarded-For (Render = 1)
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+
+
+def parse_limit(value):
+    """Parses '<burst>/<seconds>' into (capacity, tokens_per_second) or None"""
+    if not value or value.strip() in ("0", "off", "none"):
+        return None
+    try:
+        burst, seconds = value.split("/", 1)
+        capacity = float(burst)
+        period = float(seconds)
+        if capacity <= 0 or period <= 0:
+            return None
+        return capacity, capacity / period
+    except Exception:
+        log.warning("Invalid rate limit %r, ignoring", value)
+        return None
+
+
+def load_limits():
+    limits = {}
+    for route, dims in DEFAULT_LIMITS.items():
+        limits[route] = {}
+        for dim, default in dims.items():
+            parsed = parse_limit(os.getenv(f"RATE_LIMIT_{route.upper()}_{dim.upper()}", default))
+            if parsed:
+                limits[route][dim] = parsed
+    return limits
+
+
+class _Bucket:
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        self.stamp = stamp
+
+
+class TokenBucketLimiter:
+    """Token buckets for many keys behind one lock, evicting least recently used keys"""
+
+    def __init__(self, max_keys=MAX_TRACKED_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, checks, now=None):
+        """Takes one token from every (key, capacity, rate) in checks, or from none of them.
+
+        Returns (allowed, retry_after_seconds).
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            buckets = []
+            wait = 0.0
+            for key, capacity, rate in checks:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = _Bucket(capacity, now)
+                    self._buckets[key] = bucket
+                    if len(self._buckets) > self.max_keys:
+                        self._buckets.popitem(last=False)
+                else:
+                    self._buckets.move_to_end(key)
+                    bucket.tokens = min(capacity, bucket.tokens + (now - bucket.stamp) * rate)
+                    bucket.stamp = now
+                if bucket.tokens < 1:
+                    wait = max(wait, (1 - bucket.tokens) / rate)
+                buckets.append(bucket)
+
+            if wait > 0:
+                return False, wait
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return True, 0.0
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class VerdictCache:
+    """Small LRU of the last successful response body per identity"""
+
+    def __init__(self, max_entries=MAX_CACHED_VERDICTS):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def discard_identities(self, uids=(), emails=()):
+        """Drops every entry whose uid or email is listed"""
+        uids, emails = set(uids), set(emails)
+        with self._lock:
+            stale = [k for k in self._items if k.split("|", 1)[0] in emails or k.split("|", 1)[1] in uids]
+            for key in stale:
+                del self._items[key]
+        return len(stale)
+
+
+LIMITS = load_limits()
+limiter = TokenBucketLimiter()
+verdicts = VerdictCache()
+
+
+def client_ip():
+    forwarded = request.headers.get("X-Forwarded-For", "")
+    hops = [h.strip() for h in forwarded.split(",") if h.strip()]
+    if hops and TRUSTED_PROXY_HOPS > 0:
+        return hops[-min(TRUSTED_PROXY_HOPS, len(hops))]
+    return request.remote_addr or "unknown"
+
+
+def request_identity():
+    """Returns (uid, normalized email, client ip) from query args or JSON body"""
+    body = request.get_json(silent=True) if request.is_json else None
+    body = body if isinstance(body, dict) else {}
+    uid = request.args.get("uid") or body.get("uid")
+    email = request.args.get("email") or body.get("email")
+    email_norm = email.strip().lower() if isinstance(email, str) and email.strip() else None
+    return (uid if isinstance(uid, str) and uid else None), email_norm, client_ip()
+
+
+def verdict_key(uid, email_norm):
+    return f"{email_norm or ''}|{uid or ''}"
+
+
+def rate_limited(route, remember_verdict=False):
+    """Applies the configured per-uid/email/ip token buckets for a route.
+
+    When remember_verdict is set, the last 200 JSON body per identity is kept and
+    returned alongside the 429 so clients keep a usable answer while throttled.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            route_limits = LIMITS.get(route) or {}
+            if not route_limits:
+                return view(*args, **kwargs)
+
+            uid, email_norm, ip = request_identity()
+            checks = []
+            for dim, value in (("uid", uid), ("email", email_norm), ("ip", ip)):
+                if value and dim in route_limits:
+                    capacity, rate = route_limits[dim]
+                    checks.append((f"{route}|{dim}|{value}", capacity, rate))
+
+            allowed, retry_after = limiter.acquire(checks)
+            key = verdict_key(uid, email_norm)
+            if not allowed:
+                retry_after = max(1, math.ceil(retry_after))
+                body = {"error": "Too many requests", "retry_after": retry_after}
+                cached = verdicts.get(key) if remember_verdict else None
+                if cached:
+                    body = {**cached, "throttled": True, "retry_after": retry_after}
+                resp = jsonify(body)
+                resp.status_code = 429
+                resp.headers["Retry-After"] = str(retry_after)
+                return resp
+
+            resp = make_response(view(*args, **kwargs))
+            if remember_verdict and resp.status_code == 200 and resp.is_json:
+                body = resp.get_json(silent=True)
+                if isinstance(body, dict) and "error" not in body:
+                    verdicts.put(key, body)
+            return resp
+        return wrapper
+    return decorator
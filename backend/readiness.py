@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+RETRY_MIN_SECONDS = 1.0
+RETRY_MAX_SECONDS = 30.0
+
+
+class _Check:
+    __slots__ = ("name", "fn", "required", "ok", "attempts", "error", "seconds", "at")
+
+    def __init__(self, name, fn, required):
+        self.name = name
+        self.fn = fn
+        self.required = required
+        self.ok = False
+        self.attempts = 0
+        self.error = None
+        self.seconds = None
+        self.at = None
+
+
+class Readiness:
+    """Warm-up checks run in the background; the instance is ready once they have passed.
+
+    Required checks must succeed. Optional ones (plans, HTTP pools) only have
+    to be attempted once so their connections are open before traffic
+    arrives; failed ones keep being retried after readiness flips.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checks = []
+        self._thread = None
+        self.started_at = time.time()
+        self.ready_at = None
+        metrics.gauge_fn("ready", lambda: int(self.ready))
+
+    def add(self, name, fn, required=True):
+        self._checks.append(_Check(name, fn, required))
+
+    @property
+    def ready(self):
+        return self.ready_at is not None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        # Warm-up (and uptime) counts from here, which is after the fork when the app was preloaded
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="warm-up", daemon=True)
+        self._thread.start()
+
+    def run_check(self, check):
+        started = time.perf_counter()
+        try:
+            check.fn()
+            error = None
+        except Exception as e:
+            error = str(e)[:300]
+        with self._lock:
+            check.attempts += 1
+            check.ok = error is None
+            check.error = error
+            check.seconds = round(time.perf_counter() - started, 4)
+            check.at = time.time()
+        if error:
+            log.warning("Warm-up check %s failed: %s", check.name, error)
+        return error is None
+
+    def probe(self):
+        """Re-runs every check now (diagnostics)"""
+        for check in self._checks:
+            self.run_check(check)
+        return self.status()
+
+    def _run(self):
+        delay = RETRY_MIN_SECONDS
+        while True:
+            for check in self._checks:
+                if not check.ok:
+                    self.run_check(check)
+            if not self.ready and all(c.ok or (not c.required and c.attempts) for c in self._checks):
+                self.ready_at = time.time()
+                log.info("Ready after %.2fs of warm-up", self.ready_at - self.started_at)
+            if all(c.ok for c in self._checks):
+                return
+            time.sleep(delay)
+            delay = min(RETRY_MAX_SECONDS, delay * 2)
+
+    def status(self):
+        with self._lock:
+            checks = {
+                c.name: {
+                    "ok": c.ok,
+                    "required": c.required,
+                    "attempts": c.attempts,
+                    "seconds": c.seconds,
+                    "error": c.error,
+                }
+                for c in self._checks
+            }
+        return {
+            "ready": self.ready,
+            "warmup_seconds": round(self.ready_at - self.started_at, 3) if self.ready else None,
+            "checks": checks,
+        }
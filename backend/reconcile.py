@@ -0,0 +1,441 @@
+"""Bulk reconciliation of license state between Paddle, Firestore and SQLite.
+
+Every source is streamed page by page into an on-disk staging database and
+joined there by normalized email, so memory stays bounded regardless of the
+customer count. For each email a canonical license is chosen and every copy
+that disagrees with it is corrected with batched writes.
+
+    python reconcile.py --dry-run --report divergences.ndjson
+    python reconcile.py --interval 900
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+from licensing import as_utc, derive_status, paddle_plan_type, paddle_subscription_state, to_iso_z
+from paddle_api import iter_pages
+from storage import DB_NAME, init_firestore, iter_collection
+
+LICENSE_FIELDS = [
+    "email", "isPremium", "status", "method", "paymentId", "subscriptionId",
+    "planType", "expirationDate", "trialEndDate",
+]
+FIRESTORE_BATCH_LIMIT = 400
+SQLITE_CHUNK = 500
+# Lower rank wins when a customer has several Paddle subscriptions
+PADDLE_STATUS_RANK = {"active": 0, "trialing": 1, "past_due": 2, "paused": 3, "canceled": 4}
+
+STAGING_SCHEMA = """
+    CREATE TABLE paddle_customers (customer_id TEXT PRIMARY KEY, email TEXT);
+    CREATE INDEX idx_pc_email ON paddle_customers (email);
+    CREATE TABLE paddle_subs (
+        subscription_id TEXT PRIMARY KEY, customer_id TEXT, status TEXT, status_rank INTEGER,
+        expiration TEXT, trial_end TEXT, plan_type TEXT, updated_at TEXT
+    );
+    CREATE INDEX idx_ps_customer ON paddle_subs (customer_id);
+    CREATE TABLE fs_license (
+        email TEXT PRIMARY KEY, is_premium INTEGER, status TEXT, method TEXT, payment_id TEXT,
+        subscription_id TEXT, plan_type TEXT, expiration TEXT, trial_end TEXT
+    );
+    CREATE TABLE fs_user (
+        uid TEXT PRIMARY KEY, email TEXT, is_premium INTEGER, status TEXT, method TEXT, payment_id TEXT,
+        subscription_id TEXT, plan_type TEXT, expiration TEXT, trial_end TEXT
+    );
+    CREATE INDEX idx_fu_email ON fs_user (email);
+    CREATE TABLE local_license (
+        email TEXT, raw_email TEXT, is_premium INTEGER, status TEXT, method TEXT, payment_id TEXT,
+        subscription_id TEXT, expiration TEXT, trial_end TEXT
+    );
+    CREATE INDEX idx_ll_email ON local_license (email);
+"""
+
+CANDIDATE_COLUMNS = ("is_premium", "status", "method", "payment_id", "subscription_id", "plan_type", "expiration", "trial_end")
+
+
+def norm_email(value):
+    return value.strip().lower() if isinstance(value, str) and value.strip() else None
+
+
+def iso(value):
+    return to_iso_z(as_utc(value))
+
+
+def same_instant(a, b):
+    a, b = as_utc(a), as_utc(b)
+    if a is None or b is None:
+        return a is b
+    return a.replace(microsecond=0) == b.replace(microsecond=0)
+
+
+class Reconciler:
+    def __init__(self, db, db_name=DB_NAME, paddle_api_key=None, dry_run=False, report=None, page_size=500):
+        self.db = db
+        self.db_name = db_name
+        self.paddle_api_key = paddle_api_key
+        self.dry_run = dry_run
+        self.report = report
+        self.page_size = page_size
+        self.stats = {"emails": 0, "divergent": 0, "sqlite_fixes": 0, "licenses_by_email_fixes": 0, "usuarios_fixes": 0}
+        self._sqlite_rows = []
+        self._fs_batch = None
+        self._fs_pending = 0
+
+    # --- Staging ---
+
+    def _stage(self, stage):
+        if self.paddle_api_key:
+            self._stage_paddle(stage)
+        else:
+            print("Paddle skipped: reconciling Firestore and SQLite only", file=sys.stderr)
+        if self.db:
+            self._stage_firestore(stage)
+        self._stage_sqlite(stage)
+
+    def _stage_paddle(self, stage):
+        started = time.time()
+        rows = []
+        for c in iter_pages("/customers", api_key=self.paddle_api_key):
+            rows.append((c.get("id"), norm_email(c.get("email"))))
+            if len(rows) >= SQLITE_CHUNK:
+                stage.executemany("INSERT OR REPLACE INTO paddle_customers VALUES (?, ?)", rows)
+                rows = []
+        stage.executemany("INSERT OR REPLACE INTO paddle_customers VALUES (?, ?)", rows)
+
+        rows = []
+        for s in iter_pages("/subscriptions", api_key=self.paddle_api_key):
+            status = s.get("status")
+            period = s.get("current_billing_period") or {}
+            ends_at = period.get("ends_at") or s.get("next_billed_at")
+            items = s.get("items") or []
+            price_id = ((items[0].get("price") or {}).get("id") if items else None)
+            rows.append((
+                s.get("id"), s.get("customer_id"), status, PADDLE_STATUS_RANK.get(status, 9),
+                iso(ends_at), iso(ends_at) if status == "trialing" else None,
+                paddle_plan_type(price_id), s.get("updated_at"),
+            ))
+            if len(rows) >= SQLITE_CHUNK:
+                stage.executemany("INSERT OR REPLACE INTO paddle_subs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                rows = []
+        stage.executemany("INSERT OR REPLACE INTO paddle_subs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        stage.commit()
+        print(f"Staged Paddle customers/subscriptions in {time.time() - started:.1f}s", file=sys.stderr)
+
+    def _stage_firestore(self, stage):
+        started = time.time()
+        for collection, table in (("licenses_by_email", "fs_license"), ("usuarios", "fs_user")):
+            rows = []
+            for snap in iter_collection(self.db, collection, fields=LICENSE_FIELDS, page_size=self.page_size):
+                d = snap.to_dict() or {}
+                values = (
+                    1 if d.get("isPremium") else 0, d.get("status"), d.get("method"), d.get("paymentId"),
+                    d.get("subscriptionId"), d.get("planType"), iso(d.get("expirationDate")), iso(d.get("trialEndDate")),
+                )
+                if table == "fs_license":
+                    rows.append((norm_email(snap.id),) + values)
+                else:
+                    rows.append((snap.id, norm_email(d.get("email"))) + values)
+                if len(rows) >= SQLITE_CHUNK:
+                    stage.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({','.join('?' * len(rows[0]))})", rows)
+                    rows = []
+            if rows:
+                stage.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({','.join('?' * len(rows[0]))})", rows)
+            stage.commit()
+        print(f"Staged Firestore licenses in {time.time() - started:.1f}s", file=sys.stderr)
+
+    def _stage_sqlite(self, stage):
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.execute(
+                "SELECT email, is_premium, status, method, payment_id, subscription_id, expiration_date, trial_end_date FROM licenses"
+            )
+            while True:
+                chunk = cursor.fetchmany(SQLITE_CHUNK)
+                if not chunk:
+                    break
+                stage.executemany(
+                    "INSERT INTO local_license VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(norm_email(r[0]), r[0], 1 if r[1] else 0, r[2], r[3], r[4], r[5], r[6], r[7]) for r in chunk],
+                )
+        stage.commit()
+
+    # --- Diff ---
+
+    def _candidates(self, stage, email):
+        candidates = []
+        sub = stage.execute(
+            """
+            SELECT s.subscription_id, s.status, s.expiration, s.trial_end, s.plan_type
+            FROM paddle_subs s JOIN paddle_customers c ON c.customer_id = s.customer_id
+            WHERE c.email = ? ORDER BY s.status_rank, s.updated_at DESC LIMIT 1
+            """,
+            (email,),
+        ).fetchone()
+        if sub:
+            is_premium, status = paddle_subscription_state(sub[1])
+            candidates.append({
+                "source": "paddle", "is_premium": is_premium, "status": status, "method": "Paddle",
+                "payment_id": sub[0], "subscription_id": sub[0], "plan_type": sub[4],
+                "expiration": sub[2], "trial_end": sub[3],
+            })
+
+        row = stage.execute(f"SELECT {', '.join(CANDIDATE_COLUMNS)} FROM fs_license WHERE email = ?", (email,)).fetchone()
+        if row:
+            candidates.append({"source": "licenses_by_email", **dict(zip(CANDIDATE_COLUMNS, row))})
+
+        users = stage.execute(
+            f"SELECT uid, {', '.join(CANDIDATE_COLUMNS)} FROM fs_user WHERE email = ? ORDER BY is_premium DESC, expiration DESC",
+            (email,),
+        ).fetchall()
+        if users:
+            candidates.append({"source": f"usuarios/{users[0][0]}", **dict(zip(CANDIDATE_COLUMNS, users[0][1:]))})
+
+        local = stage.execute(
+            """
+            SELECT raw_email, is_premium, status, method, payment_id, subscription_id, NULL, expiration, trial_end
+            FROM local_license WHERE email = ? ORDER BY raw_email = email DESC LIMIT 1
+            """,
+            (email,),
+        ).fetchone()
+        if local:
+            candidates.append({"source": "sqlite", **dict(zip(CANDIDATE_COLUMNS, local[1:]))})
+        return candidates, users, local
+
+    def _canonical(self, candidates, now):
+        # Paddle's own view replaces every stored copy of a Paddle license
+        if candidates and candidates[0]["source"] == "paddle":
+            candidates = [candidates[0]] + [c for c in candidates[1:] if c.get("method") != "Paddle"]
+
+        best = None
+        best_end = None
+        for c in candidates:
+            if c["source"] != "paddle":
+                c["is_premium"], c["status"] = derive_status(c["status"], c["is_premium"], c["trial_end"], c["expiration"], now)
+            if not c["is_premium"]:
+                continue
+            end = as_utc(c["trial_end"]) or as_utc(c["expiration"]) or datetime.max.replace(tzinfo=timezone.utc)
+            if best is None or end > best_end:
+                best, best_end = c, end
+        return best or (candidates[0] if candidates else None)
+
+    def _firestore_diff(self, doc, canonical):
+        diff = {}
+        if bool(doc["is_premium"]) != bool(canonical["is_premium"]):
+            diff["isPremium"] = [bool(doc["is_premium"]), bool(canonical["is_premium"])]
+        if (doc["status"] or "free") != (canonical["status"] or "free"):
+            diff["status"] = [doc["status"], canonical["status"]]
+        if canonical["is_premium"]:
+            if not same_instant(doc["expiration"], canonical["expiration"]):
+                diff["expirationDate"] = [doc["expiration"], canonical["expiration"]]
+            if not same_instant(doc["trial_end"], canonical["trial_end"]):
+                diff["trialEndDate"] = [doc["trial_end"], canonical["trial_end"]]
+            if canonical["subscription_id"] and doc["subscription_id"] != canonical["subscription_id"]:
+                diff["subscriptionId"] = [doc["subscription_id"], canonical["subscription_id"]]
+        return diff
+
+    def _firestore_update(self, email, canonical):
+        update = {
+            "email": email,
+            "isPremium": bool(canonical["is_premium"]),
+            "status": canonical["status"],
+            "expirationDate": as_utc(canonical["expiration"]),
+            "trialEndDate": as_utc(canonical["trial_end"]),
+        }
+        for key, col in (("method", "method"), ("paymentId", "payment_id"), ("subscriptionId", "subscription_id"), ("planType", "plan_type")):
+            if canonical.get(col):
+                update[key] = canonical[col]
+        if canonical["trial_end"]:
+            update["usedTrial"] = True
+        return update
+
+    def _reconcile_email(self, stage, email, now):
+        candidates, users, local = self._candidates(stage, email)
+        canonical = self._canonical([dict(c) for c in candidates], now)
+        if not canonical:
+            return
+
+        fixes = []
+        # SQLite row
+        if local:
+            local_doc = dict(zip(CANDIDATE_COLUMNS, local[1:]))
+            diff = {}
+            for col in ("is_premium", "status", "method", "subscription_id"):
+                if (bool(local_doc[col]) if col == "is_premium" else local_doc[col]) != (bool(canonical[col]) if col == "is_premium" else canonical[col]):
+                    if col != "subscription_id" or canonical[col]:
+                        diff[col] = [local_doc[col], canonical[col]]
+            for col in ("expiration", "trial_end"):
+                if not same_instant(local_doc[col], canonical[col]):
+                    diff[col] = [local_doc[col], canonical[col]]
+            if diff or local[0] != email:
+                fixes.append({"target": "sqlite", "fields": diff})
+        elif canonical["is_premium"]:
+            fixes.append({"target": "sqlite", "fields": {"row": [None, "insert"]}})
+
+        if any(f["target"] == "sqlite" for f in fixes):
+            self._sqlite_rows.append((
+                email, 1 if canonical["is_premium"] else 0, canonical["status"], canonical["payment_id"],
+                canonical["subscription_id"], iso(canonical["expiration"]), iso(canonical["trial_end"]), canonical["method"],
+            ))
+
+        update = None
+        # licenses_by_email mirrors Paddle licenses only
+        if canonical["source"] == "paddle":
+            lbe = next((c for c in candidates if c["source"] == "licenses_by_email"), None)
+            diff = self._firestore_diff(lbe, canonical) if lbe else {"document": [None, "create"]}
+            if diff:
+                fixes.append({"target": "licenses_by_email", "fields": diff})
+                update = update or self._firestore_update(email, canonical)
+                self._firestore_set("licenses_by_email", email, update)
+
+        for user in users:
+            doc = dict(zip(CANDIDATE_COLUMNS, user[1:]))
+            diff = self._firestore_diff(doc, canonical)
+            if diff:
+                fixes.append({"target": f"usuarios/{user[0]}", "fields": diff})
+                update = update or self._firestore_update(email, canonical)
+                self._firestore_set("usuarios", user[0], update)
+
+        if fixes:
+            self.stats["divergent"] += 1
+            for f in fixes:
+                target = f["target"].split("/")[0]
+                self.stats[f"{target}_fixes"] += 1
+            if self.report:
+                self.report.write(json.dumps({
+                    "email": email,
+                    "canonical": {"source": canonical["source"], "premium": bool(canonical["is_premium"]),
+                                  "status": canonical["status"], "method": canonical["method"]},
+                    "fixes": fixes,
+                }, default=str) + "\n")
+
+        if len(self._sqlite_rows) >= SQLITE_CHUNK:
+            self._flush_sqlite()
+
+    # --- Apply ---
+
+    def _firestore_set(self, collection, doc_id, data):
+        if self.dry_run or not self.db:
+            return
+        if self._fs_batch is None:
+            self._fs_batch = self.db.batch()
+        self._fs_batch.set(self.db.collection(collection).document(doc_id), data, merge=True)
+        self._fs_pending += 1
+        if self._fs_pending >= FIRESTORE_BATCH_LIMIT:
+            self._flush_firestore()
+
+    def _flush_firestore(self):
+        if self._fs_batch is not None and self._fs_pending:
+            self._fs_batch.commit()
+        self._fs_batch = None
+        self._fs_pending = 0
+
+    def _flush_sqlite(self):
+        rows, self._sqlite_rows = self._sqlite_rows, []
+        if self.dry_run or not rows:
+            return
+        with sqlite3.connect(self.db_name, timeout=30) as conn:
+            conn.executemany(
+                """
+                INSERT INTO licenses (email, is_premium, status, payment_id, subscription_id, expiration_date, trial_end_date, method)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(email) DO UPDATE SET
+                    is_premium=excluded.is_premium,
+                    status=excluded.status,
+                    payment_id=COALESCE(excluded.payment_id, licenses.payment_id),
+                    subscription_id=COALESCE(excluded.subscription_id, licenses.subscription_id),
+                    expiration_date=excluded.expiration_date,
+                    trial_end_date=excluded.trial_end_date,
+                    method=excluded.method
+                """,
+                rows,
+            )
+
+    def run(self):
+        started = time.time()
+        workdir = tempfile.mkdtemp(prefix="reconcile_")
+        try:
+            stage = sqlite3.connect(os.path.join(workdir, "staging.db"))
+            stage.execute("PRAGMA journal_mode=OFF")
+            stage.execute("PRAGMA synchronous=OFF")
+            stage.execute("PRAGMA temp_store=FILE")
+            stage.executescript(STAGING_SCHEMA)
+            self._stage(stage)
+
+            now = datetime.now(timezone.utc)
+            emails = stage.execute(
+                """
+                SELECT email FROM fs_license
+                UNION SELECT email FROM fs_user WHERE email IS NOT NULL
+                UNION SELECT email FROM local_license WHERE email IS NOT NULL
+                UNION SELECT c.email FROM paddle_customers c JOIN paddle_subs s ON s.customer_id = c.customer_id
+                    WHERE c.email IS NOT NULL
+                ORDER BY 1
+                """
+            )
+            lookup = sqlite3.connect(os.path.join(workdir, "staging.db"))
+            for (email,) in emails:
+                self.stats["emails"] += 1
+                self._reconcile_email(lookup, email, now)
+            self._flush_sqlite()
+            self._flush_firestore()
+            lookup.close()
+            stage.close()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        self.stats["seconds"] = round(time.time() - started, 1)
+        self.stats["dry_run"] = self.dry_run
+        return self.stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile license state between Paddle, Firestore and SQLite")
+    parser.add_argument("--db", default=DB_NAME, help="SQLite licenses database")
+    parser.add_argument("--dry-run", action="store_true", help="Only report divergences, write nothing")
+    parser.add_argument("--report", help="Write one NDJSON line per divergent email to this file ('-' for stdout)")
+    parser.add_argument("--skip-paddle", action="store_true", help="Do not query the Paddle API")
+    parser.add_argument("--skip-firestore", action="store_true", help="Do not read or write Firestore")
+    parser.add_argument("--page-size", type=int, default=500, help="Firestore page size")
+    parser.add_argument("--interval", type=int, default=0, help="Run every N seconds instead of once")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    # A source that was asked for but can't be reached would make every license look divergent
+    paddle_key = None if args.skip_paddle else os.getenv("PADDLE_API_KEY")
+    if not args.skip_paddle and not paddle_key:
+        print("PADDLE_API_KEY is not set; use --skip-paddle to reconcile without Paddle", file=sys.stderr)
+        return 1
+    db = None if args.skip_firestore else init_firestore()
+    if not args.skip_firestore and db is None:
+        print("Firestore unavailable; use --skip-firestore to reconcile without it", file=sys.stderr)
+        return 1
+
+    while True:
+        report = None
+        if args.report == "-":
+            report = sys.stdout
+        elif args.report:
+            report = open(args.report, "w")
+        try:
+            stats = Reconciler(db, args.db, paddle_key, dry_run=args.dry_run, report=report, page_size=args.page_size).run()
+            print(json.dumps(stats), file=sys.stderr)
+        except Exception as e:
+            print(f"Reconcile error: {e}", file=sys.stderr)
+            if not args.interval:
+                return 1
+        finally:
+            if report and report is not sys.stdout:
+                report.close()
+        if not args.interval:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
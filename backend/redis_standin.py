@@ -0,0 +1,281 @@
+"""In-process stand-in for the slice of Redis the shared cache uses.
+
+Speaks RESP2 over TCP so the real client (redis-py) talks to it unchanged.
+Supports PING, GET, SET (EX/PX/NX/XX), MGET, DEL, EXPIRE, TTL, SADD,
+SMEMBERS, PUBLISH, SUBSCRIBE/UNSUBSCRIBE, DBSIZE and FLUSHALL; CLIENT and
+SELECT are accepted and ignored.
+
+    server = RedisStandIn().start()
+    os.environ["SHARED_CACHE_URL"] = server.url
+    ...
+    server.stop()
+"""
+import socket
+import socketserver
+import threading
+import time
+
+
+class _Error(Exception):
+    pass
+
+
+def _encode(value):
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, _Error):
+        return b"-ERR " + str(value).encode() + b"\r\n"
+    if isinstance(value, bool):
+        return b":%d\r\n" % int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        return b"+" + value.encode() + b"\r\n"
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, (list, tuple, set)):
+        return b"*%d\r\n" % len(value) + b"".join(_encode(v) for v in value)
+    raise TypeError(f"cannot encode {type(value).__name__}")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.channels = set()
+        self.write_lock = threading.Lock()
+        self.server.connections.add(self.connection)
+
+    def send(self, value):
+        with self.write_lock:
+            self.wfile.write(_encode(value))
+            self.wfile.flush()
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()  # inline command
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def handle(self):
+        store = self.server.store
+        try:
+            while True:
+                args = self.read_command()
+                if args is None:
+                    break
+                if not args:
+                    continue
+                name = args[0].decode().upper()
+                if name in ("SUBSCRIBE", "UNSUBSCRIBE"):
+                    self.subscription(name, [a.decode() for a in args[1:]])
+                    continue
+                if name == "PING" and self.channels:
+                    self.send([b"pong", b""])
+                    continue
+                try:
+                    reply = store.execute(name, args[1:])
+                except _Error as e:
+                    reply = e
+                except (ValueError, IndexError):
+                    reply = _Error(f"syntax error in '{name.lower()}'")
+                self.send(reply)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            store.unsubscribe(self, self.channels)
+            self.server.connections.discard(self.connection)
+
+    def subscription(self, name, channels):
+        store = self.server.store
+        if name == "SUBSCRIBE":
+            for channel in channels:
+                self.channels.add(channel)
+                store.subscribe(self, channel)
+                self.send([b"subscribe", channel.encode(), len(self.channels)])
+            return
+        for channel in channels or sorted(self.channels):
+            self.channels.discard(channel)
+            store.unsubscribe(self, [channel])
+            self.send([b"unsubscribe", channel.encode(), len(self.channels)])
+
+
+class _Store:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+        self.expires = {}
+        self.subscribers = {}
+        self.commands = 0
+
+    def _alive(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def _string(self, key):
+        if not self._alive(key):
+            return None
+        value = self.data[key]
+        if not isinstance(value, bytes):
+            raise _Error("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def subscribe(self, handler, channel):
+        with self.lock:
+            self.subscribers.setdefault(channel, set()).add(handler)
+
+    def unsubscribe(self, handler, channels):
+        with self.lock:
+            for channel in list(channels):
+                self.subscribers.get(channel, set()).discard(handler)
+
+    def execute(self, name, args):
+        with self.lock:
+            self.commands += 1
+            if name == "PUBLISH":
+                targets = list(self.subscribers.get(args[0].decode(), ()))
+            else:
+                method = getattr(self, "cmd_" + name.lower(), None)
+                if method is None:
+                    raise _Error(f"unknown command '{name.lower()}'")
+                return method(*args)
+        for handler in targets:
+            try:
+                handler.send([b"message", args[0], args[1]])
+            except OSError:
+                pass
+        return len(targets)
+
+    def cmd_ping(self, message=None):
+        return message if message is not None else "PONG"
+
+    def cmd_client(self, *args):
+        return "OK"
+
+    def cmd_select(self, index):
+        return "OK"
+
+    def cmd_get(self, key):
+        return self._string(key)
+
+    def cmd_mget(self, *keys):
+        out = []
+        for key in keys:
+            try:
+                out.append(self._string(key))
+            except _Error:
+                out.append(None)
+        return out
+
+    def cmd_set(self, key, value, *options):
+        ttl, only, i = None, None, 0
+        while i < len(options):
+            option = options[i].decode().upper()
+            if option in ("EX", "PX"):
+                ttl = int(options[i + 1]) / (1 if option == "EX" else 1000)
+                i += 1
+            elif option in ("NX", "XX"):
+                only = option
+            i += 1
+        exists = self._alive(key)
+        if (only == "NX" and exists) or (only == "XX" and not exists):
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if ttl is not None:
+            self.expires[key] = time.monotonic() + ttl
+        return "OK"
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                del self.data[key]
+                self.expires.pop(key, None)
+                removed += 1
+        return removed
+
+    def cmd_expire(self, key, seconds):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time.monotonic() + int(seconds)
+        return 1
+
+    def cmd_ttl(self, key):
+        if not self._alive(key):
+            return -2
+        expires = self.expires.get(key)
+        return -1 if expires is None else max(0, round(expires - time.monotonic()))
+
+    def cmd_sadd(self, key, *members):
+        if not self._alive(key):
+            self.data[key] = set()
+        value = self.data[key]
+        if not isinstance(value, set):
+            raise _Error("WRONGTYPE Operation against a key holding the wrong kind of value")
+        before = len(value)
+        value.update(members)
+        return len(value) - before
+
+    def cmd_smembers(self, key):
+        if not self._alive(key):
+            return []
+        value = self.data[key]
+        if not isinstance(value, set):
+            raise _Error("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return sorted(value)
+
+    def cmd_dbsize(self):
+        return sum(1 for key in list(self.data) if self._alive(key))
+
+    def cmd_flushall(self, *args):
+        self.data.clear()
+        self.expires.clear()
+        return "OK"
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RedisStandIn:
+    """Threaded RESP server on 127.0.0.1; port 0 picks a free one"""
+
+    def __init__(self, port=0):
+        self.server = _Server(("127.0.0.1", port), _Handler)
+        self.server.store = _Store()
+        self.server.connections = set()
+        self._thread = None
+
+    @property
+    def store(self):
+        return self.server.store
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"redis://{host}:{port}/0"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="redis-standin", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops accepting and drops open connections, like a crashed server"""
+        self.server.shutdown()
+        self.server.server_close()
+        for conn in list(self.server.connections):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
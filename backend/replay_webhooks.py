@@ -0,0 +1,171 @@
+"""Replays journaled webhooks through the paddle_webhook handler.
+
+    python replay_webhooks.py webhook_journal/ --speed 10
+    python replay_webhooks.py webhook_journal/webhooks-20250101T000000-42.ndjson.gz --speed max --report replay.json
+    python replay_webhooks.py webhook_journal/ --live        # recovery: apply to the configured SQLite and Firestore
+
+By default the handler runs against stand-ins: a fresh SQLite file and the
+in-memory Firestore from firestore_standin.py. Events are sent in receive
+order, spaced by their original gaps divided by --speed ("max" sends
+back to back). Prints events per second and apply latency percentiles.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from webhook_journal import iter_records
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def parse_speed(value):
+    if value == "max":
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+def load_app(live, db_path):
+    """Imports the Flask app wired to the stand-ins (or the real stores with live=True)"""
+    # Replayed events must not be journaled again, and listeners aren't needed
+    os.environ["WEBHOOK_JOURNAL_DIR"] = ""
+    os.environ["LICENSE_WATCH_ENABLED"] = "0"
+    if not live:
+        os.environ["LICENSES_DB"] = db_path
+        # Nothing may reach production: no shared cache writes or invalidations, and no
+        # start_runtime() warm-ups calling PayPal and Paddle
+        os.environ["SHARED_CACHE_URL"] = ""
+        os.environ["APP_DEFER_RUNTIME"] = "1"
+    import storage
+
+    if not live:
+        from firestore_standin import FirestoreStandin
+
+        standin = FirestoreStandin()
+        storage.init_firestore = lambda: standin
+    import app
+
+    if not live:
+        # Only what the webhook handler needs: the writer and Firestore replication into the stand-in
+        import firestore_outbox
+
+        app.db = standin
+        app.sqlite_writer.start()
+        app.replicator = firestore_outbox.FirestoreReplicator(app.DB_NAME, standin, on_applied=app.on_replicated)
+        app.replicator.start()
+    return app
+
+
+def wait_for_replication(app, timeout):
+    if not app.replicator:
+        return None
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if app.replicator.depth() == 0:
+            return round(time.perf_counter() - started, 3)
+        time.sleep(0.05)
+    return None
+
+
+def replay(app, records, speed, limit=None):
+    client = app.app.test_client()
+    latencies, codes, behind = [], {}, 0.0
+    first_received = wall_start = None
+    started = time.perf_counter()
+
+    for count, record in enumerate(records):
+        if limit is not None and count >= limit:
+            break
+        received = record.get("received_at", 0)
+        if first_received is None:
+            first_received, wall_start = received, time.perf_counter()
+        if speed is not None:
+            due = wall_start + (received - first_received) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                behind = max(behind, -delay)
+
+        headers = record.get("headers") or {}
+        t0 = time.perf_counter()
+        resp = client.post(
+            record.get("path") or "/paddle-webhook",
+            data=record.get("body") or b"",
+            headers={k: v for k, v in headers.items() if k.lower() != "content-type"},
+            content_type=headers.get("Content-Type") or headers.get("content-type") or "application/json",
+        )
+        latencies.append(time.perf_counter() - t0)
+        codes[resp.status_code] = codes.get(resp.status_code, 0) + 1
+
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        "events": len(latencies),
+        "elapsed_seconds": round(elapsed, 3),
+        "events_per_second": round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        "status_codes": {str(k): v for k, v in sorted(codes.items())},
+        "apply_latency_ms": {
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "max_behind_schedule_seconds": round(behind, 3) if speed is not None else None,
+    }
+
+
+def license_summary(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return dict(conn.execute("SELECT status, COUNT(*) FROM licenses GROUP BY status").fetchall())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("journal", nargs="+", help="Journal directory or segment files")
+    parser.add_argument("--speed", type=parse_speed, default=parse_speed("1"), help="Replay speed multiple (1, 10, ...) or 'max'")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after this many events")
+    parser.add_argument("--live", action="store_true", help="Apply to the configured database and Firestore instead of stand-ins")
+    parser.add_argument("--db", default=None, help="SQLite file for the stand-in run (default: a temp file)")
+    parser.add_argument("--report", default=None, help="Also write the JSON report to this file")
+    parser.add_argument("--drain-timeout", type=float, default=30.0, help="Seconds to wait for Firestore replication to catch up")
+    args = parser.parse_args(argv)
+
+    tmp = None
+    db_path = args.db
+    if not args.live and not db_path:
+        tmp = tempfile.TemporaryDirectory()
+        db_path = os.path.join(tmp.name, "replay.db")
+
+    app = load_app(args.live, db_path)
+    result = replay(app, iter_records(args.journal), args.speed, args.limit)
+    result["speed"] = "max" if args.speed is None else args.speed
+    result["target"] = "live" if args.live else "standin"
+    result["replication_drain_seconds"] = wait_for_replication(app, args.drain_timeout)
+    result["licenses_by_status"] = license_summary(app.DB_NAME)
+    if app.db is not None and not args.live:
+        result["firestore_writes"] = app.db.writes
+
+    out = json.dumps(result, indent=2)
+    print(out)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(out + "\n")
+    if tmp:
+        tmp.cleanup()
+    return 0 if result["events"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+try:
+    import redis
+except ImportError:  # optional: without it (or SHARED_CACHE_URL) every call is a miss
+    redis = None
+
+from metrics import metrics
+from licensing import as_utc, to_iso_z
+from storage import DB_NAME
+
+log = logging.getLogger(__name__)
+
+# redis://host:6379/0 (or rediss://); unset disables the shared tier
+CACHE_URL = os.getenv("SHARED_CACHE_URL", "")
+# Cache calls sit on the request path: a slow cache is treated as a down one
+TIMEOUT_SECONDS = float(os.getenv("SHARED_CACHE_TIMEOUT_MS", "50")) / 1000.0
+# After an error the cache is skipped for this long before it is tried again
+RETRY_SECONDS = float(os.getenv("SHARED_CACHE_RETRY_SECONDS", "10"))
+# Upper bound on staleness for changes no write endpoint announced (console edits, other services)
+LICENSE_TTL_SECONDS = int(os.getenv("SHARED_CACHE_LICENSE_TTL_SECONDS", "120"))
+PADDLE_TTL_SECONDS = int(os.getenv("SHARED_CACHE_PADDLE_TTL_SECONDS", "86400"))
+CHANNEL = os.getenv("SHARED_CACHE_CHANNEL", "license-invalidations")
+
+# Processes writing the same SQLite file share this; invalidations from it need no identity reset
+ORIGIN = f"{socket.gethostname()}:{os.path.abspath(DB_NAME)}"
+
+
+class _Miss:
+    def __repr__(self):
+        return "MISS"
+
+
+# get_many/get return this for absent keys; a cached None means "the document doesn't exist"
+MISS = _Miss()
+
+
+def user_key(uid):
+    return f"fs:usuarios:{uid}"
+
+
+def license_key(email_norm):
+    return f"fs:licenses_by_email:{email_norm}"
+
+
+def email_uids_key(email_norm):
+    # Which uid entries were filled for an email, so an email-wide write can drop them
+    return f"fs:uids:{email_norm}"
+
+
+def paddle_subs_key(email_norm):
+    return f"paddle:subs:{email_norm}"
+
+
+def paypal_token_key(mode):
+    return f"paypal:token:{mode}"
+
+
+def _default(value):
+    dt = as_utc(value)
+    if dt is None:
+        raise TypeError(f"{type(value).__name__} is not JSON serializable")
+    return to_iso_z(dt)
+
+
+def encode(value):
+    return json.dumps(value, default=_default, separators=(",", ":"))
+
+
+class SharedCache:
+    """Redis-protocol cache shared by every instance; any error turns it into a miss for a while"""
+
+    def __init__(self, url=CACHE_URL, timeout=TIMEOUT_SECONDS, retry=RETRY_SECONDS, channel=CHANNEL):
+        self.url = url
+        self.timeout = timeout
+        self.retry = retry
+        self.channel = channel
+        self._client = None
+        self._lock = threading.Lock()
+        self._down_until = 0.0
+        self._listener = None
+        metrics.gauge_fn("shared_cache_up", lambda: 1 if self.available() else 0)
+
+    @property
+    def enabled(self):
+        return bool(self.url) and redis is not None
+
+    def available(self):
+        return self.enabled and time.monotonic() >= self._down_until
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = redis.Redis.from_url(
+                    self.url,
+                    socket_timeout=self.timeout,
+                    socket_connect_timeout=self.timeout,
+                    retry_on_timeout=False,
+                )
+            return self._client
+
+    def _call(self, op, fn, default):
+        if not self.enabled:
+            return default
+        if not self.available():
+            metrics.inc("shared_cache", op=op, result="skipped")
+            return default
+        try:
+            return fn(self.client())
+        except (redis.RedisError, OSError, ValueError) as e:
+            if time.monotonic() >= self._down_until:
+                log.warning("Shared cache unavailable (%s): %s; retrying in %gs", op, e, self.retry)
+            self._down_until = time.monotonic() + self.retry
+            metrics.inc("shared_cache", op=op, result="error")
+            return default
+
+    def get_many(self, keys):
+        """Values for keys in one round trip; MISS for absent ones (and for all of them when down)"""
+        if not keys:
+            return []
+
+        def fetch(client):
+            out = [MISS if raw is None else json.loads(raw) for raw in client.mget(keys)]
+            for value in out:
+                metrics.inc("shared_cache", op="get", result="miss" if value is MISS else "hit")
+            return out
+
+        return self._call("get", fetch, [MISS] * len(keys))
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set_many(self, items, ttl):
+        """Pipelines SET key value EX ttl for each (key, value)"""
+        if not items:
+            return False
+
+        def store(client):
+            pipe = client.pipeline(transaction=False)
+            for key, value in items:
+                pipe.set(key, encode(value), ex=max(1, int(ttl)))
+            pipe.execute()
+            metrics.inc("shared_cache", len(items), op="set", result="ok")
+            return True
+
+        return self._call("set", store, False)
+
+    def set(self, key, value, ttl):
+        return self.set_many([(key, value)], ttl)
+
+    def delete(self, keys):
+        keys = [k for k in keys if k]
+        if not keys:
+            return False
+
+        def drop(client):
+            client.delete(*keys)
+            metrics.inc("shared_cache", op="delete", result="ok")
+            return True
+
+        return self._call("delete", drop, False)
+
+    def fill_user(self, uid, email_norm, fields, ttl=LICENSE_TTL_SECONDS):
+        """Caches a usuarios doc's license fields (None when the doc is missing)"""
+        def store(client):
+            pipe = client.pipeline(transaction=False)
+            pipe.set(user_key(uid), encode(fields), ex=ttl)
+            if email_norm:
+                pipe.sadd(email_uids_key(email_norm), uid)
+                pipe.expire(email_uids_key(email_norm), ttl)
+            pipe.execute()
+            metrics.inc("shared_cache", op="set", result="ok")
+            return True
+
+        return self._call("set", store, False)
+
+    def invalidate_license(self, uids=(), emails=(), publish=True):
+        """Drops cached license docs for these uids/emails and, with publish, tells every instance.
+
+        Called after a write commits and again once the replicator has applied it
+        to Firestore, so a read that refilled the cache in between is dropped too.
+        """
+        uids = sorted({u for u in uids if u})
+        emails = sorted({e for e in emails if e})
+        if not uids and not emails:
+            return False
+
+        def drop(client):
+            pipe = client.pipeline(transaction=False)
+            for email in emails:
+                pipe.smembers(email_uids_key(email))
+            members = pipe.execute() if emails else []
+            keys = [user_key(u) for u in uids]
+            for email, filled in zip(emails, members):
+                keys += [license_key(email), email_uids_key(email)]
+                keys += [user_key(u.decode() if isinstance(u, bytes) else u) for u in filled]
+            pipe = client.pipeline(transaction=False)
+            pipe.delete(*keys)
+            if publish:
+                pipe.publish(self.channel, json.dumps({"origin": ORIGIN, "uids": uids, "emails": emails}))
+            pipe.execute()
+            metrics.inc("shared_cache", op="invalidate", result="ok")
+            return True
+
+        return self._call("invalidate", drop, False)
+
+    def listen(self, handler):
+        """Calls handler(message) for every invalidation published by any instance, reconnecting as needed"""
+        if not self.enabled or (self._listener and self._listener.is_alive()):
+            return
+        self._listener = threading.Thread(target=self._listen, args=(handler,), name="shared-cache-listener", daemon=True)
+        self._listener.start()
+
+    def _listen(self, handler):
+        backoff = 1.0
+        while True:
+            try:
+                # Blocking reads: the subscription connection can't use the request-path timeout
+                client = redis.Redis.from_url(self.url, socket_connect_timeout=max(self.timeout, 1.0), socket_keepalive=True)
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                log.info("Shared cache: listening for invalidations on %s", self.channel)
+                backoff = 1.0
+                for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        handler(json.loads(message["data"]))
+                    except Exception as e:
+                        log.error("Shared cache invalidation error: %s", e)
+            except Exception as e:
+                log.warning("Shared cache listener error: %s; reconnecting in %gs", e, backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+
+cache = SharedCache()
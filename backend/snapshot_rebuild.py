@@ -0,0 +1,375 @@
+"""Bulk rebuild of the local SQLite license cache from Firestore.
+
+licenses.db lives on the instance's disk, so a fresh host starts empty and
+every first check-license would go to Firestore. This streams
+licenses_by_email and the license fields of usuarios in projected pages,
+stages them in SQLite in large transactions and then applies them to
+licenses and identities in one transaction. Progress is stored after every
+chunk, so an interrupted rebuild resumes where it stopped.
+
+The app runs it as a warm-up check when the cache is cold
+(SNAPSHOT_REBUILD_ON_START) and on demand through /admin/snapshot.
+
+    python snapshot_rebuild.py [--restart] [--page-size 500]
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+from metrics import metrics
+from licensing import LICENSE_FIELDS, as_utc, derive_status, to_iso_z
+import payments_by_id
+
+log = logging.getLogger(__name__)
+
+# auto: rebuild at start-up when licenses is empty or a previous rebuild didn't finish; 0: never
+ON_START = os.getenv("SNAPSHOT_REBUILD_ON_START", "auto")
+PAGE_SIZE = int(os.getenv("SNAPSHOT_PAGE_SIZE", "500"))
+# Documents staged per SQLite transaction (and per progress checkpoint)
+CHUNK_DOCS = int(os.getenv("SNAPSHOT_CHUNK_DOCS", "5000"))
+LEASE_SECONDS = 60
+# Renewed from a heartbeat thread, so a slow Firestore page can't let the lease lapse
+LEASE_RENEW_SECONDS = LEASE_SECONDS / 4
+
+# licenses_by_email first, so a uid's own usuarios doc is staged last
+COLLECTIONS = ("licenses_by_email", "usuarios")
+APPLY = "apply"
+SOURCE_FIELDS = list(LICENSE_FIELDS) + ["paymentId"]
+
+
+def init_table(conn):
+    # One row per phase of the current rebuild; a phase is done once finished_at is set
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS snapshot_rebuild (
+            phase TEXT PRIMARY KEY,
+            last_doc_id TEXT,
+            docs INTEGER NOT NULL DEFAULT 0,
+            started_at REAL,
+            finished_at REAL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS snapshot_licenses (
+            email TEXT PRIMARY KEY,
+            is_premium INTEGER NOT NULL,
+            status TEXT,
+            payment_id TEXT,
+            subscription_id TEXT,
+            expiration_date TEXT,
+            trial_end_date TEXT,
+            method TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS snapshot_identities (
+            uid TEXT PRIMARY KEY,
+            email TEXT NOT NULL
+        )
+    """)
+
+
+def _norm(email):
+    return email.strip().lower() if isinstance(email, str) and email.strip() else None
+
+
+def license_row(email, data, now):
+    """licenses row for a license doc, or None when it holds no license at all"""
+    if not (data.get("isPremium") or data.get("method") or data.get("status") not in (None, "free")):
+        return None
+    trial_end = as_utc(data.get("trialEndDate"))
+    exp_date = as_utc(data.get("expirationDate"))
+    is_premium, status = derive_status(data.get("status", "free"), data.get("isPremium", False), trial_end, exp_date, now)
+    # SQLite keeps provider ids in their prefixed form
+    payment_ids = payments_by_id.id_variants(data.get("paymentId"), data.get("method"))
+    return (
+        email,
+        1 if is_premium else 0,
+        status,
+        payment_ids[-1] if payment_ids else None,
+        data.get("subscriptionId"),
+        to_iso_z(exp_date),
+        to_iso_z(trial_end),
+        data.get("method"),
+    )
+
+
+# A premium copy beats a lapsed one; between two, the one that runs longer
+STAGE_LICENSE = """
+    INSERT INTO snapshot_licenses (email, is_premium, status, payment_id, subscription_id, expiration_date, trial_end_date, method)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(email) DO UPDATE SET
+        is_premium=excluded.is_premium,
+        status=excluded.status,
+        payment_id=COALESCE(excluded.payment_id, snapshot_licenses.payment_id),
+        subscription_id=COALESCE(excluded.subscription_id, snapshot_licenses.subscription_id),
+        expiration_date=excluded.expiration_date,
+        trial_end_date=excluded.trial_end_date,
+        method=excluded.method
+    WHERE excluded.is_premium > snapshot_licenses.is_premium
+       OR (excluded.is_premium = snapshot_licenses.is_premium
+           AND COALESCE(excluded.expiration_date, excluded.trial_end_date, '')
+               >= COALESCE(snapshot_licenses.expiration_date, snapshot_licenses.trial_end_date, ''))
+"""
+
+# Rows whose own writes are still waiting in the outbox are newer locally than in Firestore
+NOT_PENDING = """
+    NOT EXISTS (
+        SELECT 1 FROM firestore_outbox o
+        WHERE (o.collection IN ('licenses_by_email', 'usuarios') AND o.doc_id = {email})
+           OR (o.collection = 'usuarios' AND o.doc_id IN (SELECT i.uid FROM identities i WHERE i.email = {email}))
+    )
+"""
+
+APPLY_LICENSES = f"""
+    INSERT INTO licenses (email, is_premium, status, payment_id, subscription_id, expiration_date, trial_end_date, method)
+    SELECT email, is_premium, status, payment_id, subscription_id, expiration_date, trial_end_date, method
+    FROM snapshot_licenses s
+    WHERE {NOT_PENDING.format(email="s.email")}
+    ON CONFLICT(email) DO UPDATE SET
+        is_premium=excluded.is_premium,
+        status=excluded.status,
+        payment_id=COALESCE(excluded.payment_id, licenses.payment_id),
+        subscription_id=COALESCE(excluded.subscription_id, licenses.subscription_id),
+        expiration_date=excluded.expiration_date,
+        trial_end_date=excluded.trial_end_date,
+        method=excluded.method
+"""
+
+APPLY_IDENTITIES = f"""
+    INSERT INTO identities (uid, email, synced_at, updated_at)
+    SELECT s.uid, s.email, :now, :now FROM snapshot_identities s
+    WHERE NOT EXISTS (SELECT 1 FROM firestore_outbox o WHERE o.collection = 'usuarios' AND o.doc_id = s.uid)
+      AND {NOT_PENDING.format(email="s.email")}
+    ON CONFLICT(uid) DO UPDATE SET email=excluded.email, synced_at=excluded.synced_at, updated_at=excluded.updated_at
+"""
+
+
+class LeaseLost(RuntimeError):
+    pass
+
+
+class SnapshotRebuild:
+    """Rebuilds licenses/identities from Firestore through the writer, resumably and one process at a time"""
+
+    def __init__(self, db_name, writer, page_size=PAGE_SIZE, chunk_docs=CHUNK_DOCS):
+        self.db_name = db_name
+        self.writer = writer
+        self.page_size = page_size
+        self.chunk_docs = chunk_docs
+        self.owner = uuid.uuid4().hex
+        self._running = threading.Lock()
+        self._docs = {}
+        for phase in COLLECTIONS:
+            metrics.gauge_fn("snapshot_rebuild_docs", lambda p=phase: self._docs.get(p, 0), collection=phase)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_name, timeout=10)
+
+    def progress(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT phase, last_doc_id, docs, started_at, finished_at FROM snapshot_rebuild").fetchall()
+        phases = {
+            phase: {"last_doc_id": last, "docs": docs, "started_at": started, "finished_at": finished}
+            for phase, last, docs, started, finished in rows
+        }
+        started = min((p["started_at"] for p in phases.values() if p["started_at"]), default=None)
+        return {
+            "running": self._running.locked(),
+            "finished": bool(phases) and all(p["finished_at"] for p in phases.values()),
+            "elapsed_seconds": round(time.time() - started, 1) if started else None,
+            "phases": phases,
+        }
+
+    def needed(self):
+        """True when the local cache is cold or a previous rebuild was interrupted"""
+        with self._connect() as conn:
+            phases = conn.execute("SELECT COUNT(*), COUNT(finished_at) FROM snapshot_rebuild").fetchone()
+            empty = conn.execute("SELECT 1 FROM licenses LIMIT 1").fetchone() is None
+        total, finished = phases
+        # A finished rebuild that found nothing isn't retried at every start
+        return finished < total or (empty and total == 0)
+
+    def _hold_lease(self):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO worker_leases (name, owner, expires_at) VALUES ('snapshot_rebuild', NULL, 0)")
+            cursor = conn.execute(
+                """
+                UPDATE worker_leases SET owner = ?, expires_at = ?
+                WHERE name = 'snapshot_rebuild' AND (owner = ? OR expires_at < ?)
+                """,
+                (self.owner, now + LEASE_SECONDS, self.owner, now),
+            )
+            return cursor.rowcount == 1
+
+    def _check_lease(self, cursor):
+        """Inside a writer transaction: fails it unless this process still holds the lease, and renews it"""
+        now = time.time()
+        held = cursor.execute(
+            "UPDATE worker_leases SET expires_at = ? WHERE name = 'snapshot_rebuild' AND owner = ? AND expires_at >= ?",
+            (now + LEASE_SECONDS, self.owner, now),
+        ).rowcount == 1
+        if not held:
+            raise LeaseLost("the snapshot rebuild lease passed to another process")
+
+    def _heartbeat(self, stop):
+        while not stop.wait(LEASE_RENEW_SECONDS):
+            try:
+                if not self._hold_lease():
+                    log.error("Snapshot rebuild: lease taken over by another process")
+                    return
+            except sqlite3.Error as e:
+                log.warning("Snapshot rebuild: renewing the lease failed: %s", e)
+
+    def _release_lease(self):
+        with self._connect() as conn:
+            conn.execute("UPDATE worker_leases SET expires_at = 0 WHERE name = 'snapshot_rebuild' AND owner = ?", (self.owner,))
+
+    def ensure(self, db):
+        """Warm-up check: returns once the cache is rebuilt, here or by another worker"""
+        if ON_START == "0":
+            return
+        while self.needed():
+            if self._hold_lease():
+                self.run(db)
+                return
+            time.sleep(1.0)
+
+    def run(self, db, restart=False):
+        """Rebuilds (or resumes rebuilding); returns the final progress"""
+        if not self._running.acquire(blocking=False):
+            raise RuntimeError("a snapshot rebuild is already running in this process")
+        stop = threading.Event()
+        try:
+            if not self._hold_lease():
+                raise RuntimeError("a snapshot rebuild is running in another process")
+            threading.Thread(target=self._heartbeat, args=(stop,), name="snapshot-lease", daemon=True).start()
+            self.writer.execute(lambda cursor: self._begin(cursor, restart))
+            for collection in COLLECTIONS:
+                self._stream(db, collection)
+            self._apply()
+            return self.progress()
+        finally:
+            stop.set()
+            self._release_lease()
+            self._running.release()
+
+    def _begin(self, cursor, restart):
+        self._check_lease(cursor)
+        phases = [r[0] for r in cursor.execute("SELECT phase FROM snapshot_rebuild WHERE finished_at IS NULL")]
+        if phases and not restart:
+            log.info("Snapshot rebuild: resuming (%s unfinished)", ", ".join(phases))
+            return
+        cursor.execute("DELETE FROM snapshot_rebuild")
+        cursor.execute("DELETE FROM snapshot_licenses")
+        cursor.execute("DELETE FROM snapshot_identities")
+        now = time.time()
+        cursor.executemany(
+            "INSERT INTO snapshot_rebuild (phase, docs, started_at) VALUES (?, 0, ?)",
+            [(phase, now) for phase in COLLECTIONS + (APPLY,)],
+        )
+        log.info("Snapshot rebuild: started")
+
+    def _phase(self, phase):
+        with self._connect() as conn:
+            return conn.execute("SELECT last_doc_id, docs, finished_at FROM snapshot_rebuild WHERE phase = ?", (phase,)).fetchone()
+
+    def _stream(self, db, collection):
+        from storage import iter_collection
+
+        last_doc_id, docs, finished_at = self._phase(collection)
+        if finished_at:
+            return
+        started = time.time()
+        now = datetime.now(timezone.utc)
+        licenses, links, chunk = [], [], 0
+        for snap in iter_collection(db, collection, fields=SOURCE_FIELDS, page_size=self.page_size, start_after=last_doc_id):
+            data = snap.to_dict() or {}
+            email = _norm(snap.id if collection == "licenses_by_email" else data.get("email"))
+            if email:
+                row = license_row(email, data, now)
+                if row:
+                    licenses.append(row)
+                if collection == "usuarios":
+                    links.append((snap.id, email))
+            chunk += 1
+            last_doc_id = snap.id
+            if chunk >= self.chunk_docs:
+                docs += chunk
+                self._stage(collection, licenses, links, last_doc_id, docs, started)
+                licenses, links, chunk = [], [], 0
+        docs += chunk
+        self._stage(collection, licenses, links, last_doc_id, docs, started, finished=True)
+
+    def _stage(self, collection, licenses, links, last_doc_id, docs, started, finished=False):
+        def job(cursor):
+            # Progress written by a process that lost the lease would rewind the new holder's
+            self._check_lease(cursor)
+            cursor.executemany(STAGE_LICENSE, licenses)
+            cursor.executemany("INSERT OR REPLACE INTO snapshot_identities (uid, email) VALUES (?, ?)", links)
+            cursor.execute(
+                "UPDATE snapshot_rebuild SET last_doc_id = ?, docs = ?, finished_at = ? WHERE phase = ?",
+                (last_doc_id, docs, time.time() if finished else None, collection),
+            )
+
+        self.writer.execute(job)
+        self._docs[collection] = docs
+        elapsed = time.time() - started
+        log.info("Snapshot rebuild: %s %d docs%s (%.0f docs/s)", collection, docs, " done" if finished else "",
+                 docs / elapsed if elapsed > 0 else 0.0)
+
+    def _apply(self):
+        if self._phase(APPLY)[2]:
+            return
+
+        def job(cursor):
+            self._check_lease(cursor)
+            licenses = cursor.execute(APPLY_LICENSES).rowcount
+            identities = cursor.execute(APPLY_IDENTITIES, {"now": time.time()}).rowcount
+            cursor.execute("DELETE FROM snapshot_licenses")
+            cursor.execute("DELETE FROM snapshot_identities")
+            cursor.execute("UPDATE snapshot_rebuild SET docs = ?, finished_at = ? WHERE phase = ?", (licenses, time.time(), APPLY))
+            return licenses, identities
+
+        licenses, identities = self.writer.execute(job, timeout=300)
+        metrics.inc("snapshot_rebuilds")
+        log.info("Snapshot rebuild: applied %d licenses and %d identities", licenses, identities)
+
+
+def main(argv=None):
+    from sqlite_writer import SQLiteWriter
+    from storage import DB_NAME, init_db, init_firestore
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=DB_NAME, help="SQLite licenses database")
+    parser.add_argument("--restart", action="store_true", help="Start over instead of resuming an unfinished rebuild")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Firestore page size")
+    parser.add_argument("--chunk-docs", type=int, default=CHUNK_DOCS, help="Documents per SQLite transaction")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+    init_db(args.db)
+    db = init_firestore()
+    if db is None:
+        print("Firestore unavailable", file=sys.stderr)
+        return 1
+    writer = SQLiteWriter(args.db)
+    writer.start()
+    result = SnapshotRebuild(args.db, writer, args.page_size, args.chunk_docs).run(db, restart=args.restart)
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
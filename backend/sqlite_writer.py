@@ -0,0 +1,137 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import deadlines
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# How long the writer keeps collecting mutations after the first one arrives
+COMMIT_WINDOW_SECONDS = float(os.getenv("SQLITE_COMMIT_WINDOW_MS", "5")) / 1000.0
+MAX_BATCH = int(os.getenv("SQLITE_MAX_BATCH", "256"))
+DEFAULT_TIMEOUT = 30.0
+
+
+class _Mutation:
+    __slots__ = ("fn", "future", "enqueued_at")
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class SQLiteWriter:
+    """Funnels every SQLite mutation of this process through one connection and thread.
+
+    Mutations submitted within the same commit window share one transaction
+    (group commit). Each runs inside its own savepoint, so a failing mutation is
+    rolled back alone and only its future carries the exception. Futures resolve
+    after the transaction is durable.
+    """
+
+    def __init__(self, db_name, window=COMMIT_WINDOW_SECONDS, max_batch=MAX_BATCH):
+        self.db_name = db_name
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._conn = None
+        metrics.gauge_fn("sqlite_writer_queue_depth", self._queue.qsize)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn):
+        """Queues fn(cursor) for the next commit; returns a Future with its result"""
+        mutation = _Mutation(fn)
+        self._queue.put(mutation)
+        return mutation.future
+
+    def execute(self, fn, timeout=DEFAULT_TIMEOUT):
+        """Runs fn(cursor) in the next group commit and waits for it to be durable.
+
+        Inside a request the wait is capped by its deadline; the mutation still
+        commits if the caller gives up on it.
+        """
+        timeout = deadlines.timeout("sqlite", timeout)
+        future = self.submit(fn)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            if deadlines.expired():
+                raise deadlines.exceeded("sqlite")
+            raise
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_name, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                if self._conn is None:
+                    self._conn = self._connect()
+                self._commit(batch)
+            except Exception as e:
+                log.error("SQLite writer commit failed (%d mutations): %s", len(batch), e)
+                for m in batch:
+                    if not m.future.done():
+                        m.future.set_exception(e)
+                try:
+                    self._conn.close()
+                except Exception:
+                    pass
+                self._conn = None
+
+    def _commit(self, batch):
+        started = time.monotonic()
+        cursor = self._conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        outcomes = []
+        try:
+            for m in batch:
+                metrics.observe("sqlite_queue_wait_seconds", started - m.enqueued_at)
+                cursor.execute("SAVEPOINT mutation")
+                try:
+                    outcomes.append((True, m.fn(cursor)))
+                    cursor.execute("RELEASE mutation")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO mutation")
+                    cursor.execute("RELEASE mutation")
+                    outcomes.append((False, e))
+            cursor.execute("COMMIT")
+        except Exception:
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            raise
+
+        metrics.observe("sqlite_commit_batch_size", len(batch))
+        metrics.observe("sqlite_commit_seconds", time.monotonic() - started)
+        for m, (ok, value) in zip(batch, outcomes):
+            if ok:
+                m.future.set_result(value)
+            else:
+                m.future.set_exception(value)
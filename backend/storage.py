@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import sqlite3
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+import bulkheads
+import firestore_outbox
+import identities
+import license_stats
+import license_watch
+import paddle_index
+import paypal_verifications
+import snapshot_rebuild
+import support_outbox
+import user_sync
+
+log = logging.getLogger(__name__)
+
+# Database setup
+DB_NAME = os.getenv("LICENSES_DB", "licenses.db")
+
+
+def init_firestore():
+    """Initializes Firebase Admin and returns a Firestore client, or None without credentials"""
+    try:
+        if not firebase_admin._apps:
+            sa_json = os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON")
+            if sa_json:
+                cred = credentials.Certificate(json.loads(sa_json))
+                firebase_admin.initialize_app(cred)
+                log.info("Firebase Admin Initialized (env)")
+            elif os.path.exists("serviceAccountKey.json"):
+                cred = credentials.Certificate("serviceAccountKey.json")
+                firebase_admin.initialize_app(cred)
+                log.info("Firebase Admin Initialized (file)")
+            else:
+                log.warning("Firebase credentials not found. Firestore updates will fail.")
+                return None
+        return firestore.client()
+    except Exception as e:
+        log.error("Error initializing Firebase: %s", e)
+        return None
+
+
+def init_db(db_name=DB_NAME):
+    with sqlite3.connect(db_name) as conn:
+        # WAL lets readers keep going while the writer thread commits
+        conn.execute("PRAGMA journal_mode=WAL")
+        cursor = conn.cursor()
+        # Create table with new schema
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS licenses (
+                email TEXT PRIMARY KEY,
+                is_premium BOOLEAN DEFAULT 0,
+                status TEXT DEFAULT 'free',
+                payment_id TEXT,
+                subscription_id TEXT,
+                method TEXT,
+                date_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expiration_date TIMESTAMP,
+                trial_end_date TIMESTAMP
+            )
+        """)
+
+        # Migration: Add columns if they don't exist
+        columns = [
+            ("expiration_date", "TIMESTAMP"),
+            ("method", "TEXT"),
+            ("status", "TEXT DEFAULT 'free'"),
+            ("trial_end_date", "TIMESTAMP"),
+            ("subscription_id", "TEXT")
+        ]
+        for col_name, col_type in columns:
+            try:
+                cursor.execute(f"ALTER TABLE licenses ADD COLUMN {col_name} {col_type}")
+            except sqlite3.OperationalError:
+                pass
+
+        # Rows written before emails were normalized everywhere; a clash with an
+        # already-normalized row keeps the normalized one
+        cursor.execute("UPDATE OR IGNORE licenses SET email = lower(trim(email)) WHERE email != lower(trim(email))")
+        # restore-purchase looks licenses up by payment or subscription id
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_licenses_payment_id ON licenses (payment_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_licenses_subscription_id ON licenses (subscription_id)")
+
+        identities.init_table(cursor)
+        support_outbox.init_table(cursor)
+        firestore_outbox.init_table(cursor)
+        license_watch.init_table(cursor)
+        paddle_index.init_tables(cursor)
+        paypal_verifications.init_table(cursor)
+        license_stats.init_table(cursor)
+        user_sync.init_table(cursor)
+        bulkheads.init_table(cursor)
+        snapshot_rebuild.init_table(cursor)
+
+        conn.commit()
+
+
+def iter_collection(db, collection, fields=None, page_size=500, start_after=None):
+    """Streams a Firestore collection in document-id order, one page in memory at a time.
+
+    start_after resumes after that document id.
+    """
+    query = db.collection(collection).order_by("__name__").limit(page_size)
+    if fields:
+        query = query.select(fields)
+    last = {"__name__": start_after} if start_after is not None else None
+    while True:
+        page = (query.start_after(last) if last is not None else query).get()
+        if not page:
+            return
+        for snap in page:
+            yield snap
+        if len(page) < page_size:
+            return
+        last = page[-1]
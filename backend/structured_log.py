@@ -0,0 +1,205 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from metrics import metrics
+
+LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Records waiting for the writer thread; when the sink can't keep up, new records are dropped, not waited on
+QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# Share of requests per route whose info lines are kept; warnings and errors are always kept
+SAMPLE_RATES = {
+    "check_license": 0.05,
+    "sync_user": 0.2,
+    "healthz": 0.0,
+    "readyz": 0.0,
+    "metrics_snapshot": 0.0,
+}
+
+
+def _parse_rates(value):
+    # LOG_SAMPLE_RATES="check_license=0.01,sync_user=1"
+    out = {}
+    for item in (value or "").split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            out[name.strip()] = min(1.0, max(0.0, float(rate)))
+    return out
+
+
+SAMPLE_RATES.update(_parse_rates(os.getenv("LOG_SAMPLE_RATES")))
+
+_VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+
+class RequestContext:
+    """What every log line of one request carries: its id, route and upstream time so far"""
+
+    __slots__ = ("request_id", "route", "sampled", "started", "_upstream", "_lock")
+
+    def __init__(self, route, request_id=None):
+        self.request_id = request_id if request_id and _VALID_REQUEST_ID.match(request_id) else uuid.uuid4().hex
+        self.route = route
+        # Decided once, so a sampled request keeps all of its lines
+        self.sampled = random.random() < SAMPLE_RATES.get(route, 1.0)
+        self.started = time.perf_counter()
+        self._upstream = {}
+        self._lock = threading.Lock()
+
+    def add_upstream(self, name, seconds):
+        with self._lock:
+            calls, total = self._upstream.get(name, (0, 0.0))
+            self._upstream[name] = (calls + 1, total + seconds)
+
+    def upstream_ms(self):
+        with self._lock:
+            return {name: round(total * 1000, 1) for name, (_, total) in self._upstream.items()}
+
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+
+_current = contextvars.ContextVar("log_request", default=None)
+
+
+def begin(route, request_id=None):
+    """Starts the log context of a request; returns a token for end()"""
+    return _current.set(RequestContext(route, request_id))
+
+
+def end(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+def record_upstream(name, seconds):
+    """Adds one upstream call to the current request's timings (no-op outside a request)"""
+    ctx = _current.get()
+    if ctx is not None:
+        ctx.add_upstream(name, seconds)
+
+
+class _ContextFilter(logging.Filter):
+    """Stamps records with their request and drops info lines of unsampled requests"""
+
+    def filter(self, record):
+        ctx = _current.get()
+        if ctx is None:
+            return True
+        if record.levelno < logging.WARNING and not ctx.sampled:
+            return False
+        record.request_id = ctx.request_id
+        record.route = ctx.route
+        record.upstream_ms = ctx.upstream_ms()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        for key in ("request_id", "route", "upstream_ms"):
+            value = getattr(record, key, None)
+            if value:
+                entry[key] = value
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only what must happen on the caller's thread: freeze the message and traceback.
+        # JSON encoding and the write happen on the listener thread.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("log_dropped")
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # The queue may be full; the listener is draining it, so waiting for room is safe here
+        self.queue.put(self._sentinel)
+
+
+_handler = None
+_sink = None
+_listener = None
+
+
+def _start_listener():
+    global _listener
+    _listener = _QueueListener(_handler.queue, _sink)
+    _listener.start()
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()  # writes out what is queued
+        _listener = None
+
+
+def _after_fork_in_child():
+    # The parent's listener thread doesn't exist here; start over with an empty queue
+    global _listener
+    _listener = None
+    _handler.queue = queue.Queue(QUEUE_SIZE)
+    _start_listener()
+
+
+def setup(stream=None, level=LEVEL):
+    """Sends every log record through a bounded queue to one writer thread as JSON lines"""
+    global _handler, _sink
+    if _handler is not None:
+        return
+    _sink = logging.StreamHandler(stream or sys.stdout)
+    _sink.setFormatter(JsonFormatter())
+    _handler = _QueueHandler(queue.Queue(QUEUE_SIZE))
+    _handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [_handler]
+    root.setLevel(level)
+
+    _start_listener()
+    # Under gunicorn --preload the master forks workers after this ran
+    os.register_at_fork(before=_stop_listener, after_in_parent=_start_listener, after_in_child=_after_fork_in_child)
+    atexit.register(_stop_listener)
+    metrics.gauge_fn("log_queue_depth", lambda: _handler.queue.qsize())
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+from metrics import metrics
+import upstream
+from rate_limit import TokenBucketLimiter, parse_limit
+
+log = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(os.getenv("SUPPORT_MAIL_MAX_ATTEMPTS", "8"))
+BACKOFF_BASE_SECONDS = float(os.getenv("SUPPORT_MAIL_BACKOFF_BASE", "5"))
+BACKOFF_MAX_SECONDS = float(os.getenv("SUPPORT_MAIL_BACKOFF_MAX", "900"))
+# Resend allows 2 requests/second per team by default
+SEND_RATE = parse_limit(os.getenv("SUPPORT_MAIL_RATE", "2/1")) or (2.0, 2.0)
+POLL_SECONDS = 5.0
+BATCH_SIZE = 20
+# A row stuck in 'sending' this long belongs to a worker that died mid-send
+STALE_CLAIM_SECONDS = 300
+SENT_RETENTION_SECONDS = 7 * 24 * 3600
+
+
+def init_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS support_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            claim TEXT,
+            claimed_at REAL,
+            sent_at REAL,
+            resend_id TEXT,
+            last_error TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_support_outbox_due ON support_outbox (status, next_attempt_at)")
+
+
+def backoff_delay(attempts):
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempts)))
+
+
+class SupportOutbox:
+    """Persists support mails locally and delivers them from a background thread"""
+
+    def __init__(self, db_name, send):
+        self.db_name = db_name
+        self.send = send
+        self._wake = threading.Event()
+        self._thread = None
+        self._throttle = TokenBucketLimiter(max_keys=1)
+        metrics.gauge_fn("support_outbox_depth", self.depth)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_name, timeout=10)
+
+    def enqueue(self, cursor, params):
+        """Records a support mail in the caller's SQLite transaction (sqlite_writer); returns its outbox id"""
+        now = time.time()
+        cursor.execute(
+            "INSERT INTO support_outbox (params, created_at, next_attempt_at) VALUES (?, ?, ?)",
+            (json.dumps(params), now, now),
+        )
+        metrics.inc("support_mail_enqueued")
+        self._wake.set()
+        return cursor.lastrowid
+
+    def depth(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM support_outbox WHERE status IN ('pending', 'sending')").fetchone()[0]
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="support-mail-sender", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                delivered = self.deliver_due()
+            except Exception as e:
+                log.error("Support outbox sender error: %s", e)
+                delivered = 0
+            if not delivered:
+                self._wake.wait(POLL_SECONDS)
+                self._wake.clear()
+
+    def _claim(self):
+        now = time.time()
+        claim = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE support_outbox SET status='pending', claim=NULL WHERE status='sending' AND claimed_at < ?",
+                (now - STALE_CLAIM_SECONDS,),
+            )
+            conn.execute(
+                """
+                UPDATE support_outbox SET status='sending', claim=?, claimed_at=?
+                WHERE id IN (
+                    SELECT id FROM support_outbox
+                    WHERE status='pending' AND next_attempt_at <= ?
+                    ORDER BY id LIMIT ?
+                )
+                """,
+                (claim, now, now, BATCH_SIZE),
+            )
+            return conn.execute(
+                "SELECT id, params, attempts, created_at FROM support_outbox WHERE claim=? ORDER BY id",
+                (claim,),
+            ).fetchall()
+
+    def deliver_due(self):
+        """Sends every due message once; returns how many were delivered"""
+        delivered = 0
+        for outbox_id, params, attempts, created_at in self._claim():
+            self._wait_for_send_slot()
+            try:
+                with upstream.timed("resend"):
+                    response = self.send(json.loads(params)) or {}
+                sent_at = time.time()
+                with self._connect() as conn:
+                    conn.execute(
+                        "UPDATE support_outbox SET status='sent', sent_at=?, resend_id=?, claim=NULL, last_error=NULL WHERE id=?",
+                        (sent_at, response.get("id"), outbox_id),
+                    )
+                metrics.inc("support_mail_sent")
+                metrics.observe("support_mail_delivery_seconds", sent_at - created_at)
+                delivered += 1
+            except Exception as e:
+                attempts += 1
+                status = "failed" if attempts >= MAX_ATTEMPTS else "pending"
+                with self._connect() as conn:
+                    conn.execute(
+                        "UPDATE support_outbox SET status=?, attempts=?, next_attempt_at=?, claim=NULL, last_error=? WHERE id=?",
+                        (status, attempts, time.time() + backoff_delay(attempts), str(e)[:500], outbox_id),
+                    )
+                metrics.inc("support_mail_errors", final=str(status == "failed").lower())
+                log.warning("Support mail %s attempt %s failed: %s", outbox_id, attempts, e)
+
+        if delivered:
+            with self._connect() as conn:
+                conn.execute(
+                    "DELETE FROM support_outbox WHERE status='sent' AND sent_at < ?",
+                    (time.time() - SENT_RETENTION_SECONDS,),
+                )
+        return delivered
+
+    def _wait_for_send_slot(self):
+        capacity, rate = SEND_RATE
+        while True:
+            allowed, retry_after = self._throttle.acquire([("resend", capacity, rate)])
+            if allowed:
+                return
+            time.sleep(retry_after)
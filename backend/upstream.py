@@ -0,0 +1,221 @@
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import bulkheads
+import deadlines
+import structured_log
+from metrics import metrics
+
+# Latencies kept per upstream for the diagnostics payload
+RECENT_SAMPLES = 100
+HTTP_POOL_SIZE = int(os.getenv("UPSTREAM_HTTP_POOL_SIZE", "10"))
+# Applied when a call doesn't pass its own timeout
+HTTP_DEFAULT_TIMEOUT = float(os.getenv("UPSTREAM_HTTP_TIMEOUT_SECONDS", "20"))
+
+# Retry policy for idempotent GETs (get_idempotent)
+RETRY_ATTEMPTS = int(os.getenv("UPSTREAM_RETRY_ATTEMPTS", "3"))
+RETRY_BACKOFF_SECONDS = float(os.getenv("UPSTREAM_RETRY_BACKOFF_SECONDS", "0.2"))
+RETRY_BUDGET_SECONDS = float(os.getenv("UPSTREAM_RETRY_BUDGET_SECONDS", "8"))
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+HEDGE_ENABLED = os.getenv("UPSTREAM_HEDGE_ENABLED", "1") == "1"
+# The p95 a hedge waits for is only trusted once there are enough samples
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY_SECONDS = 0.05
+
+
+class _Stats:
+    __slots__ = ("calls", "errors", "recent", "last_error", "last_error_at", "last_ok_at")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+        self.last_error = None
+        self.last_error_at = None
+        self.last_ok_at = None
+
+
+_lock = threading.Lock()
+_stats = {}
+
+
+def record(name, seconds, error=None):
+    """Records one call to an upstream (firestore, paypal, paddle, sqlite, resend)"""
+    metrics.observe("upstream_latency_seconds", seconds, upstream=name)
+    structured_log.record_upstream(name, seconds)
+    if error is not None:
+        metrics.inc("upstream_errors", upstream=name)
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = _Stats()
+        stats.calls += 1
+        stats.recent.append(seconds)
+        if error is None:
+            stats.last_ok_at = time.time()
+        else:
+            stats.errors += 1
+            stats.last_error = str(error)[:300]
+            stats.last_error_at = time.time()
+
+
+def latency_quantile(name, q, min_samples=1):
+    """Quantile of an upstream's recent latencies, or None with fewer than min_samples"""
+    with _lock:
+        stats = _stats.get(name)
+        recent = sorted(stats.recent) if stats else []
+    if len(recent) < min_samples:
+        return None
+    return recent[min(len(recent) - 1, int(round(q * (len(recent) - 1))))]
+
+
+@contextmanager
+def timed(name):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record(name, time.perf_counter() - started, e)
+        raise
+    record(name, time.perf_counter() - started)
+
+
+def diagnostics():
+    """Recent latency and error state of every upstream seen by this process"""
+    with _lock:
+        items = [(name, s.calls, s.errors, sorted(s.recent), s.recent[-1] if s.recent else None,
+                  s.last_error, s.last_error_at, s.last_ok_at) for name, s in _stats.items()]
+    out = {}
+    for name, calls, errors, recent, last, last_error, last_error_at, last_ok_at in items:
+        ms = lambda v: round(v * 1000, 2) if v is not None else None
+        pick = lambda q: recent[min(len(recent) - 1, int(round(q * (len(recent) - 1))))] if recent else None
+        out[name] = {
+            "calls": calls,
+            "errors": errors,
+            "last_ms": ms(last),
+            "p50_ms": ms(pick(0.50)),
+            "p95_ms": ms(pick(0.95)),
+            "max_ms": ms(recent[-1] if recent else None),
+            "last_ok_at": last_ok_at,
+            "last_error": last_error,
+            "last_error_at": last_error_at,
+        }
+    return out
+
+
+class TimedSession(requests.Session):
+    """requests.Session with a sized connection pool that reports every call's latency.
+
+    Calls go through the upstream's bulkhead and are capped by the request deadline.
+    """
+
+    def __init__(self, name, pool_size=HTTP_POOL_SIZE, timeout=HTTP_DEFAULT_TIMEOUT):
+        super().__init__()
+        self.upstream = name
+        self.default_timeout = timeout
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        with bulkheads.slot(self.upstream):
+            kwargs["timeout"] = deadlines.timeout(self.upstream, kwargs.get("timeout") or self.default_timeout)
+            started = time.perf_counter()
+            try:
+                resp = super().request(method, url, **kwargs)
+            except Exception as e:
+                record(self.upstream, time.perf_counter() - started, e)
+                if isinstance(e, requests.Timeout) and deadlines.expired():
+                    raise deadlines.exceeded(self.upstream) from e
+                raise
+        error = f"HTTP {resp.status_code}" if resp.status_code >= 500 else None
+        record(self.upstream, time.perf_counter() - started, error)
+        return resp
+
+    def get_idempotent(self, url, attempts=RETRY_ATTEMPTS, budget=RETRY_BUDGET_SECONDS, hedge=HEDGE_ENABLED, **kwargs):
+        """GET retried with jittered exponential backoff inside a total time budget.
+
+        Connection errors, timeouts, 429 and 5xx are retried; every attempt's
+        timeout is capped by what is left of the budget. With hedge, a second
+        request goes out once an attempt outlives this upstream's observed p95
+        and the first good response wins. When attempts or budget run out the
+        last response is returned, or the last error raised.
+        """
+        deadline = time.monotonic() + deadlines.timeout(self.upstream, budget)
+        last_resp = last_error = None
+        for attempt in range(attempts):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            kw = dict(kwargs, timeout=min(kwargs.get("timeout") or self.default_timeout, remaining))
+            metrics.inc("upstream_attempts", upstream=self.upstream, kind="first" if attempt == 0 else "retry")
+            try:
+                resp = self._hedged_get(url, kw, deadline) if hedge else self.get(url, **kw)
+            except requests.RequestException as e:
+                last_resp, last_error = None, e
+            else:
+                if resp.status_code not in RETRYABLE_STATUS:
+                    return resp
+                last_resp, last_error = resp, None
+            # Full jitter keeps clients that failed together from retrying together
+            backoff = random.uniform(0, RETRY_BACKOFF_SECONDS * 2 ** attempt)
+            if attempt + 1 >= attempts or time.monotonic() + backoff >= deadline:
+                break
+            time.sleep(backoff)
+        metrics.inc("upstream_retries_exhausted", upstream=self.upstream)
+        if last_resp is not None:
+            return last_resp
+        raise last_error or requests.Timeout(f"{self.upstream}: retry budget exhausted")
+
+    def _hedged_get(self, url, kwargs, deadline):
+        delay = latency_quantile(self.upstream, 0.95, HEDGE_MIN_SAMPLES)
+        if delay is None:
+            return self.get(url, **kwargs)
+        delay = max(HEDGE_MIN_DELAY_SECONDS, delay)
+        # Both legs run with the caller's request deadline
+        primary = _hedge_pool.submit(contextvars.copy_context().run, self.get, url, **kwargs)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeout:
+            pass
+        if time.monotonic() >= deadline:
+            return primary.result()
+
+        metrics.inc("upstream_attempts", upstream=self.upstream, kind="hedge")
+        hedge = _hedge_pool.submit(contextvars.copy_context().run, self.get, url, **kwargs)
+        pending = {primary: "primary", hedge: "hedge"}
+        last = None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                winner = pending.pop(fut)
+                if fut.exception() is None and fut.result().status_code not in RETRYABLE_STATUS:
+                    metrics.inc("upstream_hedge_wins", upstream=self.upstream, winner=winner)
+                    for loser in pending:
+                        loser.add_done_callback(_close_response)
+                    return fut.result()
+                last = fut
+        return last.result()
+
+
+def _close_response(fut):
+    if fut.exception() is None:
+        fut.result().close()
+
+
+# Runs both legs of a hedged GET so the caller can take whichever answers first
+_hedge_pool = ThreadPoolExecutor(max_workers=2 * HTTP_POOL_SIZE, thread_name_prefix="upstream-hedge")
+
+
+# Shared per upstream so keep-alive connections are reused across requests
+paypal = TimedSession("paypal")
+paddle = TimedSession("paddle")
@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from firebase_admin import firestore
+
+import firestore_outbox
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# At most one lastLogin write per uid in this window; later logins inside it are flushed at its end
+LAST_LOGIN_WINDOW_SECONDS = float(os.getenv("USER_SYNC_LAST_LOGIN_WINDOW_SECONDS", "3600"))
+FLUSH_BATCH = 500
+
+
+def init_table(conn):
+    # Last profile written to usuarios per uid; pending_login_at is a debounced lastLogin not yet written
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_profiles (
+            uid TEXT PRIMARY KEY,
+            email TEXT,
+            display_name TEXT,
+            photo_url TEXT,
+            last_login_written_at REAL,
+            pending_login_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_profiles_pending ON user_profiles (pending_login_at) WHERE pending_login_at IS NOT NULL")
+
+
+def record_login(cursor, uid, email, display_name, photo_url, now=None, window=LAST_LOGIN_WINDOW_SECONDS):
+    """Queues the usuarios write a login needs, if any; returns 'written' or 'debounced'.
+
+    A changed profile is written right away with lastLogin. An unchanged one
+    only refreshes lastLogin once per window; logins inside the window leave
+    a pending timestamp for flush_due.
+    """
+    now = now or time.time()
+    row = cursor.execute(
+        "SELECT email, display_name, photo_url, last_login_written_at FROM user_profiles WHERE uid = ?",
+        (uid,),
+    ).fetchone()
+    profile = (email, display_name, photo_url)
+    changed = row is None or tuple(row[:3]) != profile
+    if not changed and row[3] is not None and now - row[3] < window:
+        cursor.execute("UPDATE user_profiles SET pending_login_at = ? WHERE uid = ?", (now, uid))
+        return "debounced"
+
+    data = {"uid": uid, "lastLogin": firestore.SERVER_TIMESTAMP}
+    if changed:
+        data.update(email=email, displayName=display_name, photoURL=photo_url)
+    firestore_outbox.enqueue(cursor, "usuarios", uid, data)
+    cursor.execute(
+        """
+        INSERT INTO user_profiles (uid, email, display_name, photo_url, last_login_written_at, pending_login_at)
+        VALUES (?, ?, ?, ?, ?, NULL)
+        ON CONFLICT(uid) DO UPDATE SET
+            email=excluded.email,
+            display_name=excluded.display_name,
+            photo_url=excluded.photo_url,
+            last_login_written_at=excluded.last_login_written_at,
+            pending_login_at=NULL
+        """,
+        (uid, email, display_name, photo_url, now),
+    )
+    return "written"
+
+
+def flush_due(cursor, now=None, window=LAST_LOGIN_WINDOW_SECONDS, limit=FLUSH_BATCH):
+    """Writes the debounced lastLogin of every uid whose window has closed; returns how many"""
+    now = now or time.time()
+    rows = cursor.execute(
+        """
+        SELECT uid, pending_login_at FROM user_profiles
+        WHERE pending_login_at IS NOT NULL AND (last_login_written_at IS NULL OR last_login_written_at <= ?)
+        LIMIT ?
+        """,
+        (now - window, limit),
+    ).fetchall()
+    for uid, login_at in rows:
+        # The login's own time, not the flush time
+        firestore_outbox.enqueue(cursor, "usuarios", uid, {"lastLogin": datetime.fromtimestamp(login_at, timezone.utc)})
+    cursor.executemany(
+        "UPDATE user_profiles SET last_login_written_at = ?, pending_login_at = NULL WHERE uid = ?",
+        [(now, uid) for uid, _ in rows],
+    )
+    return len(rows)
+
+
+class UserSync:
+    """Coalesces /sync-user logins into as few usuarios writes as possible"""
+
+    def __init__(self, writer, window=LAST_LOGIN_WINDOW_SECONDS):
+        self.writer = writer
+        self.window = window
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counts = {"written": 0, "debounced": 0, "flushed": 0}
+        metrics.gauge_fn("user_sync_suppressed_ratio", self.suppressed_ratio)
+
+    def count(self, result):
+        """Tallies what record_login decided for one request"""
+        metrics.inc("user_sync_logins", result=result)
+        with self._lock:
+            self._counts[result] += 1
+
+    def suppressed_ratio(self):
+        """Share of logins since start that cost no usuarios write, after debounced flushes"""
+        with self._lock:
+            logins = self._counts["written"] + self._counts["debounced"]
+            writes = self._counts["written"] + self._counts["flushed"]
+        return round(max(0, logins - writes) / logins, 4) if logins else 0.0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="user-sync-flush", daemon=True)
+        self._thread.start()
+
+    def flush(self):
+        total = 0
+        while True:
+            flushed = self.writer.execute(lambda cursor: flush_due(cursor, window=self.window))
+            total += flushed
+            if flushed < FLUSH_BATCH:
+                break
+        if total:
+            metrics.inc("user_sync_flushed", total)
+            with self._lock:
+                self._counts["flushed"] += total
+        return total
+
+    def _run(self):
+        while True:
+            time.sleep(min(60.0, max(1.0, self.window / 4)))
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("User sync flush error: %s", e)
@@ -0,0 +1,130 @@
+"""Append-only journal of inbound webhooks.
+
+Every request is stored as one JSON line (receive time, path, headers, raw
+body) in gzip segments named webhooks-<start>-<pid>.ndjson.gz. The active
+segment carries an extra .open suffix until it is rotated. Each record is
+flushed as a complete gzip block, so a crash loses at most the record being
+written.
+"""
+import base64
+import glob
+import gzip
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+JOURNAL_DIR = os.getenv("WEBHOOK_JOURNAL_DIR", "webhook_journal")
+SEGMENT_BYTES = int(os.getenv("WEBHOOK_JOURNAL_SEGMENT_MB", "64")) * 1024 * 1024
+SEGMENT_SECONDS = int(os.getenv("WEBHOOK_JOURNAL_SEGMENT_HOURS", "24")) * 3600
+OPEN_SUFFIX = ".open"
+# Request headers that are transport details or credentials, not part of the event
+SKIP_HEADERS = {"cookie", "authorization", "content-length", "host", "connection"}
+
+
+class WebhookJournal:
+    def __init__(self, directory=JOURNAL_DIR, segment_bytes=SEGMENT_BYTES, segment_seconds=SEGMENT_SECONDS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self._lock = threading.Lock()
+        self._raw = None
+        self._gz = None
+        self._path = None
+        self._opened_at = 0.0
+        self._pid = None
+
+    def append(self, path, headers, body, received_at=None):
+        """Journals one request; body is the raw bytes as received"""
+        record = {
+            "received_at": received_at or time.time(),
+            "path": path,
+            "headers": {k: v for k, v in headers.items() if k.lower() not in SKIP_HEADERS},
+        }
+        try:
+            record["body"] = body.decode("utf-8")
+        except UnicodeDecodeError:
+            record["body_b64"] = base64.b64encode(body).decode("ascii")
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+        with self._lock:
+            self._ensure_segment(len(line))
+            self._gz.write(line)
+            self._gz.flush(zlib.Z_SYNC_FLUSH)
+        metrics.inc("webhook_journal_records")
+        metrics.inc("webhook_journal_bytes", len(line))
+
+    def _ensure_segment(self, incoming):
+        # A forked worker must not share the parent's file handle
+        if self._gz is not None and self._pid != os.getpid():
+            self._gz = self._raw = None
+        if self._gz is not None:
+            too_big = self._raw.tell() + incoming > self.segment_bytes
+            too_old = time.time() - self._opened_at > self.segment_seconds
+            if not (too_big or too_old):
+                return
+            self._seal()
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        self._pid = os.getpid()
+        self._path = os.path.join(self.directory, f"webhooks-{stamp}-{self._pid}.ndjson.gz{OPEN_SUFFIX}")
+        self._raw = open(self._path, "ab")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="ab")
+        self._opened_at = time.time()
+
+    def _seal(self):
+        self._gz.close()
+        self._raw.close()
+        os.replace(self._path, self._path[: -len(OPEN_SUFFIX)])
+        self._gz = self._raw = self._path = None
+
+    def close(self):
+        with self._lock:
+            if self._gz is not None:
+                self._seal()
+
+
+def segment_paths(paths):
+    """Expands directories into their segments, sealed and open"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(glob.glob(os.path.join(path, "webhooks-*.ndjson.gz*")))
+        else:
+            found.append(path)
+    return sorted(found, key=lambda p: os.path.basename(p))
+
+
+def _segment_records(path):
+    with gzip.open(path, "rb") as f:
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "body_b64" in record:
+                    record["body"] = base64.b64decode(record.pop("body_b64"))
+                yield record
+        except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+            # Expected for the segment a running worker is still writing
+            if not path.endswith(OPEN_SUFFIX):
+                log.warning("Journal segment %s ends early: %s", path, e)
+
+
+def iter_records(paths):
+    """Yields journal records of all segments merged by receive time.
+
+    Each worker process writes its own segments, so segments overlap in time.
+    A torn tail of an open segment is skipped.
+    """
+    streams = [_segment_records(p) for p in segment_paths(paths)]
+    return heapq.merge(*streams, key=lambda r: r.get("received_at", 0))